@@ -0,0 +1,363 @@
+# archive.py - Zip writer whose entries can be compressed concurrently
+import hashlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from pathlib import Path
+from typing import List, Optional
+
+# Sizes/offsets at or above this need ZIP64 records; the 32-bit field then holds 0xFFFFFFFF
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+UTF8_FLAG = 0x0800
+COPY_BUFFER = 1024 * 1024
+
+
+def _dos_datetime(timestamp: float):
+    t = time.localtime(timestamp)
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    clock = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return clock, date
+
+
+class ArchiveEntry:
+    def __init__(self, arcname: str, method: int):
+        self.arcname = arcname
+        self.method = method
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.seconds = 0.0
+        self.data_path: Optional[str] = None
+        # Entries copied from another archive read compressed_size bytes from here instead
+        self.source = None
+        self.data_offset = 0
+        self.offset = 0
+        self.mtime = time.time()
+
+    @property
+    def zip64(self):
+        return self.size >= ZIP64_LIMIT or self.compressed_size >= ZIP64_LIMIT
+
+    def stats(self):
+        return {
+            "name": self.arcname,
+            "bytes": self.size,
+            "compressed_bytes": self.compressed_size,
+            "seconds": round(self.seconds, 4),
+        }
+
+
+class EntryWriter(io.RawIOBase):
+    """Binary sink for one archive member: CRCs and compresses into a private temp file.
+
+    Entries do not share state, so different threads can fill different entries at once.
+    """
+
+    def __init__(self, entry: ArchiveEntry, tmp_dir: str, level: int):
+        super().__init__()
+        self.entry = entry
+        fd, entry.data_path = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+        self._file = os.fdopen(fd, "wb", buffering=COPY_BUFFER)
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if entry.method == ZIP_DEFLATED else None
+        self._started = time.perf_counter()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.entry.size
+
+    def write(self, data):
+        data = bytes(data)
+        entry = self.entry
+        entry.crc = zlib.crc32(data, entry.crc)
+        entry.size += len(data)
+        out = self._compressor.compress(data) if self._compressor is not None else data
+        self._file.write(out)
+        entry.compressed_size += len(out)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._compressor is not None:
+            tail = self._compressor.flush()
+            self._file.write(tail)
+            self.entry.compressed_size += len(tail)
+        self._file.close()
+        self.entry.seconds = time.perf_counter() - self._started
+        super().close()
+
+
+class ArchiveWriter:
+    """Builds a zip (ZIP64 when needed) from entries written in any order or thread.
+
+    open_entry() reserves the member's position; the archive is assembled on close()
+    by copying each entry's already-compressed bytes behind its header.
+    """
+
+    def __init__(self, path: Path, level: int = 6):
+        self.path = Path(path)
+        self.level = level
+        self._entries: List[ArchiveEntry] = []
+        self._lock = threading.Lock()
+        self._tmp_dir = tempfile.mkdtemp(prefix=".archive-", dir=self.path.parent)
+        self._sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def open_entry(self, arcname: str, compress: bool = True) -> EntryWriter:
+        entry = ArchiveEntry(arcname, ZIP_DEFLATED if compress else ZIP_STORED)
+        with self._lock:
+            self._entries.append(entry)
+        return EntryWriter(entry, self._tmp_dir, self.level)
+
+    def add_bytes(self, arcname: str, data: bytes, compress: bool = True):
+        with self.open_entry(arcname, compress) as out:
+            out.write(data)
+
+    def add_file(self, arcname: str, path, compress: bool = True):
+        with open(path, "rb") as src, self.open_entry(arcname, compress) as out:
+            shutil.copyfileobj(src, out, COPY_BUFFER)
+
+    def copy_entry(self, source_zip: Path, name: str, expected_crc: Optional[int] = None) -> bool:
+        """Add a member of another zip as-is (still compressed); False if it is not there.
+
+        The source stays open until close(), so it may be replaced meanwhile (e.g. by
+        this archive itself) without affecting the copy. expected_crc guards against a
+        member that changed since it was recorded.
+        """
+        key = str(Path(source_zip).resolve())
+        with self._lock:
+            if key not in self._sources:
+                self._sources[key] = open(source_zip, "rb")
+            f = self._sources[key]
+            try:
+                info = zipfile.ZipFile(f).getinfo(name)
+            except (KeyError, zipfile.BadZipFile):
+                return False
+            if expected_crc is not None and info.CRC != expected_crc:
+                return False
+            entry = ArchiveEntry(name, info.compress_type)
+            entry.crc, entry.size, entry.compressed_size = info.CRC, info.file_size, info.compress_size
+            entry.mtime = time.mktime(info.date_time + (0, 0, -1))
+            entry.source, entry.data_offset = f, member_data_offset(f, info)
+            entry.data_path = key
+            self._entries.append(entry)
+        return True
+
+    def abort(self):
+        for f in self._sources.values():
+            f.close()
+        self._sources = {}
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def stats(self) -> List[dict]:
+        """Per-entry sizes and write times"""
+        return [e.stats() for e in self._entries]
+
+    def close(self) -> List[dict]:
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        try:
+            with open(tmp_path, "wb") as out:
+                for entry in self._entries:
+                    if entry.data_path is None:
+                        continue
+                    entry.offset = out.tell()
+                    out.write(local_header(entry))
+                    if entry.source is not None:
+                        entry.source.seek(entry.data_offset)
+                        remaining = entry.compressed_size
+                        while remaining > 0:
+                            chunk = entry.source.read(min(COPY_BUFFER, remaining))
+                            if not chunk:
+                                raise IOError(f"{entry.data_path} ended inside {entry.arcname}")
+                            out.write(chunk)
+                            remaining -= len(chunk)
+                    else:
+                        with open(entry.data_path, "rb") as data:
+                            shutil.copyfileobj(data, out, COPY_BUFFER)
+                out.write(central_directory([e for e in self._entries if e.data_path is not None], out.tell()))
+            os.replace(tmp_path, self.path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+            self.abort()
+        return self.stats()
+
+
+def local_header(entry: ArchiveEntry) -> bytes:
+    name = entry.arcname.encode("utf-8")
+    clock, date = _dos_datetime(entry.mtime)
+    if entry.zip64:
+        extra = struct.pack("<HHQQ", 0x0001, 16, entry.size, entry.compressed_size)
+        sizes = (ZIP64_MARKER, ZIP64_MARKER)
+    else:
+        extra = b""
+        sizes = (entry.compressed_size, entry.size)
+    header = struct.pack(
+        "<IHHHHHIIIHH", 0x04034B50, 45 if entry.zip64 else 20, UTF8_FLAG, entry.method,
+        clock, date, entry.crc, sizes[0], sizes[1], len(name), len(extra),
+    )
+    return header + name + extra
+
+
+def central_directory(entries: List[ArchiveEntry], cd_start: int) -> bytes:
+    """Central directory and end records for entries whose offsets are already set"""
+    out = io.BytesIO()
+    for entry in entries:
+        name = entry.arcname.encode("utf-8")
+        clock, date = _dos_datetime(entry.mtime)
+        fields = []
+        size, csize, offset = entry.size, entry.compressed_size, entry.offset
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+            size = ZIP64_MARKER
+        if csize >= ZIP64_LIMIT:
+            fields.append(csize)
+            csize = ZIP64_MARKER
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_MARKER
+        extra = struct.pack("<HH", 0x0001, 8 * len(fields)) + struct.pack(f"<{len(fields)}Q", *fields) if fields else b""
+        needed = 45 if fields else 20
+        out.write(struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | 45, needed, UTF8_FLAG, entry.method,
+            clock, date, entry.crc, csize, size, len(name), len(extra), 0, 0, 0,
+            0o100644 << 16, offset,
+        ))
+        out.write(name + extra)
+    cd_size = out.tell()
+    cd_end = cd_start + cd_size
+    count = len(entries)
+
+    if count >= 0xFFFF or cd_size >= ZIP64_LIMIT or cd_start >= ZIP64_LIMIT:
+        out.write(struct.pack(
+            "<IQHHIIQQQQ", 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, cd_start,
+        ))
+        out.write(struct.pack("<IIQI", 0x07064B50, 0, cd_end, 1))
+    out.write(struct.pack(
+        "<IHHHHIIH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        cd_size if cd_size < ZIP64_LIMIT else ZIP64_MARKER,
+        cd_start if cd_start < ZIP64_LIMIT else ZIP64_MARKER, 0,
+    ))
+    return out.getvalue()
+
+
+def _file_identity(stat: os.stat_result):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def member_data_offset(f, info: zipfile.ZipInfo) -> int:
+    """Offset of a member's (compressed) bytes in an open zip file"""
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+class ZipSelection:
+    """A zip of some members of an existing archive, laid out without recompressing.
+
+    Member bytes are referenced where they sit in the source archive, so the result has a
+    known size up front and any byte range of it can be streamed without building it.
+    """
+
+    def __init__(self, source: Path, names: List[str]):
+        self.source = Path(source)
+        self.segments = []  # bytes, or (offset in source, length)
+        self.entries: List[ArchiveEntry] = []
+        with zipfile.ZipFile(self.source) as zf, open(self.source, "rb") as f:
+            infos = {info.filename: info for info in zf.infolist()}
+            missing = [name for name in names if name not in infos]
+            if missing:
+                raise KeyError(", ".join(missing))
+            position = 0
+            for name in names:
+                info = infos[name]
+                entry = ArchiveEntry(name, info.compress_type)
+                entry.crc, entry.size, entry.compressed_size = info.CRC, info.file_size, info.compress_size
+                entry.mtime = time.mktime(info.date_time + (0, 0, -1))
+                entry.offset = position
+                header = local_header(entry)
+                self.segments += [header, (member_data_offset(f, info), info.compress_size)]
+                self.entries.append(entry)
+                position += len(header) + info.compress_size
+            self.segments.append(central_directory(self.entries, position))
+            self._identity = _file_identity(os.fstat(f.fileno()))
+        self.size = position + len(self.segments[-1])
+
+    def etag(self) -> str:
+        digest = hashlib.sha256()
+        for entry in self.entries:
+            digest.update(f"{entry.arcname}\0{entry.crc}\0{entry.size}\0{entry.method}\0{entry.mtime}\0".encode())
+        return f'"{digest.hexdigest()[:32]}"'
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None, chunk_size: int = COPY_BUFFER):
+        """Yield bytes start..end (inclusive) of the selection archive"""
+        end = self.size - 1 if end is None else end
+        position = 0
+        with open(self.source, "rb") as f:
+            if _file_identity(os.fstat(f.fileno())) != self._identity:
+                # Re-merged since the layout was read; the offsets no longer apply
+                raise IOError(f"{self.source} changed while it was being served")
+            for segment in self.segments:
+                length = len(segment) if isinstance(segment, bytes) else segment[1]
+                lo, hi = max(start, position), min(end + 1, position + length)
+                if lo < hi:
+                    if isinstance(segment, bytes):
+                        yield segment[lo - position:hi - position]
+                    else:
+                        f.seek(segment[0] + lo - position)
+                        remaining = hi - lo
+                        while remaining > 0:
+                            chunk = f.read(min(chunk_size, remaining))
+                            if not chunk:
+                                raise IOError(f"{self.source} is shorter than its directory says")
+                            remaining -= len(chunk)
+                            yield chunk
+                position += length
+                if position > end:
+                    break
+
+
+def iter_member_range(zip_path: Path, name: str, start: int = 0, end: Optional[int] = None,
+                      chunk_size: int = COPY_BUFFER):
+    """Yield bytes start..end (inclusive) of one member's uncompressed content.
+
+    Stored members are read straight from their offset; deflated ones are inflated from
+    the beginning and the bytes before start are discarded.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        info = zf.getinfo(name)
+        end = info.file_size - 1 if end is None else end
+        remaining = end - start + 1
+        if info.compress_type == ZIP_STORED:
+            with open(zip_path, "rb") as f:
+                f.seek(member_data_offset(f, info) + start)
+                while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+                    remaining -= len(chunk)
+                    yield chunk
+            return
+        with zf.open(info) as member:
+            skip = start
+            while skip > 0 and (chunk := member.read(min(chunk_size, skip))):
+                skip -= len(chunk)
+            while remaining > 0 and (chunk := member.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
@@ -0,0 +1,407 @@
+# benchmark.py - Reproducible pipeline benchmarks on synthetic Bundle 1 / Bundle 2 pairs
+#
+#   python benchmark.py run --tables 8 --rows 200000 --width 16 --shape one-to-many -o bench.json
+#   python benchmark.py compare baseline.json bench.json --threshold 0.15
+#
+# "run" generates the bundles from a seed, times every pipeline stage (load, cached load,
+# profile, mapping with a stubbed model, apply, zip, pdf) over several repeats and writes a
+# JSON report with throughput and peak traced memory per stage. "compare" diffs two reports
+# and exits non-zero when a stage got slower than the threshold.
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPORT_VERSION = 1
+STAGES = ("load", "load_cached", "profile", "mapping", "apply", "zip", "pdf")
+SHAPES = ("one-to-one", "one-to-many", "many-to-one")
+DTYPES = ("int", "float", "str", "date", "bool")
+
+# Field name stems; renamed source fields use abbreviations the local matcher cannot pair,
+# so that part of the mapping goes to the (stubbed) model
+_STEMS = ["customer_id", "order_total", "region_name", "created_date", "is_active", "unit_price",
+          "product_code", "quantity", "discount_rate", "account_status", "postal_code", "ship_date"]
+
+
+# Synthetic bundles -------------------------------------------------------------------
+
+def make_column(rng, kind: str, rows: int, cardinality: int):
+    if kind == "int":
+        return rng.integers(0, 1_000_000, rows)
+    if kind == "float":
+        return np.round(rng.normal(1000, 250, rows), 2)
+    if kind == "str":
+        return pd.Series(rng.integers(0, cardinality, rows)).map(lambda n: f"val_{n:06d}").to_numpy()
+    if kind == "date":
+        return (pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1500, rows), unit="D")).strftime("%Y-%m-%d")
+    if kind == "bool":
+        return rng.random(rows) < 0.5
+    raise ValueError(f"unknown dtype '{kind}'")
+
+
+def parse_dtype_mix(spec: str) -> dict:
+    """"int:3,str:2,float:1" -> relative weights per column kind"""
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.strip().partition(":")
+        if kind not in DTYPES:
+            raise ValueError(f"unknown dtype '{kind}' (expected one of {', '.join(DTYPES)})")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def table_layout(shape: str, tables: int):
+    """Pairs of (source table index, target table index) for a mapping shape"""
+    if shape == "one-to-one":
+        return [(i, i) for i in range(tables)]
+    if shape == "one-to-many":
+        # Each source table feeds two targets with half of its fields each
+        return [(i, 2 * i + part) for i in range(tables) for part in (0, 1)]
+    if shape == "many-to-one":
+        return [(i, i // 2) for i in range(tables)]
+    raise ValueError(f"unknown shape '{shape}' (expected one of {', '.join(SHAPES)})")
+
+
+def generate_bundles(out_dir: Path, tables: int = 4, rows: int = 50_000, target_rows: int = None, width: int = 12,
+                     dtype_mix: str = "int:3,float:2,str:3,date:1,bool:1", shape: str = "one-to-one",
+                     renamed_fraction: float = 0.5, cardinality: int = 1000, file_format: str = "csv", seed: int = 0):
+    """Write a Bundle 1 / Bundle 2 pair under out_dir; returns their paths and the true mappings.
+
+    Bundle 1 has `tables` source tables of `width` fields and `rows` rows; Bundle 2 holds the
+    targets implied by `shape` with `target_rows` rows each. renamed_fraction of the source
+    fields get names the local matcher will not pair with their target.
+    """
+    rng = np.random.default_rng(seed)
+    target_rows = rows if target_rows is None else target_rows
+    mix = parse_dtype_mix(dtype_mix)
+    kinds = list(mix)
+    weights = np.array([mix[k] for k in kinds]) / sum(mix.values())
+    layout = table_layout(shape, tables)
+
+    # Field kinds and names are per source table; targets take the fields routed to them
+    sources = []
+    for i in range(tables):
+        fields = []
+        for j in range(width):
+            kind = str(rng.choice(kinds, p=weights))
+            target_name = f"{_STEMS[j % len(_STEMS)]}_{j}"
+            renamed = rng.random() < renamed_fraction
+            source_name = f"f{i}x{j}_{kind[:2]}" if renamed else target_name
+            fields.append({"kind": kind, "target": target_name, "source": source_name})
+        sources.append(fields)
+
+    routes = {}
+    for source, target in layout:
+        routes.setdefault(source, []).append(target)
+    target_fields = {}
+    table_mappings = []
+    for source, targets in routes.items():
+        for part, target in enumerate(targets):
+            fields = sources[source][part::len(targets)]
+            existing = target_fields.setdefault(target, {})
+            for f in fields:
+                existing.setdefault(f["target"], f["kind"])
+            table_mappings.append({
+                "source_table": f"src_{source}",
+                "target_table": f"tgt_{target}",
+                "field_mappings": [
+                    {"source_field": f["source"], "target_field": f["target"], "confidence": 0.9, "reasoning": "synthetic"}
+                    for f in fields
+                ],
+            })
+
+    def write(df, path):
+        if file_format == "xlsx":
+            df.to_excel(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+
+    bundle1, bundle2 = [], []
+    for directory in ("bundle1", "bundle2"):
+        (out_dir / directory).mkdir(parents=True, exist_ok=True)
+    for i, fields in enumerate(sources):
+        df = pd.DataFrame({f["source"]: make_column(rng, f["kind"], rows, cardinality) for f in fields})
+        path = out_dir / "bundle1" / f"src_{i}.{file_format}"
+        write(df, path)
+        bundle1.append(str(path))
+    for target, fields in sorted(target_fields.items()):
+        df = pd.DataFrame({name: make_column(rng, kind, target_rows, cardinality) for name, kind in fields.items()})
+        path = out_dir / "bundle2" / f"tgt_{target}.{file_format}"
+        write(df, path)
+        bundle2.append(str(path))
+
+    return bundle1, bundle2, {"table_mappings": table_mappings, "summary": "synthetic ground truth"}
+
+
+def stub_responder(truth: dict):
+    """Model stand-in: answers each prompt with the true mappings of the tables it mentions"""
+    def respond(prompt: str) -> str:
+        mentioned = [tm for tm in truth["table_mappings"] if f'"{tm["source_table"]}": {{' in prompt]
+        return json.dumps({"table_mappings": mentioned, "summary": "benchmark stub"})
+    return respond
+
+
+# Measurement -------------------------------------------------------------------------
+
+class StageTimer:
+    """Collects wall time per stage over repeated passes, and peak traced memory in one pass"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.peak_bytes = {}
+        self.counters = {}
+        self.trace = False
+
+    def run(self, name, fn, **counters):
+        if self.trace:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        if self.trace:
+            self.peak_bytes[name] = tracemalloc.get_traced_memory()[1] - baseline
+        else:
+            self.seconds.setdefault(name, []).append(elapsed)
+        self.counters.setdefault(name, {}).update(counters)
+        return result
+
+    def report(self):
+        stages = {}
+        for name in STAGES:
+            if name not in self.seconds:
+                continue
+            runs = self.seconds[name]
+            median = statistics.median(runs)
+            entry = {
+                "seconds": round(median, 6),
+                "seconds_min": round(min(runs), 6),
+                "runs": [round(r, 6) for r in runs],
+                "peak_memory_bytes": self.peak_bytes.get(name),
+            }
+            for key, value in self.counters.get(name, {}).items():
+                entry[key] = value
+                if key in ("rows", "bytes") and median > 0:
+                    entry[f"{key}_per_second"] = round(value / median, 1)
+            stages[name] = entry
+        return stages
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmark(args) -> dict:
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="datamerge-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    bundle1, bundle2, truth = generate_bundles(
+        workdir / "data", tables=args.tables, rows=args.rows, target_rows=args.target_rows, width=args.width,
+        dtype_mix=args.dtypes, shape=args.shape, renamed_fraction=args.renamed, cardinality=args.cardinality,
+        file_format=args.format, seed=args.seed)
+
+    # main reads its settings at import time and keeps uploads/outputs/cache relative to
+    # the working directory, so import it from inside the scratch directory
+    os.environ.update({
+        "LLM_BACKEND": "stub",
+        "LLM_REQUESTS_PER_MINUTE": "0",
+        "STATE_BACKEND_URL": f"sqlite:///{workdir / 'cache' / 'state.sqlite3'}",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    })
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import main
+        from llm_client import StubClient
+        from archive import ArchiveWriter
+        from merge_engine import write_frame
+        from mapping_pdf import REPORTLAB_AVAILABLE, render_mapping_pdf
+
+        stub = StubClient(responder=stub_responder(truth))
+        main.llm_client = stub
+        input_bytes = sum(Path(p).stat().st_size for p in bundle1 + bundle2)
+        session_id = "benchmark"
+        output_dir = main.OUTPUT_DIR / session_id
+        output_dir.mkdir(parents=True, exist_ok=True)
+        timer = StageTimer()
+
+        def one_pass():
+            # Cold parse: the parse cache is emptied first so "load" always measures parsing
+            shutil.rmtree(main.table_cache.cache_dir, ignore_errors=True)
+            main.table_cache.cache_dir.mkdir(parents=True, exist_ok=True)
+            rows = None
+
+            memory = {}
+
+            def load():
+                return (main.load_tables(bundle1, "Bundle 1", compact=args.compact, memory=memory),
+                        main.load_tables(bundle2, "Bundle 2", compact=args.compact, memory=memory))
+
+            b1, b2 = timer.run("load", load, bytes=input_bytes)
+            rows = sum(len(df) for df in [*b1.values(), *b2.values()])
+            timer.counters["load"]["rows"] = rows
+            timer.counters["load"]["table_bytes_before"] = sum(m["bytes_before"] for m in memory.values())
+            timer.counters["load"]["table_bytes_after"] = sum(m["bytes_after"] for m in memory.values())
+            if main.table_cache.enabled:
+                timer.run("load_cached", load, rows=rows, bytes=input_bytes)
+
+            s1, s2 = timer.run("profile", lambda: main.analyze_all_schemas(b1, b2), rows=rows)
+
+            calls_before = stub.calls
+            mappings = timer.run("mapping", lambda: main.build_mappings(b1, b2, s1, s2),
+                                 columns=sum(len(df.columns) for df in b1.values()))
+            timer.counters["mapping"]["model_calls"] = stub.calls - calls_before
+            timer.counters["mapping"]["field_mappings"] = sum(len(tm["field_mappings"]) for tm in mappings["table_mappings"])
+
+            merged = timer.run("apply", lambda: main.apply_mappings(b1, b2, mappings), rows=rows)
+            merged_rows = sum(len(df) for df in merged.values())
+            timer.counters["apply"]["output_rows"] = merged_rows
+
+            def write_zip():
+                archive = ArchiveWriter(output_dir / "merged_output.zip", main.settings.output_compression_level)
+                entries = [archive.open_entry(f"merged_{name}.{args.output_format}", compress=args.output_format == "csv")
+                           for name in merged]
+                for entry, df in zip(entries, merged.values()):
+                    write_frame(entry, df, args.output_format)
+                archive.close()
+                return (output_dir / "merged_output.zip").stat().st_size
+
+            zip_bytes = timer.run("zip", write_zip, rows=merged_rows)
+            timer.counters["zip"]["bytes"] = zip_bytes
+
+            if REPORTLAB_AVAILABLE:
+                # Rendering itself; served PDFs come from the digest-keyed cache
+                pdf = timer.run("pdf", lambda: render_mapping_pdf(mappings, session_id),
+                                table_mappings=len(mappings["table_mappings"]))
+                timer.counters["pdf"]["bytes"] = len(pdf)
+
+        for _ in range(args.repeat):
+            one_pass()
+        if not args.no_memory:
+            timer.trace = True
+            tracemalloc.start()
+            try:
+                one_pass()
+            finally:
+                tracemalloc.stop()
+
+        return {
+            "version": REPORT_VERSION,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "environment": {
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "config": {
+                "tables": args.tables, "rows": args.rows, "target_rows": args.target_rows, "width": args.width,
+                "dtypes": args.dtypes, "shape": args.shape, "renamed": args.renamed, "cardinality": args.cardinality,
+                "format": args.format, "output_format": args.output_format, "compact": args.compact,
+                "seed": args.seed, "repeat": args.repeat,
+            },
+            "dataset": {
+                "bundle1_tables": len(bundle1),
+                "bundle2_tables": len(bundle2),
+                "input_bytes": input_bytes,
+                "true_field_mappings": sum(len(tm["field_mappings"]) for tm in truth["table_mappings"]),
+            },
+            "stages": timer.report(),
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        }
+    finally:
+        os.chdir(cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Comparison --------------------------------------------------------------------------
+
+def compare_reports(baseline: dict, current: dict, threshold: float):
+    """Per-stage time ratios (current / baseline) and the stages slower than 1 + threshold"""
+    rows, regressions = [], []
+    for name in STAGES:
+        old, new = baseline["stages"].get(name), current["stages"].get(name)
+        if not old or not new or not old["seconds"]:
+            continue
+        ratio = new["seconds"] / old["seconds"]
+        old_mem, new_mem = old.get("peak_memory_bytes"), new.get("peak_memory_bytes")
+        mem_ratio = new_mem / old_mem if old_mem and new_mem is not None else None
+        rows.append((name, old["seconds"], new["seconds"], ratio, mem_ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the merge pipeline on synthetic bundles")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate bundles and time every stage")
+    run.add_argument("--tables", type=int, default=4, help="Bundle 1 tables")
+    run.add_argument("--rows", type=int, default=50_000, help="rows per Bundle 1 table")
+    run.add_argument("--target-rows", type=int, default=None, help="rows per Bundle 2 table (default: --rows)")
+    run.add_argument("--width", type=int, default=12, help="fields per Bundle 1 table")
+    run.add_argument("--dtypes", default="int:3,float:2,str:3,date:1,bool:1", help="column kind weights")
+    run.add_argument("--shape", choices=SHAPES, default="one-to-one")
+    run.add_argument("--renamed", type=float, default=0.5, help="fraction of fields left for the model to map")
+    run.add_argument("--cardinality", type=int, default=1000, help="distinct values per string column")
+    run.add_argument("--format", choices=("csv", "xlsx"), default="csv", help="input file format")
+    run.add_argument("--output-format", choices=("csv", "parquet"), default="csv")
+    run.add_argument("--compact", action="store_true", help="load tables with compact dtypes")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--repeat", type=int, default=3, help="timed passes (the median is reported)")
+    run.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    run.add_argument("--workdir", help="keep generated data and outputs here instead of a temp dir")
+    run.add_argument("--keep", action="store_true", help="do not delete the temp dir")
+    run.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+
+    compare = commands.add_parser("compare", help="compare two reports")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown per stage (0.1 = 10%%)")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        report = run_benchmark(args)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(text + "\n")
+        else:
+            print(text)
+        return 0
+
+    baseline = json.loads(Path(args.baseline).read_text())
+    current = json.loads(Path(args.current).read_text())
+    if baseline.get("config") != current.get("config"):
+        print("warning: reports were run with different configs", file=sys.stderr)
+    rows, regressions = compare_reports(baseline, current, args.threshold)
+    print(f"{'stage':<12} {'baseline s':>11} {'current s':>11} {'time':>7} {'memory':>7}")
+    for name, old, new, ratio, mem_ratio in rows:
+        mem = f"{mem_ratio:6.2f}x" if mem_ratio is not None else "      -"
+        print(f"{name:<12} {old:>11.4f} {new:>11.4f} {ratio:6.2f}x {mem}")
+    if regressions:
+        print(f"slower than {1 + args.threshold:.2f}x: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
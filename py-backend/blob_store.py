@@ -0,0 +1,179 @@
+# blob_store.py - Content-addressed upload storage shared by all sessions, with reference counts
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from state_store import StateCollection
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+logger = logging.getLogger(__name__)
+
+
+def valid_sha256(value: str) -> bool:
+    return bool(SHA256_PATTERN.match(value or ""))
+
+
+class BlobStore:
+    """Uploaded files stored once each, at <root>/<first 2 hex digits>/<sha256>.
+
+    Sessions see their files as hard links to the blobs (see link), so readers keep
+    using ordinary paths and file names. The index (a StateCollection, shared by every
+    API worker) holds each blob's size and reference count: the number of session
+    manifest entries pointing at it. Blobs nobody references are deleted by collect()
+    once they have been unreferenced for a grace period, so a client that just learned
+    a blob exists still has time to attach it by hash.
+    """
+
+    def __init__(self, root: Path, index: StateCollection, grace_seconds: float = 3600.0):
+        self.root = Path(root)
+        self.index = index
+        self.grace_seconds = grace_seconds
+        self.tmp_dir = self.root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._link_warned = False
+
+    def path(self, sha256: str) -> Path:
+        if not valid_sha256(sha256):
+            raise ValueError(f"not a SHA-256 hex digest: {sha256!r}")
+        return self.root / sha256[:2] / sha256
+
+    def exists(self, sha256: str) -> bool:
+        return valid_sha256(sha256) and sha256 in self.index and self.path(sha256).exists()
+
+    def size(self, sha256: str) -> Optional[int]:
+        entry = self.index.get(sha256)
+        return entry["bytes"] if entry else None
+
+    def temp_path(self) -> Path:
+        """A fresh path to write an upload to before its hash is known (see put)"""
+        return self.tmp_dir / uuid.uuid4().hex
+
+    def put(self, tmp_path: Path, sha256: str, size: int) -> bool:
+        """Move a fully written temp file into the store; returns False if the blob was already there.
+
+        The blob starts with no references (see acquire).
+        """
+        path = self.path(sha256)
+
+        def apply(entry):
+            now = time.time()
+            entry = entry or {"refs": 0, "created_at": now}
+            # An unreferenced blob gets a new grace period, so collect() leaves it alone
+            return {**entry, "bytes": size, "released_at": now if entry["refs"] == 0 else None}
+
+        # The index is updated first: collect() re-checks it before deleting a file
+        self.index.modify(sha256, apply)
+        existed = path.exists()
+        if existed:
+            Path(tmp_path).unlink(missing_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+        return not existed
+
+    def link(self, sha256: str, dest: Path):
+        """Make dest a hard link to the blob (a copy where the filesystem cannot link)"""
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}")
+        try:
+            os.link(self.path(sha256), tmp)
+        except OSError as e:
+            if not self._link_warned:
+                logger.warning("Cannot hard-link blobs into %s (%s); copying instead", dest.parent, e)
+                self._link_warned = True
+            shutil.copyfile(self.path(sha256), tmp)
+        os.replace(tmp, dest)
+
+    def _adjust(self, hashes: Iterable[str], delta: int):
+        for sha256 in hashes:
+            def apply(entry):
+                if entry is None:
+                    return None
+                refs = max(entry.get("refs", 0) + delta, 0)
+                return {**entry, "refs": refs, "released_at": time.time() if refs == 0 else entry.get("released_at")}
+            self.index.modify(sha256, apply)
+
+    def acquire(self, hashes: Iterable[str]):
+        """Add one reference to each blob (hashes may repeat)"""
+        self._adjust(hashes, 1)
+
+    def release(self, hashes: Iterable[str]):
+        """Drop one reference from each blob; unreferenced blobs are left to collect()"""
+        self._adjust(hashes, -1)
+
+    def collect(self, referenced: Optional[Dict[str, int]] = None, now: Optional[float] = None) -> dict:
+        """Delete blobs unreferenced for longer than the grace period; returns what was freed.
+
+        referenced (hash -> count over every session manifest) first corrects the stored
+        counts, which drift when sessions disappear without releasing (e.g. a crash).
+        Temp files older than the grace period are removed too.
+        """
+        now = now or time.time()
+        freed = {"blobs": 0, "bytes": 0, "corrected": 0}
+
+        def expired(entry) -> bool:
+            released_at = entry.get("released_at")
+            return entry.get("refs", 0) == 0 and released_at is not None and now - released_at > self.grace_seconds
+
+        for sha256, entry in self.index.items():
+            if referenced is not None and referenced.get(sha256, 0) != entry.get("refs", 0):
+                freed["corrected"] += 1
+
+                def correct(e, refs=referenced.get(sha256, 0)):
+                    if e is None:
+                        return None
+                    # A count that drops to zero here starts its grace period now
+                    released_at = None if refs else (e.get("released_at") if e.get("refs", 0) == 0 else now)
+                    return {**e, "refs": refs, "released_at": released_at}
+
+                entry = self.index.modify(sha256, correct)
+            if entry is None or not expired(entry):
+                continue
+            # Moved aside first so that a concurrent put() of the same bytes writes a new file
+            path = self.path(sha256)
+            trash = self.tmp_dir / f"{sha256}.{uuid.uuid4().hex}"
+            try:
+                os.replace(path, trash)
+            except FileNotFoundError:
+                trash = None
+            # Re-checked under the store's lock: the blob may have just been uploaded or attached again
+            kept = self.index.modify(sha256, lambda e: e if e is None or not expired(e) else None)
+            if kept is not None:
+                if trash is not None and not path.exists():
+                    os.replace(trash, path)
+                elif trash is not None:
+                    trash.unlink(missing_ok=True)
+                continue
+            if trash is not None:
+                trash.unlink(missing_ok=True)
+            freed["blobs"] += 1
+            freed["bytes"] += entry.get("bytes", 0)
+        for tmp in self.tmp_dir.iterdir():
+            try:
+                if now - tmp.stat().st_mtime > self.grace_seconds:
+                    tmp.unlink()
+            except OSError:
+                continue
+        if freed["blobs"] or freed["corrected"]:
+            logger.info("Blob store: deleted %d unreferenced blobs (%d bytes), corrected %d reference counts",
+                        freed["blobs"], freed["bytes"], freed["corrected"])
+        return freed
+
+    def stats(self) -> dict:
+        entries = self.index.values()
+        stored = sum(e.get("bytes", 0) for e in entries)
+        referenced = sum(e.get("bytes", 0) * e.get("refs", 0) for e in entries)
+        return {
+            "blobs": len(entries),
+            "stored_bytes": stored,
+            "referenced_bytes": referenced,
+            "unreferenced_blobs": sum(1 for e in entries if e.get("refs", 0) == 0),
+            "dedup_ratio": round(referenced / stored, 3) if stored else None,
+        }
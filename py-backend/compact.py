@@ -0,0 +1,91 @@
+# compact.py - Compact dtypes for in-memory tables: downcast numbers, categoricals and Arrow strings
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    # pyarrow is optional; without it text columns that are not categorical stay as they are
+    import pyarrow  # noqa: F401
+    try:
+        # NaN as the missing value, like the default "str" dtype of pandas 3
+        ARROW_STRING = pd.StringDtype("pyarrow", na_value=np.nan)
+    except TypeError:
+        ARROW_STRING = pd.StringDtype("pyarrow")
+except Exception:
+    ARROW_STRING = None
+
+
+def _integer_dtype(low, high, nullable: bool) -> str:
+    """Smallest signed integer dtype holding [low, high]"""
+    for bits in (8, 16, 32, 64):
+        info = np.iinfo(f"int{bits}")
+        if info.min <= low and high <= info.max:
+            return f"Int{bits}" if nullable else f"int{bits}"
+    return "Int64" if nullable else "int64"
+
+
+def compact_series(series: pd.Series, category_ratio: float, category_min_rows: int) -> pd.Series:
+    """The same values in the most compact dtype that represents them exactly.
+
+    Integers are downcast to the smallest width; floats that only hold whole numbers and
+    missing values become nullable integers, other floats become float32 when that is
+    lossless; text with few distinct values (at most category_ratio of the rows) becomes
+    categorical, other text Arrow-backed strings. Anything else is returned unchanged.
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype):
+        return series
+
+    if pd.api.types.is_integer_dtype(dtype):
+        if series.count() == 0:
+            return series
+        nullable = isinstance(dtype, pd.api.extensions.ExtensionDtype)
+        target = _integer_dtype(series.min(), series.max(), nullable)
+        return series.astype(target) if target != str(dtype) else series
+
+    if pd.api.types.is_float_dtype(dtype):
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        missing = np.isnan(values)
+        present = values[~missing]
+        if len(present) == 0:
+            return series
+        if (missing.any() and np.isfinite(present).all() and (present == np.floor(present)).all()
+                and np.abs(present).max() < 2 ** 53):
+            # Whole numbers stored as float only because of missing values
+            return series.astype(_integer_dtype(present.min(), present.max(), nullable=True))
+        if dtype == np.float64:
+            narrowed = values.astype(np.float32)
+            if np.array_equal(narrowed.astype(np.float64), values, equal_nan=True):
+                return series.astype(np.float32)
+        return series
+
+    is_text = pd.api.types.is_string_dtype(dtype) and (
+        dtype != object or pd.api.types.infer_dtype(series, skipna=True) in ("string", "empty"))
+    if not is_text:
+        return series
+    if len(series) >= category_min_rows and series.nunique(dropna=True) <= len(series) * category_ratio:
+        return series.astype("category")
+    if ARROW_STRING is not None and dtype != ARROW_STRING:
+        return series.astype(ARROW_STRING)
+    return series
+
+
+def compact_frame(df: pd.DataFrame, category_ratio: float = 0.5, category_min_rows: int = 100) -> Tuple[pd.DataFrame, dict]:
+    """Compact every column (see compact_series); returns (frame, memory report).
+
+    The report has the deep memory footprint before and after, and the dtype change of
+    every column that was converted.
+    """
+    before = int(df.memory_usage(index=True, deep=True).sum())
+    columns = {}
+    changed = {}
+    for col in df.columns:
+        series = df[col]
+        compacted = compact_series(series, category_ratio, category_min_rows)
+        columns[col] = compacted
+        if compacted.dtype != series.dtype:
+            changed[str(col)] = f"{series.dtype} -> {compacted.dtype}"
+    result = pd.DataFrame(columns, index=df.index) if changed else df
+    after = int(result.memory_usage(index=True, deep=True).sum())
+    return result, {"bytes_before": before, "bytes_after": after, "dtypes": changed}
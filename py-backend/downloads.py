@@ -0,0 +1,95 @@
+# downloads.py - Conditional (ETag) and byte-range responses for generated download bodies
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Iterator, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+
+# Outputs change when a session is merged again, so clients must revalidate
+CACHE_CONTROL = "private, no-cache"
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """First-to-last byte (inclusive) of a single "bytes=" range, or None to send everything.
+
+    Multi-range requests are answered with the whole body, which RFC 9110 allows.
+    """
+    if not header or not header.strip().lower().startswith("bytes=") or "," in header:
+        return None
+    spec = header.split("=", 1)[1].strip()
+    first, _, last = spec.partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def not_modified(request: Request, etag: str, last_modified: Optional[float] = None) -> bool:
+    """If-None-Match (or, without it, If-Modified-Since) says the client's copy is current"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def ranged_response(request: Request, size: int, etag: str, iter_range: Callable[[int, int], Iterator[bytes]],
+                    filename: str, media_type: str = "application/octet-stream",
+                    last_modified: Optional[float] = None) -> Response:
+    """200, 206, 304 or 416 for a body of known size produced by iter_range(start, end).
+
+    Range is honoured unless If-Range names a different version, so resumed downloads
+    never splice bytes from two versions of a file.
+    """
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": CACHE_CONTROL,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range.strip() in (etag, headers.get("Last-Modified")):
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return PlainTextResponse("Requested range not satisfiable", status_code=416,
+                                     headers={"Content-Range": f"bytes */{size}", "ETag": etag})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_range(0, size - 1), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_range(start, end), status_code=206, media_type=media_type, headers=headers)
@@ -0,0 +1,155 @@
+# ingest.py - Table ingest: one parse per file, files parsed concurrently, every workbook sheet a table
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import pandas as pd
+
+try:
+    # python-calamine is optional; it is a Rust-backed reader that pandas uses for
+    # engine="calamine" and is several times faster than openpyxl
+    import python_calamine  # noqa: F401
+    CALAMINE_AVAILABLE = True
+except Exception:
+    CALAMINE_AVAILABLE = False
+
+TABLE_EXTENSIONS = ('.csv', '.xls', '.xlsx')
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+
+logger = logging.getLogger(__name__)
+
+
+class TableSource(NamedTuple):
+    """Where a table lives: a CSV file, or one sheet of a workbook"""
+    path: str
+    sheet: Optional[str] = None
+
+    @property
+    def is_csv(self) -> bool:
+        return self.path.lower().endswith('.csv')
+
+
+def as_source(source: Union[str, TableSource]) -> TableSource:
+    return source if isinstance(source, TableSource) else TableSource(source)
+
+
+def excel_engine(path: str, preferred: str = "auto") -> Optional[str]:
+    """pandas engine for a workbook: calamine when available (or asked for), else pandas' choice"""
+    if preferred in ("auto", "calamine"):
+        return "calamine" if CALAMINE_AVAILABLE else None
+    if preferred == "openpyxl" and not path.lower().endswith('.xlsx'):
+        return None
+    return preferred or None
+
+
+def workbook_sheets(path: str, engine: str = "auto") -> List[str]:
+    with pd.ExcelFile(path, engine=excel_engine(path, engine)) as workbook:
+        return [str(name) for name in workbook.sheet_names]
+
+
+def table_sources(file_paths: List[str], sheets: Callable[[str], List[str]] = workbook_sheets) -> Dict[str, TableSource]:
+    """Table name -> source, for loadable files.
+
+    A CSV file or a single-sheet workbook is one table named after the file (without
+    extension); each sheet of a larger workbook is a table named "<file>.<sheet>".
+    sheets(path) lists a workbook's sheets (callers may cache it).
+    """
+    tables = {}
+    for file_path in file_paths:
+        filename = Path(file_path).name
+        if not filename.lower().endswith(TABLE_EXTENSIONS):
+            continue
+        stem = filename.rsplit('.', 1)[0]
+        if filename.lower().endswith('.csv'):
+            tables[stem] = TableSource(file_path)
+            continue
+        try:
+            names = sheets(file_path)
+        except Exception as e:
+            logger.error("Error reading the sheets of %s: %s", filename, e)
+            continue
+        for sheet in names:
+            tables[stem if len(names) == 1 else f"{stem}.{sheet}"] = TableSource(file_path, sheet)
+    return tables
+
+
+def read_sheet(source: TableSource, engine: str = "auto") -> pd.DataFrame:
+    return pd.read_excel(source.path, sheet_name=source.sheet or 0, engine=excel_engine(source.path, engine))
+
+
+def read_head(source: TableSource, rows: int, engine: str = "auto") -> pd.DataFrame:
+    """The first rows of a table; readers stop after them instead of parsing the whole file"""
+    if source.is_csv:
+        return pd.read_csv(source.path, nrows=rows)
+    return pd.read_excel(source.path, sheet_name=source.sheet or 0, nrows=rows, engine=excel_engine(source.path, engine))
+
+
+def parse_file(path: str, sheets: Optional[List[str]] = None, engine: str = "auto") -> Tuple[Dict[Optional[str], pd.DataFrame], dict]:
+    """Parse a file once: a CSV (keyed None) or the given sheets of a workbook (all if None).
+
+    Returns ({sheet: frame}, stats) with the parse time and throughput. A workbook the
+    fast engine cannot read is parsed again with pandas' default engine.
+    """
+    started = time.perf_counter()
+    if path.lower().endswith('.csv'):
+        frames = {None: pd.read_csv(path)}
+        used = "pandas"
+    else:
+        used = excel_engine(path, engine)
+        try:
+            frames = pd.read_excel(path, sheet_name=sheets, engine=used)
+        except Exception as e:
+            if used is None:
+                raise
+            logger.warning("%s engine failed on %s (%s); using pandas' default engine", used, Path(path).name, e)
+            used = None
+            frames = pd.read_excel(path, sheet_name=sheets)
+        frames = {str(name): df for name, df in frames.items()}
+        used = used or "pandas"
+    seconds = time.perf_counter() - started
+    size = os.path.getsize(path)
+    return frames, {
+        "file": Path(path).name,
+        "engine": used,
+        "bytes": size,
+        "tables": len(frames),
+        "rows": sum(len(df) for df in frames.values()),
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(size / 1024 ** 2 / seconds, 2) if seconds > 0 else None,
+    }
+
+
+def parse_files(jobs: Dict[str, Optional[List[str]]], engine: str = "auto", workers: int = 0,
+                executor: str = "process", process_min_bytes: int = 0) -> Dict[str, Union[tuple, Exception]]:
+    """Run parse_file for every path -> sheets item, concurrently; failures are returned, not raised.
+
+    Parsing holds the GIL, so files are spread over worker processes. Small batches (under
+    process_min_bytes) use threads, as does a daemonic process (merge jobs run in one),
+    which cannot have children.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    results = {}
+    if workers <= 1:
+        for path, sheets in jobs.items():
+            try:
+                results[path] = parse_file(path, sheets, engine)
+            except Exception as e:
+                results[path] = e
+        return results
+
+    use_processes = (executor == "process" and not multiprocessing.current_process().daemon
+                     and sum(os.path.getsize(p) for p in jobs) >= process_min_bytes)
+    pool = (ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) if use_processes
+            else ThreadPoolExecutor(workers, thread_name_prefix="ingest"))
+    with pool:
+        futures = {path: pool.submit(parse_file, path, sheets, engine) for path, sheets in jobs.items()}
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                results[path] = e
+    return results
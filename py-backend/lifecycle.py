@@ -0,0 +1,224 @@
+# lifecycle.py - TTL eviction and disk quotas for sessions, jobs, uploads and outputs
+import logging
+import shutil
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from state_store import StateCollection
+
+FINISHED_STATUSES = ("success", "failed", "cancelled")
+
+logger = logging.getLogger(__name__)
+
+
+def dir_bytes(path: Path, seen: Optional[set] = None) -> int:
+    """Total size of the files under path (0 if it does not exist).
+
+    With seen, a file already counted under another name (hard links to the same blob)
+    is counted once; seen collects (device, inode) pairs across calls.
+    """
+    total = 0
+    if path.exists():
+        for p in path.rglob("*"):
+            try:
+                if p.is_file():
+                    st = p.stat()
+                    if seen is not None:
+                        if (st.st_dev, st.st_ino) in seen:
+                            continue
+                        seen.add((st.st_dev, st.st_ino))
+                    total += st.st_size
+            except OSError:
+                # Removed while we were walking
+                continue
+    return total
+
+
+class LifecycleManager:
+    """Evicts idle sessions, finished jobs and their files from the state store and disk.
+
+    A session is idle once its "last_access" is older than session_ttl; finished jobs are
+    dropped job_ttl after they finish. Sessions over session_quota_bytes (uploads plus
+    outputs) are evicted, and while total usage exceeds total_quota_bytes the least
+    recently used sessions go first. Sessions with a queued or running job are never
+    touched. Upload/output directories of sessions missing from the store (e.g. left
+    by a crashed process) are removed once their mtime is older than session_ttl.
+
+    With a blob_store, upload files are links to shared blobs: an evicted session
+    releases its references, every sweep recounts the references of all sessions and
+    collects unreferenced blobs, and total usage counts each blob once.
+    """
+
+    def __init__(self, sessions: StateCollection, jobs: StateCollection, upload_dir: Path, output_dir: Path,
+                 session_ttl: float, job_ttl: float, session_quota_bytes: int = 0, total_quota_bytes: int = 0,
+                 sweep_interval: float = 300.0, blob_store=None):
+        self.sessions = sessions
+        self.jobs = jobs
+        self.upload_dir = Path(upload_dir)
+        self.output_dir = Path(output_dir)
+        self.session_ttl = session_ttl
+        self.job_ttl = job_ttl
+        self.session_quota_bytes = session_quota_bytes
+        self.total_quota_bytes = total_quota_bytes
+        self.sweep_interval = sweep_interval
+        self.blob_store = blob_store
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sweep = None
+        self.evicted = {"sessions": 0, "jobs": 0, "orphan_dirs": 0, "bytes": 0, "blobs": 0}
+
+    def touch(self, session_id: str) -> Optional[dict]:
+        """Mark a session as used; returns it, or None if it does not exist"""
+        return self.sessions.patch(session_id, {"last_access": time.time()}, create=False)
+
+    def start(self):
+        if self._thread is None and self.sweep_interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="lifecycle-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Lifecycle sweep failed")
+
+    def busy_sessions(self) -> set:
+        """Sessions with a queued or running job"""
+        return {job.get("session_id") for job in self.jobs.values() if job.get("status") not in FINISHED_STATUSES}
+
+    def session_bytes(self, session_id: str) -> int:
+        return dir_bytes(self.upload_dir / session_id) + dir_bytes(self.output_dir / session_id)
+
+    def evict_session(self, session_id: str) -> int:
+        """Drop a session, its finished jobs and its files; returns the bytes freed."""
+        freed = self.session_bytes(session_id)
+        session = self.sessions.pop(session_id, None)
+        if self.blob_store is not None and session:
+            self.blob_store.release(h for files in session.get("files", {}).values() for h in files.values())
+        for job_id, job in self.jobs.items():
+            if job.get("session_id") == session_id and job.get("status") in FINISHED_STATUSES:
+                self.jobs.pop(job_id, None)
+                self.evicted["jobs"] += 1
+        shutil.rmtree(self.upload_dir / session_id, ignore_errors=True)
+        shutil.rmtree(self.output_dir / session_id, ignore_errors=True)
+        self.evicted["sessions"] += 1
+        self.evicted["bytes"] += freed
+        return freed
+
+    def sweep(self, now: Optional[float] = None) -> dict:
+        """Run one eviction pass; returns what was removed."""
+        now = now or time.time()
+        before = dict(self.evicted)
+        evicted_sessions = []
+        with self._lock:
+            # Finished jobs past their TTL
+            for job_id, job in self.jobs.items():
+                finished_at = job.get("finished_at")
+                if job.get("status") in FINISHED_STATUSES and finished_at and now - finished_at > self.job_ttl:
+                    self.jobs.pop(job_id, None)
+                    self.evicted["jobs"] += 1
+
+            def evict(session_id):
+                self.evict_session(session_id)
+                evicted_sessions.append(session_id)
+
+            # Idle sessions, then sessions over their own quota
+            usage = {}
+            busy = self.busy_sessions()
+            for session_id, session in self.sessions.items():
+                if session_id in busy:
+                    continue
+                last_access = session.get("last_access") or session.get("created_at") or now
+                if now - last_access > self.session_ttl:
+                    evict(session_id)
+                    continue
+                usage[session_id] = self.session_bytes(session_id)
+                if self.session_quota_bytes and usage[session_id] > self.session_quota_bytes:
+                    evict(session_id)
+                    del usage[session_id]
+
+            # Leftovers of sessions that are no longer in the store
+            known = set(self.sessions.keys())
+            for root in (self.upload_dir, self.output_dir):
+                if not root.exists():
+                    continue
+                for path in root.iterdir():
+                    if not path.is_dir() or path.name in known:
+                        continue
+                    if now - path.stat().st_mtime > self.session_ttl:
+                        freed = dir_bytes(path)
+                        shutil.rmtree(path, ignore_errors=True)
+                        self.evicted["orphan_dirs"] += 1
+                        self.evicted["bytes"] += freed
+
+            # Blobs no remaining session references
+            if self.blob_store is not None:
+                referenced = Counter(h for session in self.sessions.values()
+                                     for files in session.get("files", {}).values() for h in files.values())
+                freed = self.blob_store.collect(referenced, now)
+                self.evicted["blobs"] += freed["blobs"]
+                self.evicted["bytes"] += freed["bytes"]
+
+            # Global quota: least recently used idle sessions first (their blobs are only
+            # freed by a later sweep, after the grace period)
+            if self.total_quota_bytes:
+                total = self.upload_bytes() + dir_bytes(self.output_dir)
+                last_access = {s: (v.get("last_access") or 0) for s, v in self.sessions.items()}
+                busy = self.busy_sessions()
+                for session_id in sorted(usage, key=lambda s: last_access.get(s, 0)):
+                    if total <= self.total_quota_bytes:
+                        break
+                    if session_id in busy:
+                        continue
+                    total -= usage[session_id]
+                    evict(session_id)
+
+            self.last_sweep = now
+        removed = {key: self.evicted[key] - before[key] for key in self.evicted}
+        removed["sessions"] = evicted_sessions
+        if evicted_sessions or removed["jobs"] or removed["orphan_dirs"]:
+            logger.info("Evicted %d sessions, %d jobs, %d orphan dirs (%d bytes)",
+                        len(evicted_sessions), removed["jobs"], removed["orphan_dirs"], removed["bytes"])
+        return removed
+
+    def upload_bytes(self) -> int:
+        """Disk used by uploads, each blob counted once however many sessions link to it"""
+        if self.blob_store is None:
+            return dir_bytes(self.upload_dir)
+        seen = set()
+        return dir_bytes(self.upload_dir, seen) + dir_bytes(self.blob_store.root, seen)
+
+    def stats(self) -> dict:
+        upload_bytes = self.upload_bytes()
+        output_bytes = dir_bytes(self.output_dir)
+        statuses = {}
+        for job in self.jobs.values():
+            status = job.get("status")
+            statuses[status] = statuses.get(status, 0) + 1
+        return {
+            "sessions": len(self.sessions),
+            "jobs": len(self.jobs),
+            "jobs_by_status": statuses,
+            "upload_bytes": upload_bytes,
+            "output_bytes": output_bytes,
+            "total_bytes": upload_bytes + output_bytes,
+            "session_ttl_seconds": self.session_ttl,
+            "job_ttl_seconds": self.job_ttl,
+            "session_quota_bytes": self.session_quota_bytes,
+            "total_quota_bytes": self.total_quota_bytes,
+            "last_sweep": self.last_sweep,
+            "evicted": dict(self.evicted),
+            **({"blob_store": self.blob_store.stats()} if self.blob_store is not None else {}),
+        }
@@ -0,0 +1,231 @@
+# llm_client.py - Async model clients with deadlines, retries and JSON repair
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from prompt_planner import estimate_tokens
+from telemetry import record
+
+try:
+    # google-generativeai is only needed for the "gemini" backend
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
+    GENAI_AVAILABLE = True
+except Exception:
+    GENAI_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """A model call failed permanently."""
+
+
+class TransientLLMError(LLMError):
+    """A model call failed in a way that is worth retrying (timeouts, 429/5xx)."""
+
+
+class MappingParseError(LLMError):
+    """The model reply could not be turned into a mappings document."""
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ModelClient:
+    """Interface: async generate(prompt) -> reply text."""
+
+    name = "base"
+
+    async def generate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+
+class GeminiClient(ModelClient):
+    name = "gemini"
+
+    def __init__(self, api_key: str, model_name: str, timeout: float):
+        if not GENAI_AVAILABLE:
+            raise LLMError("google-generativeai is not installed; use llm_backend=stub for offline runs")
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+        self.timeout = timeout
+
+    async def generate(self, prompt: str) -> str:
+        try:
+            response = await self.model.generate_content_async(
+                prompt,
+                generation_config={"response_mime_type": "application/json"},
+                request_options={"timeout": self.timeout},
+            )
+        except (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted,
+                google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                google_exceptions.DeadlineExceeded) as e:
+            raise TransientLLMError(str(e)) from e
+        except google_exceptions.GoogleAPICallError as e:
+            raise LLMError(str(e)) from e
+        try:
+            return response.text
+        except ValueError as e:
+            # Empty or blocked candidate; a second sample usually succeeds
+            raise TransientLLMError(f"empty model response: {e}") from e
+
+
+class StubClient(ModelClient):
+    """Offline backend: replays recorded replies by prompt hash, else asks a responder.
+
+    Without a responder, unrecorded prompts get an empty mappings document so a merge
+    still completes (with the local pre-matcher's mappings only).
+    """
+
+    name = "stub"
+
+    def __init__(self, recordings_dir: Optional[Path] = None, responder: Optional[Callable[[str], str]] = None):
+        self.recordings_dir = Path(recordings_dir) if recordings_dir else None
+        self.responder = responder
+        self.calls = 0
+
+    async def generate(self, prompt: str) -> str:
+        self.calls += 1
+        if self.recordings_dir:
+            recorded = self.recordings_dir / f"{prompt_key(prompt)}.txt"
+            if recorded.exists():
+                return recorded.read_text(encoding="utf-8")
+        if self.responder:
+            return self.responder(prompt)
+        return json.dumps({"table_mappings": [], "summary": "offline stub: no recorded response"})
+
+
+class RecordingClient(ModelClient):
+    """Wraps another client and stores every reply for later replay by StubClient."""
+
+    def __init__(self, inner: ModelClient, recordings_dir: Path):
+        self.inner = inner
+        self.name = inner.name
+        self.recordings_dir = Path(recordings_dir)
+        self.recordings_dir.mkdir(parents=True, exist_ok=True)
+
+    async def generate(self, prompt: str) -> str:
+        text = await self.inner.generate(prompt)
+        (self.recordings_dir / f"{prompt_key(prompt)}.txt").write_text(text, encoding="utf-8")
+        return text
+
+
+async def generate_with_retries(client: ModelClient, prompt: str, timeout: float, attempts: int, base_delay: float) -> str:
+    """Call the model under a per-attempt deadline, retrying transient failures.
+
+    Backoff is exponential with full jitter so concurrent shards do not retry in lockstep.
+    """
+    for attempt in range(1, attempts + 1):
+        started = time.perf_counter()
+        try:
+            text = await asyncio.wait_for(client.generate(prompt), timeout)
+        except (asyncio.TimeoutError, TransientLLMError, ConnectionError) as e:
+            record("datamerge_llm_request_seconds", time.perf_counter() - started, backend=client.name, outcome="retryable_error")
+            logger.warning("Model call attempt %d/%d failed: %s", attempt, attempts, e or type(e).__name__)
+            if attempt == attempts:
+                raise LLMError(f"model call failed after {attempts} attempts: {e or type(e).__name__}") from e
+            await asyncio.sleep(random.uniform(0, base_delay * 2 ** (attempt - 1)))
+            continue
+        except Exception:
+            record("datamerge_llm_request_seconds", time.perf_counter() - started, backend=client.name, outcome="error")
+            raise
+        record("datamerge_llm_request_seconds", time.perf_counter() - started, backend=client.name, outcome="ok")
+        record("datamerge_llm_tokens_total", estimate_tokens(prompt), backend=client.name, direction="prompt")
+        record("datamerge_llm_tokens_total", estimate_tokens(text), backend=client.name, direction="completion")
+        return text
+
+
+def _repair_json(text: str) -> str:
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    text = re.sub(r"\bTrue\b", "true", text)
+    text = re.sub(r"\bFalse\b", "false", text)
+    text = re.sub(r"\bNone\b", "null", text)
+    return text.replace("“", '"').replace("”", '"')
+
+
+def extract_json(text: str) -> dict:
+    """Pull the first JSON object out of a model reply, repairing common slips."""
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.S)
+    if fenced:
+        text = fenced.group(1)
+    text = text.strip()
+    try:
+        obj = json.loads(text)
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"\{", text):
+        try:
+            obj, _ = decoder.raw_decode(text, match.start())
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            continue
+
+    start, end = text.find("{"), text.rfind("}") + 1
+    if start >= 0 and end > start:
+        try:
+            return json.loads(_repair_json(text[start:end]))
+        except ValueError as e:
+            raise MappingParseError(f"invalid JSON: {e}") from e
+    raise MappingParseError("no JSON object in model reply")
+
+
+def validate_mappings(obj: dict) -> dict:
+    """Keep only well-formed table and field mappings; fail if there is no mapping list."""
+    table_mappings = obj.get("table_mappings")
+    if not isinstance(table_mappings, list):
+        raise MappingParseError("reply has no 'table_mappings' list")
+    clean = []
+    for tm in table_mappings:
+        if not isinstance(tm, dict) or not tm.get("source_table") or not tm.get("target_table"):
+            continue
+        fields = [
+            fm for fm in tm.get("field_mappings") or []
+            if isinstance(fm, dict) and fm.get("source_field") and fm.get("target_field")
+        ]
+        clean.append({**tm, "field_mappings": fields})
+    return {**obj, "table_mappings": clean, "summary": str(obj.get("summary") or "")}
+
+
+REPAIR_PROMPT = """Your previous reply could not be parsed ({error}).
+Return ONLY the corrected JSON object with a "table_mappings" list and a "summary" string, nothing else.
+
+PREVIOUS REPLY:
+{reply}
+"""
+
+
+async def request_mappings(client: ModelClient, prompt: str, timeout: float, attempts: int, base_delay: float) -> dict:
+    """Ask for a mappings document; on an unparseable reply, re-ask once with just the reply."""
+    text = await generate_with_retries(client, prompt, timeout, attempts, base_delay)
+    try:
+        return validate_mappings(extract_json(text))
+    except MappingParseError as e:
+        repair = REPAIR_PROMPT.format(error=e, reply=text[:20000])
+        text = await generate_with_retries(client, repair, timeout, attempts, base_delay)
+        return validate_mappings(extract_json(text))
+
+
+def create_client(backend: str, api_key: str, model_name: str, timeout: float,
+                  recordings_dir: Optional[str] = None, record: bool = False) -> ModelClient:
+    """Build the configured backend: "gemini" (optionally recording) or "stub" (offline)."""
+    if backend == "stub":
+        return StubClient(recordings_dir)
+    if backend != "gemini":
+        raise ValueError(f"unknown llm_backend '{backend}'")
+    client = GeminiClient(api_key, model_name, timeout)
+    if record and recordings_dir:
+        return RecordingClient(client, Path(recordings_dir))
+    return client
@@ -1,39 +1,129 @@
 # main.py - FastAPI Backend with .env support
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Query, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, PlainTextResponse, Response
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
-import google.generativeai as genai
 import pandas as pd
 import json
 import os
 import shutil
 import zipfile
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pathlib import Path
 import uuid
 import io
+import time
+import hashlib
+import asyncio
+import socket
+import logging
+import cProfile
+import pstats
+from starlette.concurrency import run_in_threadpool
+from parse_cache import TableCache, file_sha256
+from mapping_cache import MappingCache, schema_fingerprint
+from profiler import profile_table, reservoir_sample
+from compact import compact_frame
+from ingest import EXCEL_EXTENSIONS, TableSource, parse_file, parse_files, read_head, table_sources, workbook_sheets
+from matcher import prematch, remaining_schema, combine_mappings
+from prompt_planner import plan_shards, run_concurrently
+from llm_client import create_client, request_mappings
+from merge_engine import MERGE_STRATEGIES, apply_mappings, group_by_target, sample_table, stream_merge, target_schemas, write_frame
+from archive import ArchiveWriter, ZipSelection, iter_member_range
+from downloads import CACHE_CONTROL, file_etag, not_modified, ranged_response
+from scheduler import JobScheduler, QueueFull
+from lifecycle import LifecycleManager
+from progress import StageTracker, sse_event
+from mapping_pdf import REPORTLAB_AVAILABLE, ensure_mapping_pdf
+from merge_graph import MergeGraph, digest, load_manifest
+from blob_store import BlobStore, valid_sha256
+from transforms import validate_transforms
+from telemetry import configure_logging, log_context, metric_sink, record, apply_observation, registry, QUEUE_DEPTH, JOBS_RUNNING
+from state_store import StateCollection, create_state_backend
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    # reportlab is optional; if missing, the endpoint will return JSON error asking to install it
-    from reportlab.lib.pagesizes import letter
-    from reportlab.pdfgen import canvas
-    REPORTLAB_AVAILABLE = True
-except Exception:
-    REPORTLAB_AVAILABLE = False
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Configuration using Pydantic Settings
 class Settings(BaseSettings):
-    gemini_api_key: str
+    gemini_api_key: str = ""
     gemini_model: str = "gemini-flash-latest"
     host: str = "0.0.0.0"
     port: int = 8000
     debug: bool = False
     cors_origins: str = "http://localhost:3000,http://localhost:5173"
+    # Upload streaming and limits (bytes)
+    upload_chunk_size: int = 1024 * 1024
+    max_upload_file_bytes: int = 5 * 1024 ** 3
+    max_session_upload_bytes: int = 20 * 1024 ** 3
+    # Parsed-table cache (Arrow IPC keyed by content hash); 0 disables it
+    parse_cache_max_bytes: int = 10 * 1024 ** 3
+    # Mapping cache keyed by schema fingerprint
+    mapping_cache_ttl_seconds: int = 7 * 24 * 3600
+    mapping_cache_max_entries: int = 1000
+    # Column profiling: rows sampled per table and top values kept per column
+    profile_sample_rows: int = 100_000
+    profile_top_k: int = 5
+    profile_full_scan_rows: int = 20_000_000
+    # In-memory merges: load tables with compact dtypes (downcast numbers, categoricals
+    # for text with at most compact_category_ratio distinct values per row, Arrow strings)
+    compact_dtypes: bool = False
+    compact_category_ratio: float = 0.5
+    # Files are parsed concurrently (0 = one worker per CPU), in worker processes unless
+    # a batch is smaller than ingest_process_min_bytes (then threads)
+    ingest_workers: int = 0
+    ingest_executor: str = "process"
+    ingest_process_min_bytes: int = 64 * 1024 * 1024
+    # Local pre-matcher: field pairs scoring above the threshold skip the LLM
+    prematch_enabled: bool = True
+    prematch_threshold: float = 0.9
+    prematch_min_coverage: float = 0.5
+    # Mapping prompts: per-request token budget, parallel requests and rate limit
+    llm_prompt_token_budget: int = 30000
+    llm_concurrency: int = 4
+    llm_requests_per_minute: int = 60
+    # Model client: "gemini" or "stub" (offline, replays llm_recordings_dir)
+    llm_backend: str = "gemini"
+    llm_timeout_seconds: float = 120.0
+    llm_max_attempts: int = 4
+    llm_retry_base_delay: float = 1.0
+    llm_recordings_dir: Optional[str] = None
+    llm_record: bool = False
+    # Preview merges: rows read from each table by default and at most
+    preview_rows: int = 1000
+    preview_max_rows: int = 100_000
+    # Streaming merge mode: rows per chunk read from each source table
+    stream_chunk_rows: int = 200_000
+    # Merged output: "csv" (deflated in the zip) or "parquet" (zstd, stored in the zip)
+    output_format: str = "csv"
+    output_compression_level: int = 6
+    output_workers: int = 4
+    # Merge jobs: worker pool ("process" or "thread"), queue bound and process start method
+    job_workers: int = 2
+    job_queue_size: int = 32
+    job_executor: str = "process"
+    job_start_method: str = "spawn"
+    # Lifecycle: idle sessions and finished jobs expire, disk quotas (0 = unlimited)
+    session_ttl_seconds: int = 24 * 3600
+    job_ttl_seconds: int = 24 * 3600
+    max_session_disk_bytes: int = 40 * 1024 ** 3
+    max_total_disk_bytes: int = 0
+    lifecycle_sweep_seconds: int = 300
+    # Upload blobs no session references are deleted after this grace period
+    blob_gc_grace_seconds: int = 3600
+    # Session/job state shared by all API workers: sqlite:///path or redis://host:port/db
+    state_backend_url: str = "sqlite:///cache/state.sqlite3"
+    # Job event stream: how often the state store is checked, keep-alive interval
+    progress_poll_seconds: float = 0.25
+    progress_keepalive_seconds: float = 15.0
+    # Logging: level and "text" or "json" lines
+    log_level: str = "INFO"
+    log_format: str = "text"
     
     class Config:
         env_file = ".env"
@@ -42,12 +132,26 @@ class Settings(BaseSettings):
 # Load settings
 settings = Settings()
 
+# Structured logs, tagged with job_id/session_id inside merge jobs
+configure_logging(settings.log_level, settings.log_format)
+logger = logging.getLogger("datamerge")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The sweeper only runs in the API process, never in merge workers
+    recover_orphaned_jobs()
+    lifecycle.start()
+    yield
+    lifecycle.stop()
+
+
 # Initialize FastAPI
 app = FastAPI(
     title="EY Data Integration API",
     description="AI-powered data integration using Gemini API",
     version="1.0.0",
-    debug=settings.debug
+    debug=settings.debug,
+    lifespan=lifespan
 )
 
 # Enable CORS
@@ -60,29 +164,99 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure Gemini
-genai.configure(api_key=settings.gemini_api_key)
-model = genai.GenerativeModel(settings.gemini_model)
+# Configure the mapping model client (Gemini, or an offline stub for build machines)
+llm_client = create_client(
+    settings.llm_backend,
+    settings.gemini_api_key,
+    settings.gemini_model,
+    settings.llm_timeout_seconds,
+    recordings_dir=settings.llm_recordings_dir,
+    record=settings.llm_record
+)
 
 # Storage directories
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("outputs")
+CACHE_DIR = Path("cache")
+BLOB_DIR = Path("blobs")
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-# Session storage (in production, use Redis or database)
-sessions = {}
+# Parsed tables shared across sessions, keyed by upload content hash
+table_cache = TableCache(CACHE_DIR / "tables", settings.parse_cache_max_bytes)
+# Gemini mapping results, reused when the same bundle layouts come in again
+mapping_cache = MappingCache(CACHE_DIR / "mappings.sqlite3", settings.mapping_cache_ttl_seconds, settings.mapping_cache_max_entries)
+
+# Session and job storage, shared by every API worker and kept across restarts
+state_backend = create_state_backend(settings.state_backend_url)
+sessions = StateCollection(state_backend, "sessions")
 # Job storage for background merges
-jobs = {}
+jobs = StateCollection(state_backend, "jobs")
+# Uploaded file contents, stored once however many sessions upload them
+blob_store = BlobStore(BLOB_DIR, StateCollection(state_backend, "blobs"), settings.blob_gc_grace_seconds)
+# Progress events kept per job for the event stream (oldest are dropped first)
+MAX_JOB_EVENTS = 500
+# Identifies the API process that owns (runs) a job
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
 
 # Job structure example:
 # jobs[job_id] = {
-#   "status": "queued" | "running" | "success" | "failed",
+#   "status": "queued" | "running" | "success" | "failed" | "cancelled",
 #   "session_id": session_id,
+#   "stage": "load" | "profile" | "mapping" | "apply" | "write" | "zip" | "pdf",
+#   "events": [{"seq": n, "stage": ..., "state": ..., "elapsed": ...}, ...], "stage_seconds": {...},
+#   "mode": "memory" | "streaming", "merge_strategy": "append" | "upsert" | "skip_existing",
+#   "owner": "host:pid", "cancel_requested": bool,
+#   "queued_at": ..., "started_at": ..., "finished_at": ..., "wait_seconds": ...,
 #   "result": {...},
 #   "error": "..."
 # }
 
+# Evicts idle sessions, old jobs and their files, and enforces disk quotas
+lifecycle = LifecycleManager(
+    sessions,
+    jobs,
+    UPLOAD_DIR,
+    OUTPUT_DIR,
+    session_ttl=settings.session_ttl_seconds,
+    job_ttl=settings.job_ttl_seconds,
+    session_quota_bytes=settings.max_session_disk_bytes,
+    total_quota_bytes=settings.max_total_disk_bytes,
+    sweep_interval=settings.lifecycle_sweep_seconds,
+    blob_store=blob_store
+)
+
+
+def require_session(session_id: str) -> dict:
+    """Return the session (marking it as recently used) or raise 404"""
+    session = lifecycle.touch(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+
+def recover_orphaned_jobs():
+    """Fail unfinished jobs whose owning API process on this host no longer exists"""
+    host = socket.gethostname()
+    for job_id, job in jobs.items():
+        if job.get("status") not in ("queued", "running"):
+            continue
+        owner_host, _, pid = str(job.get("owner", "")).rpartition(":")
+        if owner_host != host or not pid.isdigit() or pid_alive(int(pid)):
+            continue
+        jobs.patch(job_id, {"status": "failed", "error": "Server restarted before the job finished", "finished_at": time.time()})
+        logger.warning("Job %s was orphaned by a restart; marked failed", job_id)
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 @app.get("/")
 async def root():
@@ -91,184 +265,502 @@ async def root():
         "status": "healthy",
         "service": "EY Data Integration API",
         "version": "1.0.0",
-        "model": settings.gemini_model
+        "model": settings.gemini_model,
+        "llm_backend": llm_client.name
     }
 
 
-@app.post("/api/upload-bundle1")
-async def upload_bundle1(files: List[UploadFile] = File(...)):
-    """Upload multiple files for Bundle 1"""
-    session_id = str(uuid.uuid4())
-    session_dir = UPLOAD_DIR / session_id / "bundle1"
+def upload_filename(name: str) -> str:
+    filename = Path(name or "").name
+    if filename in ("", ".", ".."):
+        raise HTTPException(status_code=400, detail=f"Invalid file name '{name}'")
+    return filename
+
+
+def unique_filename(filename: str, sha256: str, taken: Dict[str, str]) -> Optional[str]:
+    """Name for a file within one upload: None for a repeat of the same content, and a
+    numbered name (orders_2.csv) when different content arrives under a name already taken"""
+    stem, dot, extension = filename.rpartition(".")
+    if not dot:
+        stem, extension = filename, ""
+    candidate, n = filename, 1
+    while candidate in taken:
+        if taken[candidate] == sha256:
+            return None
+        n += 1
+        candidate = f"{stem}_{n}{dot}{extension}"
+    taken[candidate] = sha256
+    return candidate
+
+
+def other_upload_bytes(session_id: str, kind: str, replace: bool) -> int:
+    """Bytes already held by the session's other upload kinds (re-uploading a kind replaces it)"""
+    session = sessions.get(session_id, {})
+    return sum(b for k, b in session.get("upload_bytes", {}).items() if k != kind or not replace)
+
+
+async def save_uploads(files: List[UploadFile], session_id: str, kind: str, replace: bool = True):
+    """Stream uploaded files into the blob store and link them into uploads/<session_id>/<kind>/.
+
+    Chunks are hashed (SHA-256) as they arrive and written from a worker thread so the
+    event loop is never blocked on disk I/O. Per-file and per-session size limits are
+    enforced while streaming; a file that exceeds them is removed and a 413 is raised.
+    Content the store already holds is not kept twice (see blob_store). Files of one
+    upload that share a name but not their content are numbered instead of overwriting
+    each other. With replace=False the kind's earlier files still count towards the
+    session limit. Returns (paths, upload_stats).
+    """
+    session_dir = UPLOAD_DIR / session_id / kind
     session_dir.mkdir(parents=True, exist_ok=True)
-    
-    uploaded_files = []
+
+    other_bytes = other_upload_bytes(session_id, kind, replace)
+
+    paths = []
+    stats = []
+    taken = {}
+    kind_bytes = 0
     for file in files:
-        file_path = session_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        uploaded_files.append(str(file_path))
-    
+        filename = upload_filename(file.filename)
+        tmp_path = blob_store.temp_path()
+        digest = hashlib.sha256()
+        size = 0
+        started = time.perf_counter()
+        out = await run_in_threadpool(open, tmp_path, "wb")
+        try:
+            while True:
+                chunk = await file.read(settings.upload_chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > settings.max_upload_file_bytes:
+                    raise HTTPException(status_code=413, detail=f"{filename} exceeds the per-file limit of {settings.max_upload_file_bytes} bytes")
+                if other_bytes + kind_bytes + size > settings.max_session_upload_bytes:
+                    raise HTTPException(status_code=413, detail=f"Session upload limit of {settings.max_session_upload_bytes} bytes exceeded")
+                digest.update(chunk)
+                await run_in_threadpool(out.write, chunk)
+        except BaseException:
+            await run_in_threadpool(out.close)
+            tmp_path.unlink(missing_ok=True)
+            raise
+        await run_in_threadpool(out.close)
+        await file.close()
+
+        sha256 = digest.hexdigest()
+        stored = await run_in_threadpool(blob_store.put, tmp_path, sha256, size)
+        name = unique_filename(filename, sha256, taken)
+        if name is None:
+            logger.info("Skipping a repeat of %s in the same upload", filename)
+            continue
+        if name != filename:
+            logger.warning("Two different files named %s were uploaded; storing the second as %s", filename, name)
+        file_path = session_dir / name
+        await run_in_threadpool(blob_store.link, sha256, file_path)
+
+        elapsed = time.perf_counter() - started
+        kind_bytes += size
+        paths.append(str(file_path))
+        stats.append({
+            "filename": name,
+            "bytes": size,
+            "sha256": sha256,
+            "deduplicated": not stored,
+            "seconds": round(elapsed, 4),
+            "mb_per_s": round(size / 1024 ** 2 / elapsed, 2) if elapsed > 0 else None,
+        })
+        if name != filename:
+            stats[-1]["renamed_from"] = filename
+
+    return paths, stats
+
+
+def record_uploads(session_id: str, kind: str, paths: List[str], stats: List[dict], replace: bool = True):
+    """Attach uploaded paths, content hashes and byte counts to the session.
+
+    replace=False keeps the kind's earlier files that were not uploaded again, so a
+    single changed table can be re-uploaded (and re-merged incrementally). The
+    session's manifest (session["files"][kind]: file name -> SHA-256) holds one blob
+    reference per file; files it no longer lists are released and, unless a job of the
+    session is running, unlinked.
+    """
+    previous = {}
+
+    def apply(session):
+        session = session or {"bundle1": [], "bundle2": [], "created_at": time.time()}
+        session["last_access"] = time.time()
+        kept = [] if replace else [p for p in session.get(kind, []) if p not in paths]
+        session[kind] = kept + paths
+        session.setdefault("hashes", {}).update({p: s["sha256"] for p, s in zip(paths, stats)})
+        session.setdefault("upload_bytes", {})[kind] = sum(s["bytes"] for s in stats) + sum(
+            os.path.getsize(p) for p in kept if os.path.exists(p))
+        manifest = session.setdefault("files", {})
+        previous.clear()
+        previous.update(manifest.get(kind, {}))
+        manifest[kind] = {Path(p).name: session["hashes"][p] for p in session[kind]}
+        return session
+
+    session = sessions.modify(session_id, apply)
+    current = session["files"][kind]
+    # New references first, so blobs kept by this upload never drop to zero
+    blob_store.acquire(current.values())
+    blob_store.release(previous.values())
+    dropped = [name for name in previous if name not in current]
+    if dropped and session_id not in lifecycle.busy_sessions():
+        for name in dropped:
+            (UPLOAD_DIR / session_id / kind / name).unlink(missing_ok=True)
+    record("datamerge_upload_bytes_total", sum(s["bytes"] for s in stats), kind=kind)
+
+
+def upload_throughput(stats: List[dict]):
+    """Aggregate per-file upload stats for the API response."""
+    total_bytes = sum(s["bytes"] for s in stats)
+    total_seconds = sum(s["seconds"] for s in stats)
+    return {
+        "bytes": total_bytes,
+        "seconds": round(total_seconds, 4),
+        "mb_per_s": round(total_bytes / 1024 ** 2 / total_seconds, 2) if total_seconds > 0 else None,
+        "files": stats,
+    }
+
+
+@app.post("/api/upload-bundle1")
+async def upload_bundle1(files: List[UploadFile] = File(...), session_id: Optional[str] = None, replace: bool = True):
+    """Upload multiple files for Bundle 1.
+
+    Starts a new session unless session_id is given. replace=false keeps the Bundle 1
+    files that are not uploaded again (same-named files are overwritten).
+    """
+    if session_id:
+        require_session(session_id)
+    else:
+        session_id = str(uuid.uuid4())
+    uploaded_files, stats = await save_uploads(files, session_id, "bundle1", replace)
+
     # Initialize session
-    if session_id not in sessions:
-        sessions[session_id] = {"bundle1": [], "bundle2": []}
-    sessions[session_id]["bundle1"] = uploaded_files
+    record_uploads(session_id, "bundle1", uploaded_files, stats, replace)
     
     return {
         "status": "success",
         "session_id": session_id,
         "message": f"Uploaded {len(files)} Bundle 1 files",
-        "files": [f.filename for f in files]
+        "files": [s["filename"] for s in stats],
+        "upload": upload_throughput(stats)
     }
 
 
 @app.post("/api/upload-bundle2")
-async def upload_bundle2(session_id: str, files: List[UploadFile] = File(...)):
-    """Upload multiple files for Bundle 2"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def upload_bundle2(session_id: str, files: List[UploadFile] = File(...), replace: bool = True):
+    """Upload multiple files for Bundle 2 (replace=false keeps the files not uploaded again)"""
+    require_session(session_id)
     
-    session_dir = UPLOAD_DIR / session_id / "bundle2"
-    session_dir.mkdir(parents=True, exist_ok=True)
-    
-    uploaded_files = []
-    for file in files:
-        file_path = session_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        uploaded_files.append(str(file_path))
-    
-    sessions[session_id]["bundle2"] = uploaded_files
+    uploaded_files, stats = await save_uploads(files, session_id, "bundle2", replace)
+    record_uploads(session_id, "bundle2", uploaded_files, stats, replace)
     
     return {
         "status": "success",
         "session_id": session_id,
         "message": f"Uploaded {len(files)} Bundle 2 files",
-        "files": [f.filename for f in files]
+        "files": [s["filename"] for s in stats],
+        "upload": upload_throughput(stats)
     }
 
 
-@app.post("/api/upload-schema1")
-async def upload_schema1(session_id: str = Form(...), files: List[UploadFile] = File(...)):
-    """Upload optional schema/documentation files for Bundle 1 (Excel/CSV)."""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+UPLOAD_KINDS = ("bundle1", "bundle2", "schema1", "schema2")
 
-    session_dir = UPLOAD_DIR / session_id / "schema1"
-    session_dir.mkdir(parents=True, exist_ok=True)
 
-    uploaded_files = []
-    for file in files:
-        file_path = session_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        uploaded_files.append(str(file_path))
+class HashedFile(BaseModel):
+    filename: str
+    sha256: str
 
-    # attach schema paths to session
-    sessions[session_id]["schema1"] = uploaded_files
 
-    return {"status": "success", "session_id": session_id, "files": [f.filename for f in files]}
+@app.post("/api/upload-by-hash")
+async def upload_by_hash(files: List[HashedFile], kind: str = "bundle1", session_id: Optional[str] = None, replace: bool = True):
+    """Attach files the server already has, named by SHA-256, without sending their bytes.
 
+    Files whose content is in the blob store are added to the session's kind (like an
+    upload; a bundle1 call without session_id starts a session). The others are listed
+    under "missing": upload just those with replace=false to complete the set.
+    """
+    if kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(UPLOAD_KINDS)}")
+    if session_id:
+        require_session(session_id)
+    elif kind == "bundle1":
+        session_id = str(uuid.uuid4())
+    else:
+        raise HTTPException(status_code=400, detail="session_id is required")
+    requested = []
+    for file in files:
+        sha256 = file.sha256.lower()
+        if not valid_sha256(sha256):
+            raise HTTPException(status_code=400, detail=f"Invalid SHA-256 for {file.filename}: '{file.sha256}'")
+        requested.append((upload_filename(file.filename), sha256))
+
+    def attach():
+        other_bytes = other_upload_bytes(session_id, kind, replace)
+        session_dir = UPLOAD_DIR / session_id / kind
+        paths, stats, missing, taken = [], [], [], {}
+        for filename, sha256 in requested:
+            size = blob_store.size(sha256) if blob_store.exists(sha256) else None
+            if size is None:
+                missing.append({"filename": filename, "sha256": sha256})
+                continue
+            name = unique_filename(filename, sha256, taken)
+            if name is None:
+                continue
+            if size > settings.max_upload_file_bytes:
+                raise HTTPException(status_code=413, detail=f"{filename} exceeds the per-file limit of {settings.max_upload_file_bytes} bytes")
+            if other_bytes + sum(st["bytes"] for st in stats) + size > settings.max_session_upload_bytes:
+                raise HTTPException(status_code=413, detail=f"Session upload limit of {settings.max_session_upload_bytes} bytes exceeded")
+            try:
+                blob_store.link(sha256, session_dir / name)
+            except FileNotFoundError:
+                # Collected since it was looked up
+                missing.append({"filename": filename, "sha256": sha256})
+                continue
+            paths.append(str(session_dir / name))
+            stats.append({"filename": name, "bytes": size, "sha256": sha256, "deduplicated": True, "seconds": 0.0, "mb_per_s": None})
+            if name != filename:
+                stats[-1]["renamed_from"] = filename
+        record_uploads(session_id, kind, paths, stats, replace)
+        return stats, missing
+
+    stats, missing = await run_in_threadpool(attach)
+    return {
+        "status": "success",
+        "session_id": session_id,
+        "message": f"Attached {len(stats)} of {len(requested)} {kind} files by hash",
+        "files": [st["filename"] for st in stats],
+        "missing": missing,
+        "upload": upload_throughput(stats)
+    }
 
-@app.post("/api/upload-schema2")
-async def upload_schema2(session_id: str = Form(...), files: List[UploadFile] = File(...)):
-    """Upload optional schema/documentation files for Bundle 2 (Excel/CSV)."""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
 
-    session_dir = UPLOAD_DIR / session_id / "schema2"
-    session_dir.mkdir(parents=True, exist_ok=True)
+@app.post("/api/upload-schema1")
+async def upload_schema1(session_id: str = Form(...), files: List[UploadFile] = File(...)):
+    """Upload optional schema/documentation files for Bundle 1 (Excel/CSV)."""
+    require_session(session_id)
 
-    uploaded_files = []
-    for file in files:
-        file_path = session_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        uploaded_files.append(str(file_path))
+    uploaded_files, stats = await save_uploads(files, session_id, "schema1")
 
-    sessions[session_id]["schema2"] = uploaded_files
+    # attach schema paths to session
+    record_uploads(session_id, "schema1", uploaded_files, stats)
 
-    return {"status": "success", "session_id": session_id, "files": [f.filename for f in files]}
+    return {"status": "success", "session_id": session_id, "files": [s["filename"] for s in stats], "upload": upload_throughput(stats)}
 
 
-def load_tables(file_paths: List[str], bundle_name: str):
-    """Load all CSV/Excel files into dictionary of DataFrames"""
-    tables = {}
-    for file_path in file_paths:
-        try:
-            filename = Path(file_path).name
-            if filename.endswith('.csv'):
-                df = pd.read_csv(file_path)
-            elif filename.endswith(('.xls', '.xlsx')):
-                df = pd.read_excel(file_path)
+@app.post("/api/upload-schema2")
+async def upload_schema2(session_id: str = Form(...), files: List[UploadFile] = File(...)):
+    """Upload optional schema/documentation files for Bundle 2 (Excel/CSV)."""
+    require_session(session_id)
+
+    uploaded_files, stats = await save_uploads(files, session_id, "schema2")
+
+    record_uploads(session_id, "schema2", uploaded_files, stats)
+
+    return {"status": "success", "session_id": session_id, "files": [s["filename"] for s in stats], "upload": upload_throughput(stats)}
+
+
+def cached_sheet_names(path: str, hashes: dict) -> List[str]:
+    """Sheets of a workbook, remembered in the table cache so it is not opened again"""
+    key = None
+    if table_cache.enabled:
+        key = f"{hashes.get(path) or file_sha256(path)}-sheets"
+        cached = table_cache.get(key)
+        if cached is not None:
+            return [str(name) for name in cached["sheet"]]
+    names = workbook_sheets(path)
+    if key:
+        table_cache.put(key, pd.DataFrame({"sheet": names}))
+    return names
+
+
+def bundle_sources(file_paths: List[str], hashes: Optional[dict] = None) -> Dict[str, TableSource]:
+    """Table name -> source for a bundle's files (every workbook sheet is a table)"""
+    hashes = hashes or {}
+    return table_sources(file_paths, sheets=lambda path: cached_sheet_names(path, hashes))
+
+
+def load_sources(sources: Dict[str, Dict[str, TableSource]], hashes: Optional[dict] = None, compact: bool = False,
+                 memory: Optional[dict] = None, files: Optional[list] = None, documents: List[str] = ()):
+    """Load tables given as {bundle: {table: source}} into {bundle: {table: DataFrame}}.
+
+    Parsed tables are looked up in the content-addressed table cache first, using the
+    SHA-256 recorded at upload time (or computed here), so re-merges skip parsing. The
+    other files - and the documentation workbooks in documents - are each parsed once,
+    all sheets together, concurrently (see ingest.parse_files). With compact=True every
+    table is converted to compact dtypes (see compact.py); memory receives each table's
+    memory footprint before and after and files the per-file parse stats. Tables that
+    cannot be loaded are logged and left out. Returns (tables, {workbook path: sheets}).
+    """
+    hashes = dict(hashes or {})
+
+    def cache_key(source):
+        if source.path not in hashes:
+            hashes[source.path] = file_sha256(source.path)
+        if source.sheet is None:
+            return hashes[source.path]
+        return f"{hashes[source.path]}-{hashlib.sha256(source.sheet.encode('utf-8')).hexdigest()[:16]}"
+
+    tables = {bundle: {} for bundle in sources}
+    origin = {}
+    jobs = {}
+    for bundle, bundle_tables in sources.items():
+        for table_name, source in bundle_tables.items():
+            df = table_cache.get(cache_key(source)) if table_cache.enabled else None
+            if df is not None:
+                tables[bundle][table_name] = df
+                origin[(bundle, table_name)] = "cache"
+            elif source.sheet is None:
+                jobs[source.path] = None
             else:
+                jobs.setdefault(source.path, []).append(source.sheet)
+    for path in documents:
+        if path.lower().endswith(EXCEL_EXTENSIONS):
+            jobs[path] = None
+
+    results = parse_files(jobs, workers=settings.ingest_workers, executor=settings.ingest_executor,
+                          process_min_bytes=settings.ingest_process_min_bytes) if jobs else {}
+    for path, result in results.items():
+        if isinstance(result, Exception):
+            logger.error("Error loading %s: %s", Path(path).name, result)
+            continue
+        stats = result[1]
+        logger.info("Parsed %s: %d table(s), %d rows in %.2fs (%s MB/s, %s)", stats["file"], stats["tables"],
+                    stats["rows"], stats["seconds"], stats["mb_per_s"], stats["engine"])
+        if files is not None:
+            files.append(stats)
+
+    for bundle, bundle_tables in sources.items():
+        for table_name, source in bundle_tables.items():
+            if table_name in tables[bundle]:
+                continue
+            result = results.get(source.path)
+            df = None if result is None or isinstance(result, Exception) else result[0].get(source.sheet)
+            if df is None:
                 continue
-            
-            # Use filename (without extension) as table name
-            table_name = filename.rsplit('.', 1)[0]
-            tables[table_name] = df
-            print(f"  ✓ {table_name}: {len(df)} rows, {len(df.columns)} columns")
+            if table_cache.enabled:
+                table_cache.put(cache_key(source), df)
+            tables[bundle][table_name] = df
+            origin[(bundle, table_name)] = "parsed"
+
+    for bundle, bundle_tables in tables.items():
+        for table_name, df in bundle_tables.items():
+            if compact:
+                df, report = compact_frame(df, category_ratio=settings.compact_category_ratio)
+                logger.info("%s %s: compacted from %.1f MB to %.1f MB", bundle, table_name,
+                            report["bytes_before"] / 1024 ** 2, report["bytes_after"] / 1024 ** 2)
+                bundle_tables[table_name] = df
+            elif memory is not None:
+                report = {"bytes_before": int(df.memory_usage(index=True, deep=True).sum())}
+                report["bytes_after"] = report["bytes_before"]
+            if memory is not None:
+                memory.setdefault(bundle, {})[table_name] = report
+            logger.info("%s %s: %d rows, %d columns (%s)", bundle, table_name, len(df), len(df.columns), origin[(bundle, table_name)])
+
+    workbooks = {path: results[path] if isinstance(results[path], Exception) else results[path][0]
+                 for path in documents if path in results}
+    return tables, workbooks
+
+
+def load_tables(file_paths: List[str], bundle_name: str, hashes: Optional[dict] = None,
+                compact: bool = False, memory: Optional[dict] = None, files: Optional[list] = None):
+    """Load all CSV/Excel files (every sheet) of one bundle into a dictionary of DataFrames (see load_sources)"""
+    by_bundle = {} if memory is not None else None
+    tables, _ = load_sources({bundle_name: bundle_sources(file_paths, hashes)}, hashes, compact, by_bundle, files)
+    if memory is not None:
+        memory.update(by_bundle.get(bundle_name, {}))
+    return tables[bundle_name]
+
+
+def read_schema_docs(paths: List[str], workbooks: Optional[dict] = None) -> Optional[str]:
+    """Concatenate uploaded schema documentation files into one text block.
+
+    Excel workbooks are serialized sheet by sheet to CSV (workbooks holds the ones
+    already parsed by load_sources); the prompt planner trims the text to the token
+    budget later.
+    """
+    if not paths:
+        return None
+    workbooks = workbooks or {}
+    parts = []
+    for p in paths:
+        pth = Path(p)
+        try:
+            if pth.suffix.lower() in EXCEL_EXTENSIONS:
+                # Serialize each sheet fully to CSV
+                sheets = workbooks.get(p)
+                if sheets is None:
+                    sheets, _ = parse_file(p)
+                elif isinstance(sheets, Exception):
+                    raise sheets
+                for sheet_name, df_sheet in sheets.items():
+                    parts.append(f"--- SHEET: {sheet_name} ---")
+                    parts.append(df_sheet.to_csv(index=False))
+            else:
+                parts.append(pth.read_text(encoding="utf-8"))
         except Exception as e:
-            print(f"  ✗ Error loading {filename}: {e}")
-    
-    return tables
+            parts.append(f"(could not read {pth.name}: {e})")
+    return "\n".join(parts)
+
+
+def describe_table(df):
+    """Schema summary for one table: columns, dtypes and a vectorized column profile"""
+    return {
+        "columns": list(df.columns),
+        "dtypes": {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+        "profile": profile_table(
+            df,
+            sample_rows=settings.profile_sample_rows,
+            top_k=settings.profile_top_k,
+            full_scan_rows=settings.profile_full_scan_rows
+        )["columns"],
+        "row_count": len(df)
+    }
 
 
 def analyze_all_schemas(bundle1_tables, bundle2_tables):
     """Get comprehensive schema for all tables"""
     
-    def convert_timestamps_to_strings(obj):
-        """Recursively convert Timestamp objects to strings"""
-        if isinstance(obj, dict):
-            return {k: convert_timestamps_to_strings(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [convert_timestamps_to_strings(elem) for elem in obj]
-        elif isinstance(obj, pd.Timestamp):
-            return str(obj)
-        else:
-            return obj
-    
     # Build schema summary for Bundle 1
-    b1_schema = {}
-    for table_name, df in bundle1_tables.items():
-        b1_schema[table_name] = {
-            "columns": list(df.columns),
-            "sample": convert_timestamps_to_strings(df.head(2).to_dict('records')),
-            "row_count": len(df)
-        }
+    b1_schema = {table_name: describe_table(df) for table_name, df in bundle1_tables.items()}
     
     # Build schema summary for Bundle 2
-    b2_schema = {}
-    for table_name, df in bundle2_tables.items():
-        b2_schema[table_name] = {
-            "columns": list(df.columns),
-            "sample": convert_timestamps_to_strings(df.head(2).to_dict('records')),
-            "row_count": len(df)
-        }
+    b2_schema = {table_name: describe_table(df) for table_name, df in bundle2_tables.items()}
     
     return b1_schema, b2_schema
 
 
-def generate_mappings(b1_schema, b2_schema, schema_doc1: Optional[str] = None, schema_doc2: Optional[str] = None):
-    """Use Gemini to create intelligent mappings. Optionally include textual schema documentation to improve mapping quality."""
+def build_mapping_prompt(b1_schema, b2_schema, schema_doc1: Optional[str] = None, schema_doc2: Optional[str] = None, known_mappings: Optional[dict] = None):
+    """Render the Gemini mapping prompt for (part of) the two bundles.
+
+    known_mappings holds field mappings already settled locally; b1_schema should then only
+    contain the columns that still need a mapping.
+    """
 
     schema1_block = f"\n\nBUNDLE 1 SCHEMA DOCUMENTATION:\n{schema_doc1}" if schema_doc1 else ""
     schema2_block = f"\n\nBUNDLE 2 SCHEMA DOCUMENTATION:\n{schema_doc2}" if schema_doc2 else ""
+    known_block = ""
+    if known_mappings and known_mappings.get("table_mappings"):
+        pairs = [
+            f"- {tm['source_table']} → {tm['target_table']}: " + ", ".join(f"{fm['source_field']}→{fm['target_field']}" for fm in tm["field_mappings"])
+            for tm in known_mappings["table_mappings"]
+        ]
+        known_block = (
+            "\n\nALREADY MAPPED (do not repeat these fields; the Bundle 1 schema above lists only the columns still unmapped):\n"
+            + "\n".join(pairs)
+        )
 
     prompt = f"""
 You are a data integration expert. Analyze these two data bundles and create mappings.
 
 BUNDLE 1 SCHEMA:
-{json.dumps(b1_schema, indent=2)}
+{json.dumps(b1_schema, indent=2, default=str)}
 {schema1_block}
 
 BUNDLE 2 SCHEMA:
-{json.dumps(b2_schema, indent=2)}
+{json.dumps(b2_schema, indent=2, default=str)}
 {schema2_block}
+{known_block}
 
 TASK: Create field-level mappings from Bundle 1 to Bundle 2.
 
@@ -278,6 +770,12 @@ RULES:
 - One Bundle 1 table can map to ONE Bundle 2 table (one-to-one)
 - Map based on semantic meaning, not just column names
 - For unmapped columns in Bundle 1, suggest which Bundle 2 table should receive them
+- Set "key": true on field mappings whose target field identifies a record (an ID or business key), so overlapping records can be matched instead of duplicated
+- When a value must be converted to fit the target field (type, date format, units, combined columns, codes), add a "transform" expression to its field mapping; omit it otherwise.
+  Expressions use Python syntax over column names ("value" is the source field): literals, + - * / // % **, comparisons, and/or/not, "a if cond else b" and only these functions:
+  int, float, number, str, bool, date(x, format=None, dayfirst=False), upper, lower, strip, title, len, replace(x, old, new), substr(x, start, stop),
+  split(x, sep, part), concat(a, b, ..., sep=""), lookup(x, {{"code": "label"}}, default=None), round(x, digits), abs, coalesce(a, b, ...), where(cond, a, b), isnull, notnull, col("column name").
+  Example: "transform": "float(value) * 100"
 
 Return JSON in this EXACT format:
 {{
@@ -290,6 +788,7 @@ Return JSON in this EXACT format:
                     "source_field": "column_from_bundle1",
                     "target_field": "column_in_bundle2",
                     "confidence": 0.95,
+                    "key": false,
                     "reasoning": "why this mapping makes sense"
                 }}
             ]
@@ -299,250 +798,793 @@ Return JSON in this EXACT format:
 }}
 """
 
-    print("🤖 Asking Gemini to analyze schemas and create mappings...")
-    response = model.generate_content(prompt)
+    return prompt
 
-    # Extract JSON from response
-    response_text = response.text
-    json_start = response_text.find('{')
-    json_end = response_text.rfind('}') + 1
-    json_string = response_text[json_start:json_end]
 
-    mappings = json.loads(json_string)
-    return mappings
+async def ask_model(prompt: str):
+    """Send one mapping prompt to the model and parse the JSON mappings out of the reply"""
+    return await request_mappings(
+        llm_client,
+        prompt,
+        timeout=settings.llm_timeout_seconds,
+        attempts=settings.llm_max_attempts,
+        base_delay=settings.llm_retry_base_delay
+    )
 
 
-def apply_mappings(bundle1_tables, bundle2_tables, mappings):
-    """Transform Bundle 1 data and merge into Bundle 2"""
-    
-    merged_tables = {}
-    
-    # Start with copies of Bundle 2 tables
-    for table_name, df in bundle2_tables.items():
-        merged_tables[table_name] = df.copy()
-    
-    # Process each table mapping
-    for mapping in mappings['table_mappings']:
-        source_table = mapping['source_table']
-        target_table = mapping['target_table']
-        field_mappings = mapping['field_mappings']
-        
-        if source_table not in bundle1_tables:
-            print(f"⚠️  Source table '{source_table}' not found, skipping...")
-            continue
-        
-        if target_table not in merged_tables:
-            print(f"⚠️  Target table '{target_table}' not found, creating new...")
-            merged_tables[target_table] = pd.DataFrame()
-        
-        print(f"\n🔄 Mapping: {source_table} → {target_table}")
-        
-        # Transform source data
-        source_df = bundle1_tables[source_table]
-        transformed = pd.DataFrame()
-        
-        for field_map in field_mappings:
-            source_field = field_map['source_field']
-            target_field = field_map['target_field']
-            
-            if source_field in source_df.columns:
-                transformed[target_field] = source_df[source_field]
-                print(f"  ✓ {source_field} → {target_field} ({field_map.get('confidence', 'N/A')})")
-        
-        # Add missing columns from target with null values
-        target_df = merged_tables[target_table]
-        for col in target_df.columns:
-            if col not in transformed.columns:
-                transformed[col] = None
-        
-        # Reorder to match target schema
-        if len(target_df.columns) > 0:
-            transformed = transformed[target_df.columns]
-        
-        # Merge
-        merged_tables[target_table] = pd.concat(
-            [target_df, transformed], 
-            ignore_index=True
-        )
-        
-        print(f"  📊 Added {len(transformed)} rows to {target_table}")
-    
-    return merged_tables
+def generate_mappings(b1_schema, b2_schema, schema_doc1: Optional[str] = None, schema_doc2: Optional[str] = None, known_mappings: Optional[dict] = None):
+    """Use Gemini to create intelligent mappings. Optionally include textual schema documentation to improve mapping quality.
 
+    The work is split into per-table-group prompts that each fit llm_prompt_token_budget
+    (documentation is trimmed to the relevant lines); the prompts run concurrently and
+    their results are merged into one mappings document. A shard that still fails after
+    retries only loses its own tables, which are listed under "unmapped_tables".
+    """
 
-@app.post("/api/merge/{session_id}")
-async def merge_data(session_id: str, background_tasks: BackgroundTasks):
-    """Start the AI-powered merge as a background job and return a job id immediately."""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    def prompt_builder(b1, b2, doc1, doc2):
+        return build_mapping_prompt(b1, b2, doc1, doc2, known_mappings=known_mappings)
 
-    bundle1_paths = sessions[session_id].get("bundle1", [])
-    bundle2_paths = sessions[session_id].get("bundle2", [])
+    shards = plan_shards(b1_schema, b2_schema, schema_doc1, schema_doc2, settings.llm_prompt_token_budget, prompt_builder)
+    logger.info("Asking %s for mappings: %d request(s), ~%d tokens", llm_client.name, len(shards), sum(s["estimated_tokens"] for s in shards))
 
-    if not bundle1_paths or not bundle2_paths:
-        raise HTTPException(status_code=400, detail="Both bundles must be uploaded")
+    results = asyncio.run(run_concurrently(
+        [s["prompt"] for s in shards],
+        ask_model,
+        settings.llm_concurrency,
+        settings.llm_requests_per_minute
+    ))
 
-    # Create job
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "queued", "session_id": session_id, "result": None, "error": None}
+    mappings = {"table_mappings": [], "summary": ""}
+    unmapped = []
+    for shard, result in zip(shards, results):
+        if isinstance(result, Exception):
+            logger.error("Mapping request for %s failed: %s", ", ".join(map(str, shard["tables"])), result)
+            unmapped.extend(shard["tables"])
+            continue
+        mappings = combine_mappings(mappings, result)
 
-    def run_merge(job_id: str, session_id: str):
-        try:
-            jobs[job_id]["status"] = "running"
+    if unmapped and len(unmapped) == sum(len(s["tables"]) for s in shards):
+        raise RuntimeError(f"All mapping requests failed: {results[0]}")
+    if unmapped:
+        mappings["unmapped_tables"] = unmapped
+    return mappings
 
-            # Load tables
-            print("📊 Loading Bundle 1 tables:")
-            bundle1_tables = load_tables(bundle1_paths, "Bundle 1")
 
-            print("\n📊 Loading Bundle 2 tables:")
-            bundle2_tables = load_tables(bundle2_paths, "Bundle 2")
+def build_mappings(bundle1_tables, bundle2_tables, b1_schema, b2_schema, schema_doc1: Optional[str] = None, schema_doc2: Optional[str] = None):
+    """Match obvious fields locally, then ask Gemini only about the ambiguous remainder"""
+    if not settings.prematch_enabled:
+        return generate_mappings(b1_schema, b2_schema, schema_doc1=schema_doc1, schema_doc2=schema_doc2)
 
-            # Analyze schemas
-            print("\n🔍 Analyzing schemas...")
-            b1_schema, b2_schema = analyze_all_schemas(bundle1_tables, bundle2_tables)
+    local = prematch(
+        bundle1_tables,
+        bundle2_tables,
+        threshold=settings.prematch_threshold,
+        min_coverage=settings.prematch_min_coverage
+    )
+    matched = sum(len(tm["field_mappings"]) for tm in local["table_mappings"])
+    remaining = remaining_schema(b1_schema, local)
+    logger.info("%d fields matched locally, %d left for the model", matched, sum(len(t["columns"]) for t in remaining.values()))
 
-            # Read optional schema documentation files (if uploaded) and include their text in the Gemini prompt
-            schema_doc1 = None
-            schema_doc2 = None
-            try:
-                s1_paths = sessions[session_id].get("schema1", [])
-                if s1_paths:
-                    parts = []
-                    for p in s1_paths:
-                        pth = Path(p)
-                        try:
-                            if pth.suffix.lower() == ".csv":
-                                parts.append(open(pth, "r", encoding="utf-8").read())
-                            elif pth.suffix.lower() in (".xls", ".xlsx"):
-                                # Read all sheets and serialize each sheet fully to CSV
-                                xls = pd.read_excel(pth, sheet_name=None)
-                                for sheet_name, df_sheet in xls.items():
-                                    parts.append(f"--- SHEET: {sheet_name} ---")
-                                    parts.append(df_sheet.to_csv(index=False))
-                            else:
-                                parts.append(open(pth, "r", encoding="utf-8").read())
-                        except Exception as e:
-                            parts.append(f"(could not read {pth.name}: {e})")
-                    schema_doc1 = "\n".join(parts)
-            except Exception:
-                schema_doc1 = None
+    if not remaining:
+        return local
 
-            try:
-                s2_paths = sessions[session_id].get("schema2", [])
-                if s2_paths:
-                    parts = []
-                    for p in s2_paths:
-                        pth = Path(p)
-                        try:
-                            if pth.suffix.lower() == ".csv":
-                                parts.append(open(pth, "r", encoding="utf-8").read())
-                            elif pth.suffix.lower() in (".xls", ".xlsx"):
-                                # Read all sheets and serialize each sheet fully to CSV
-                                xls = pd.read_excel(pth, sheet_name=None)
-                                for sheet_name, df_sheet in xls.items():
-                                    parts.append(f"--- SHEET: {sheet_name} ---")
-                                    parts.append(df_sheet.to_csv(index=False))
-                            else:
-                                parts.append(open(pth, "r", encoding="utf-8").read())
-                        except Exception as e:
-                            parts.append(f"(could not read {pth.name}: {e})")
-                    schema_doc2 = "\n".join(parts)
-            except Exception:
-                schema_doc2 = None
-
-            # Generate mappings with Gemini (include schema docs when available)
-            print("\n🤖 Generating mappings...")
-            mappings = generate_mappings(b1_schema, b2_schema, schema_doc1=schema_doc1, schema_doc2=schema_doc2)
+    llm = generate_mappings(remaining, b2_schema, schema_doc1=schema_doc1, schema_doc2=schema_doc2, known_mappings=local)
+    return combine_mappings(local, llm)
 
-            # Apply mappings and merge
-            print("\n🔄 Applying transformations...")
-            merged_tables = apply_mappings(bundle1_tables, bundle2_tables, mappings)
 
-            # Save results
-            output_dir = OUTPUT_DIR / session_id
-            output_dir.mkdir(parents=True, exist_ok=True)
+def _no_report(event: dict):
+    pass
 
-            # Save mapping documentation
-            mapping_doc_path = output_dir / "mapping_documentation.json"
-            with open(mapping_doc_path, "w") as f:
-                json.dump(mappings, f, indent=2)
 
-            # Save merged tables
-            output_files = []
-            for table_name, df in merged_tables.items():
-                output_path = output_dir / f"merged_{table_name}.csv"
-                df.to_csv(output_path, index=False)
-                output_files.append(output_path.name)
-
-            # Create zip file
-            zip_path = output_dir / "merged_output.zip"
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                zipf.write(mapping_doc_path, "mapping_documentation.json")
-                for table_name, df in merged_tables.items():
-                    csv_path = output_dir / f"merged_{table_name}.csv"
-                    zipf.write(csv_path, f"merged_{table_name}.csv")
+def confirmed_table_mappings(confirmed: Optional[dict], b1_schema: dict) -> Dict[str, list]:
+    """Confirmed table mappings (see confirm_preview_mappings) by Bundle 1 table.
 
-            # Generate summary statistics
-            summary = {
-                "total_tables": len(merged_tables),
-                "table_details": {}
+    Only tables whose columns are still the ones the preview saw are included; a table
+    without any confirmed table mapping was confirmed as unmapped.
+    """
+    if not confirmed:
+        return {}
+    return {
+        table: [tm for tm in confirmed["mappings"].get("table_mappings", []) if tm["source_table"] == table]
+        for table, columns in confirmed["columns"].items()
+        if table in b1_schema and [str(c) for c in b1_schema[table]["columns"]] == columns
+    }
+
+
+def preview_session(session_id: str, session: dict, rows: int, sample: str, limit: int, refresh_mappings: bool) -> dict:
+    """Merge a bounded sample of every table: load, profile, mapping, apply - no output files.
+
+    sample="head" reads only the first rows of each file; "random" takes a reservoir
+    sample, which reads each file through in chunks. Mappings are the confirmed ones
+    where still valid, else cached or generated exactly like the full merge does (on
+    the sample); they are remembered in the session so they can be confirmed.
+    Returns up to limit of the rows each target table gets from Bundle 1.
+    """
+    stages = StageTracker(_no_report)
+    hashes = session.get("hashes", {})
+    sources = {"bundle1": bundle_sources(session.get("bundle1", []), hashes),
+               "bundle2": bundle_sources(session.get("bundle2", []), hashes)}
+
+    def read(item):
+        bundle, table_name, source = item
+        try:
+            if sample == "random":
+                return sample_table(source, rows, settings.stream_chunk_rows)[0]
+            return read_head(source, rows)
+        except Exception as e:
+            logger.error("Error reading a preview of %s %s: %s", bundle, table_name, e)
+            return None
+
+    with stages.stage("load") as counters:
+        items = [(bundle, t, source) for bundle, tables in sources.items() for t, source in tables.items()]
+        tables = {bundle: {} for bundle in sources}
+        with ThreadPoolExecutor(max_workers=settings.ingest_workers or os.cpu_count() or 1) as pool:
+            for (bundle, t, _), df in zip(items, pool.map(read, items)):
+                if df is not None:
+                    tables[bundle][t] = df
+        counters["rows"] = sum(len(df) for bundle_tables in tables.values() for df in bundle_tables.values())
+        counters["tables"] = sum(len(bundle_tables) for bundle_tables in tables.values())
+
+    with stages.stage("profile"):
+        b1_schema, b2_schema = analyze_all_schemas(tables["bundle1"], tables["bundle2"])
+
+    with stages.stage("mapping") as counters:
+        confirmed = {} if refresh_mappings else confirmed_table_mappings(session.get("confirmed_mappings"), b1_schema)
+        pending = [t for t in b1_schema if t not in confirmed]
+        fresh = None
+        mapping_source = "confirmed"
+        if pending:
+            pending_schema = {t: b1_schema[t] for t in pending}
+            schema_doc1 = read_schema_docs(session.get("schema1", []))
+            schema_doc2 = read_schema_docs(session.get("schema2", []))
+            fingerprint = schema_fingerprint(pending_schema, b2_schema, schema_doc1, schema_doc2, settings.gemini_model)
+            fresh = None if refresh_mappings else mapping_cache.get(fingerprint)
+            mapping_source = "cache" if fresh is not None else "generated"
+            if fresh is None:
+                fresh = build_mappings({t: tables["bundle1"][t] for t in pending}, tables["bundle2"],
+                                       pending_schema, b2_schema, schema_doc1=schema_doc1, schema_doc2=schema_doc2)
+                if not fresh.get("unmapped_tables"):
+                    mapping_cache.put(fingerprint, fresh)
+        mappings = {
+            **(fresh or {}),
+            "table_mappings": [tm for t in b1_schema for tm in confirmed.get(t, [])] + (fresh or {}).get("table_mappings", []),
+        }
+        transform_errors = validate_transforms(mappings, {t: info["columns"] for t, info in b1_schema.items()})
+        counters["source"] = mapping_source
+
+    with stages.stage("apply"):
+        merge_stats = {}
+        merged_tables = apply_mappings(tables["bundle1"], tables["bundle2"], mappings, stats=merge_stats)
+        previews = {}
+        for target in group_by_target(mappings):
+            df = merged_tables.get(target)
+            if df is None:
+                continue
+            from_bundle1 = df.iloc[len(tables["bundle2"].get(target, ())):]
+            previews[target] = {
+                "columns": [str(c) for c in df.columns],
+                "dtypes": {str(c): str(dtype) for c, dtype in df.dtypes.items()},
+                "rows_from_bundle2": len(df) - len(from_bundle1),
+                "rows_from_bundle1": len(from_bundle1),
+                "rows": json.loads(from_bundle1.head(limit).to_json(orient="records", date_format="iso")),
+                "transforms": merge_stats.get(target, {}).get("transforms", []),
             }
 
+    columns = {t: [str(c) for c in info["columns"]] for t, info in b1_schema.items()}
+
+    def remember(current):
+        if current is not None:
+            current["preview"] = {"mappings": mappings, "columns": columns, "created_at": time.time()}
+        return current
+
+    sessions.modify(session_id, remember)
+    return {
+        "session_id": session_id,
+        "sample": {"method": sample, "rows_per_table": rows},
+        "mappings": mappings,
+        "mapping_source": mapping_source,
+        "transform_errors": transform_errors,
+        "tables": previews,
+        "stage_seconds": stages.timings,
+    }
+
+
+def run_merge(job_id: str, session_id: str, session: dict, mode: str = "memory", output_format: str = "csv",
+              refresh_mappings: bool = False, profile: bool = False, merge_strategy: str = "append",
+              key_fields: Optional[dict] = None, incremental: bool = True, compact: bool = False, report=_no_report):
+    """Run one merge job and return its result.
+
+    Runs inside a scheduler worker (possibly a child process), so it gets a snapshot of
+    the session's file paths instead of reading the sessions dict. Stage events (see
+    progress.StageTracker) and metric observations go to report(event); logs are tagged
+    with the job and session ids. With profile=True the job runs under cProfile and the
+    stats are saved next to its outputs.
+    """
+    with log_context(job_id=job_id, session_id=session_id), metric_sink(lambda obs: report({"metric": obs})):
+        if not profile:
+            return merge_session(session_id, session, mode, output_format, refresh_mappings, report, merge_strategy, key_fields, incremental, compact)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = merge_session(session_id, session, mode, output_format, refresh_mappings, report, merge_strategy, key_fields, incremental, compact)
+        finally:
+            profiler.disable()
+            profile_path = job_profile_path(session_id, job_id)
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_path)
+            logger.info("Saved cProfile stats to %s", profile_path)
+        result["profile_url"] = f"/api/job/{job_id}/profile"
+        return result
+
+
+def job_profile_path(session_id: str, job_id: str) -> Path:
+    # Kept with the session's outputs so it is evicted along with them
+    return OUTPUT_DIR / session_id / "profiles" / f"{job_id}.prof"
+
+
+def merge_session(session_id: str, session: dict, mode: str, output_format: str, refresh_mappings: bool, report,
+                  merge_strategy: str = "append", key_fields: Optional[dict] = None, incremental: bool = True,
+                  compact: bool = False):
+    """The merge pipeline itself: load, profile, mapping, apply, write, zip, pdf.
+
+    With incremental=True the previous merge's manifest (see merge_graph) decides what is
+    still current: only changed tables are loaded and profiled, only changed Bundle 1
+    tables are mapped again, and outputs whose inputs are unchanged are copied from the
+    previous archive. The manifest is rewritten after every successful merge.
+    compact=True loads tables with compact dtypes (memory mode), which carry through the
+    merge into the outputs.
+    """
+    stages = StageTracker(report)
+    key_fields = key_fields or {}
+    hashes = session.get("hashes", {})
+    output_dir = OUTPUT_DIR / session_id
+    output_dir.mkdir(parents=True, exist_ok=True)
+    zip_path = output_dir / "merged_output.zip"
+    graph = MergeGraph(
+        load_manifest(output_dir) if incremental else None,
+        {"bundle1": bundle_sources(session["bundle1"], hashes), "bundle2": bundle_sources(session["bundle2"], hashes)},
+        hashes,
+        profile_key=digest([mode, compact, settings.compact_category_ratio, settings.profile_sample_rows,
+                            settings.profile_top_k, settings.profile_full_scan_rows, settings.stream_chunk_rows])
+    )
+
+    # Tables (streaming mode only keeps a bounded sample of each) are loaded when first
+    # needed, each batch in parallel
+    frames = {"bundle1": {}, "bundle2": {}}
+    row_counts = {}
+    memory = {"bundle1": {}, "bundle2": {}}
+    files = []
+
+    def sample(bundle, table_name):
+        started = time.perf_counter()
+        source = graph.source(bundle, table_name)
+        table_sample, rows = sample_table(source, settings.profile_sample_rows, settings.stream_chunk_rows)
+        seconds = time.perf_counter() - started
+        size = os.path.getsize(source.path)
+        logger.info("%s %s: %d rows, %d columns (sampled %d)", bundle, table_name, rows, len(table_sample.columns), len(table_sample))
+        return table_sample, rows, {
+            "file": Path(source.path).name, "engine": "pandas (sampled)", "bytes": size, "tables": 1, "rows": rows,
+            "seconds": round(seconds, 4), "mb_per_s": round(size / 1024 ** 2 / seconds, 2) if seconds > 0 else None,
+        }
+
+    def ensure_loaded(wanted: Dict[str, List[str]], documents: List[str] = ()):
+        """Load the wanted tables that are not loaded yet, plus documentation workbooks"""
+        missing = {bundle: {t: graph.source(bundle, t) for t in names if t not in frames[bundle]} for bundle, names in wanted.items()}
+        if mode == "streaming":
+            # CSV files are sampled chunk by chunk; sheets can only be read whole, so they
+            # are loaded like in memory mode (one parse per workbook) and sampled after
+            items = [(bundle, t) for bundle, sources in missing.items() for t, source in sources.items() if source.is_csv]
+            with ThreadPoolExecutor(max_workers=settings.ingest_workers or os.cpu_count() or 1) as pool:
+                for (bundle, t), (table_sample, rows, stats) in zip(items, pool.map(lambda item: sample(*item), items)):
+                    frames[bundle][t] = table_sample
+                    row_counts[(bundle, t)] = rows
+                    files.append(stats)
+            missing = {bundle: {t: s for t, s in sources.items() if not s.is_csv} for bundle, sources in missing.items()}
+        loaded, workbooks = load_sources(missing, hashes, compact and mode == "memory", memory, files, documents)
+        for bundle, sources in missing.items():
+            for t in sources:
+                df = loaded[bundle].get(t)
+                if mode == "streaming" and df is not None:
+                    row_counts[(bundle, t)] = len(df)
+                    df = reservoir_sample(iter([df]), settings.profile_sample_rows, 0)
+                frames[bundle][t] = df
+        return workbooks
+
+    def load(bundle, table_name):
+        ensure_loaded({bundle: [table_name]})
+        return frames[bundle][table_name]
+
+    def loaded_rows():
+        if mode == "streaming":
+            return sum(row_counts.values())
+        return sum(len(df) for tables in frames.values() for df in tables.values() if df is not None)
+
+    # Load the tables whose schema cannot be taken from the previous merge, and the
+    # optional schema documentation files
+    with stages.stage("load") as counters:
+        workbooks = ensure_loaded(
+            {bundle: [t for t in tables if graph.reusable_schema(bundle, t) is None] for bundle, tables in graph.tables.items()},
+            documents=session.get("schema1", []) + session.get("schema2", [])
+        )
+        counters["rows"] = loaded_rows()
+        counters["tables"] = sum(len(tables) for tables in frames.values())
+        counters["reused_tables"] = sum(len(tables) for tables in graph.tables.values()) - counters["tables"]
+        counters["bytes"] = sum(f["bytes"] for f in files)
+        counters["files"] = len(files)
+
+    # Analyze schemas
+    with stages.stage("profile") as counters:
+        profiled = 0
+        for bundle in ("bundle1", "bundle2"):
+            for table_name in list(graph.tables[bundle]):
+                info = graph.reusable_schema(bundle, table_name)
+                if info is None:
+                    df = load(bundle, table_name)
+                    if df is None:
+                        graph.drop(bundle, table_name)
+                        continue
+                    info = describe_table(df)
+                    if mode == "streaming":
+                        info["row_count"] = row_counts[(bundle, table_name)]
+                    profiled += 1
+                graph.set_schema(bundle, table_name, info)
+        b1_schema, b2_schema = graph.schemas["bundle1"], graph.schemas["bundle2"]
+        counters["columns"] = sum(len(info["columns"]) for info in [*b1_schema.values(), *b2_schema.values()])
+        counters["profiled_tables"] = profiled
+
+    # Include the text of the schema documentation files in the Gemini prompt
+    schema_doc1 = read_schema_docs(session.get("schema1", []), workbooks)
+    schema_doc2 = read_schema_docs(session.get("schema2", []), workbooks)
+
+    # Generate mappings with Gemini (include schema docs when available) for the Bundle 1
+    # tables the previous merge did not map, unless the same schema layout was mapped before
+    with stages.stage("mapping") as counters:
+        context = schema_fingerprint({}, b2_schema, schema_doc1, schema_doc2, settings.gemini_model)
+        context = digest([context, settings.prematch_enabled, settings.prematch_threshold, settings.prematch_min_coverage])
+        reused_mappings = graph.reusable_mappings(context)
+        if refresh_mappings:
+            reused_mappings = {}
+        # Mappings confirmed after a preview take precedence over everything else
+        confirmed = {} if refresh_mappings else confirmed_table_mappings(session.get("confirmed_mappings"), b1_schema)
+        reused_mappings.update(confirmed)
+        pending = [t for t in b1_schema if t not in reused_mappings]
+        fresh = None
+        mapping_source = "confirmed" if confirmed and len(confirmed) == len(reused_mappings) else "reused"
+        if pending:
+            pending_schema = {t: b1_schema[t] for t in pending}
+            fingerprint = schema_fingerprint(pending_schema, b2_schema, schema_doc1, schema_doc2, settings.gemini_model)
+            fresh = None if refresh_mappings else mapping_cache.get(fingerprint)
+            mapping_source = "cache" if fresh is not None else "generated"
+            if fresh is None:
+                ensure_loaded({"bundle1": pending, "bundle2": list(b2_schema)})
+                fresh = build_mappings(
+                    {t: frames["bundle1"][t] for t in pending if frames["bundle1"][t] is not None},
+                    {t: frames["bundle2"][t] for t in b2_schema if frames["bundle2"][t] is not None},
+                    pending_schema, b2_schema, schema_doc1=schema_doc1, schema_doc2=schema_doc2
+                )
+                # Partial results (some requests failed) are not worth reusing
+                if not fresh.get("unmapped_tables"):
+                    mapping_cache.put(fingerprint, fresh)
+            else:
+                logger.info("Reusing cached mappings (%s)", fingerprint[:12])
+        if reused_mappings:
+            logger.info("Reusing the previous merge's mappings of %d of %d Bundle 1 tables", len(reused_mappings), len(b1_schema))
+        mappings = graph.set_mappings(reused_mappings, fresh)
+        # Transforms are compiled (and checked against the source columns) before any data
+        # is touched; a bad one falls back to copying its source field
+        transform_errors = validate_transforms(mappings, {t: info["columns"] for t, info in b1_schema.items()})
+        for error in transform_errors:
+            logger.warning("Ignoring the transform of %s.%s: %s", error["target_table"], error["target_field"], error["error"])
+        counters["source"] = mapping_source
+        counters["table_mappings"] = len(mappings.get("table_mappings", []))
+        counters["reused_tables"] = len(reused_mappings)
+        counters["confirmed_tables"] = len(confirmed)
+        counters["transform_errors"] = len(transform_errors)
+
+    # Save mapping documentation
+    mapping_doc_path = output_dir / "mapping_documentation.json"
+    with open(mapping_doc_path, "w") as f:
+        json.dump(mappings, f, indent=2)
+
+    # Loose table files from earlier runs would shadow the new archive entries
+    for stale in output_dir.glob("merged_*"):
+        if stale.name != "merged_output.zip":
+            stale.unlink()
+
+    # Every output table is rebuilt unless its inputs match the previous merge
+    by_target = group_by_target(mappings)
+    targets = list(b2_schema) + [t for t in by_target if t not in b2_schema]
+    output_hashes = {
+        target: graph.output_hash(target, by_target.get(target, []), {
+            "mode": mode,
+            "output_format": output_format,
+            "merge_strategy": merge_strategy,
+            "key_fields": key_fields.get(target),
+            "compact": compact and mode == "memory",
+        })
+        for target in targets
+    }
+
+    # Tables are serialized straight into compressed zip entries
+    extension = "parquet" if output_format == "parquet" else "csv"
+    archive = ArchiveWriter(zip_path, settings.output_compression_level)
+    try:
+        archive.add_file("mapping_documentation.json", mapping_doc_path)
+
+        reused_outputs = {}
+        if zip_path.exists():
+            for target in targets:
+                previous = graph.reusable_output(target, output_hashes[target])
+                if previous and archive.copy_entry(zip_path, previous["entry"], previous["crc"]):
+                    reused_outputs[target] = previous
+        affected = [t for t in targets if t not in reused_outputs]
+        affected_mappings = {**mappings, "table_mappings": [tm for tm in mappings.get("table_mappings", []) if tm["target_table"] in affected]}
+        sources = list(dict.fromkeys(tm["source_table"] for tm in affected_mappings["table_mappings"] if tm["source_table"] in b1_schema))
+        targets_in_b2 = [t for t in affected if t in b2_schema]
+        if reused_outputs:
+            logger.info("Reusing %d of %d output tables from the previous merge", len(reused_outputs), len(targets))
+
+        if mode == "streaming":
+            # Apply mappings chunk by chunk, writing merged tables as we go; both stages
+            # happen at once, so they are reported as one "apply" stage with row progress
+            with stages.stage("apply") as counters:
+                ensure_loaded({"bundle1": sources, "bundle2": targets_in_b2})
+                new_files, new_details = stream_merge(
+                    {t: graph.source("bundle1", t) for t in sources},
+                    {t: graph.source("bundle2", t) for t in targets_in_b2},
+                    target_schemas(
+                        {t: frames["bundle1"][t] for t in sources},
+                        {t: frames["bundle2"][t] for t in targets_in_b2},
+                        affected_mappings
+                    ),
+                    affected_mappings,
+                    archive,
+                    settings.stream_chunk_rows,
+                    fmt=output_format,
+                    progress=lambda **fields: stages.progress("apply", **fields),
+                    strategy=merge_strategy,
+                    key_fields=key_fields
+                )
+                new_outputs = dict(zip(new_details, new_files))
+                counters["rows"] = sum(d["total_rows"] for d in new_details.values())
+                counters["tables"] = len(new_details)
+                counters["reused_tables"] = len(reused_outputs)
+        else:
+            # Apply mappings and merge
+            with stages.stage("apply") as counters:
+                ensure_loaded({"bundle1": sources, "bundle2": targets_in_b2})
+                bundle1_tables = {t: frames["bundle1"][t] for t in sources if frames["bundle1"][t] is not None}
+                bundle2_tables = {t: frames["bundle2"][t] for t in targets_in_b2 if frames["bundle2"][t] is not None}
+                merge_stats = {}
+                merged_tables = apply_mappings(bundle1_tables, bundle2_tables, affected_mappings, stats=merge_stats,
+                                               strategy=merge_strategy, key_fields=key_fields)
+                counters["rows"] = sum(len(df) for df in merged_tables.values())
+                counters["tables"] = len(merged_tables)
+                counters["reused_tables"] = len(reused_outputs)
+
+            # Save merged tables, compressing tables in parallel
+            with stages.stage("write") as counters:
+                new_outputs = {table_name: f"merged_{table_name}.{extension}" for table_name in merged_tables}
+                entries = [archive.open_entry(name, compress=output_format == "csv") for name in new_outputs.values()]
+                with ThreadPoolExecutor(max_workers=settings.output_workers) as pool:
+                    list(pool.map(
+                        lambda item: write_frame(item[0], item[1], output_format),
+                        zip(entries, merged_tables.values())
+                    ))
+                counters["bytes"] = sum(e["bytes"] for e in archive.stats())
+
+            # Generate summary statistics
+            new_details = {}
             for table_name, df in merged_tables.items():
                 original_size = len(bundle2_tables.get(table_name, pd.DataFrame()))
                 added = len(df) - original_size
-                summary["table_details"][table_name] = {
+                new_details[table_name] = {
                     "total_rows": len(df),
                     "rows_from_bundle1": added,
                     "columns": len(df.columns)
                 }
+                if table_name in merge_stats:
+                    new_details[table_name]["merge"] = merge_stats[table_name]
+
+        output_files = []
+        table_details = {}
+        for target in targets:
+            if target in reused_outputs:
+                previous = reused_outputs[target]
+                graph.set_output(target, output_hashes[target], previous["entry"], previous["details"])
+                output_files.append(previous["entry"])
+                table_details[target] = {**previous["details"], "reused": True}
+            elif target in new_outputs:
+                graph.set_output(target, output_hashes[target], new_outputs[target], new_details[target])
+                output_files.append(new_outputs[target])
+                table_details[target] = new_details[target]
+
+        with stages.stage("zip") as counters:
+            archive.close()
+            counters["bytes"] = zip_path.stat().st_size
+    except BaseException:
+        archive.abort()
+        raise
+    graph.save(output_dir, zip_path)
+
+    # Render the mapping PDF now so the first download is served from the cache
+    if REPORTLAB_AVAILABLE:
+        with stages.stage("pdf") as counters:
+            try:
+                pdf_path, _ = ensure_mapping_pdf(output_dir, session_id)
+                counters["bytes"] = pdf_path.stat().st_size
+            except Exception as e:
+                # The PDF is rendered again on request; not worth failing the merge
+                logger.warning("Could not pre-render the mapping PDF: %s", e)
 
-            result = {
-                "status": "success",
-                "session_id": session_id,
-                "mappings": mappings,
-                "summary": summary,
-                "output_files": output_files,
-                "download_url": f"/api/download/{session_id}/merged_output.zip",
-                "message": f"Successfully merged {len(merged_tables)} tables"
-            }
+    outputs = {entry["name"]: entry for entry in archive.stats()}
 
-            jobs[job_id]["status"] = "success"
-            jobs[job_id]["result"] = result
+    summary = {
+        "total_tables": len(table_details),
+        "table_details": table_details
+    }
+    keyed = [d["merge"]["keyed"] for d in table_details.values() if "keyed" in d.get("merge", {})]
+    if keyed:
+        # Totals over the tables merged by key; per-table counts are in table_details
+        summary["merge_strategy"] = merge_strategy
+        summary["keyed_totals"] = {
+            field: sum(k.get(field, 0) for k in keyed)
+            for field in ("inserted", "updated", "unchanged", "skipped", "conflicts", "source_duplicates", "target_duplicates", "null_keys")
+        }
+    if transform_errors:
+        summary["transform_errors"] = transform_errors
 
-        except Exception as e:
-            jobs[job_id]["status"] = "failed"
-            jobs[job_id]["error"] = str(e)
-            print(f"Job {job_id} failed: {e}")
+    result = {
+        "status": "success",
+        "session_id": session_id,
+        "mappings": mappings,
+        "mapping_source": mapping_source,
+        "summary": summary,
+        "output_files": output_files,
+        "output_format": output_format,
+        "outputs": outputs,
+        "download_url": f"/api/download/{session_id}/merged_output.zip",
+        "mode": mode,
+        "incremental": {
+            "tables_loaded": sum(1 for tables in frames.values() for df in tables.values() if df is not None),
+            "tables_profiled": profiled,
+            "mappings_reused": sorted(reused_mappings),
+            "mappings_confirmed": sorted(confirmed),
+            "outputs_reused": [reused_outputs[t]["entry"] for t in targets if t in reused_outputs],
+            "outputs_rebuilt": [new_outputs[t] for t in targets if t in new_outputs],
+        },
+        "table_memory": memory,
+        "ingest": files,
+        "stage_seconds": stages.timings,
+        "message": f"Successfully merged {len(table_details)} tables"
+    }
 
-    # Schedule the background job
-    background_tasks.add_task(run_merge, job_id, session_id)
+    return result
+
+
+def update_job(job_id: str, fields: dict):
+    """Scheduler callback: apply a job's state change or record a progress event"""
+    event = fields.get("event")
+    if event is None:
+        job = jobs.patch(job_id, fields)
+        record_job_metrics(job, fields)
+        return
+    if "metric" in event:
+        apply_observation(event["metric"])
+        return
+
+    def append(job):
+        job = job or {}
+        seq = job.get("event_count", 0) + 1
+        job["event_count"] = seq
+        job["events"] = (job.get("events", []) + [{**event, "seq": seq}])[-MAX_JOB_EVENTS:]
+        if "stage" in event:
+            job["stage"] = event["stage"]
+            if event.get("state") == "finished":
+                job.setdefault("stage_seconds", {})[event["stage"]] = event.get("seconds")
+        return job
+
+    jobs.modify(job_id, append)
+
+
+def record_job_metrics(job: dict, fields: dict):
+    """Queue wait, run time, outcome and per-stage metrics, recorded in the owning API process"""
+    if "wait_seconds" in fields:
+        record("datamerge_job_wait_seconds", fields["wait_seconds"])
+    status = fields.get("status")
+    if status not in ("success", "failed", "cancelled"):
+        return
+    record("datamerge_jobs_total", status=status)
+    if job.get("started_at"):
+        record("datamerge_job_seconds", fields["finished_at"] - job["started_at"], status=status)
+    mode = job.get("mode", "")
+    for event in job.get("events", []):
+        if event.get("state") != "finished":
+            continue
+        record("datamerge_stage_seconds", event["seconds"], stage=event["stage"], mode=mode)
+        if isinstance(event.get("rows"), int):
+            record("datamerge_stage_rows_total", event["rows"], stage=event["stage"], mode=mode)
+        if event["stage"] == "write":
+            record("datamerge_output_bytes_total", event.get("bytes", 0), kind="table")
+        elif event["stage"] == "zip":
+            record("datamerge_output_bytes_total", event.get("bytes", 0), kind="archive")
+
+
+def cancel_requested(job_id: str) -> bool:
+    return bool((jobs.get(job_id) or {}).get("cancel_requested"))
+
+
+# Merges run off the API process so large jobs cannot starve uploads
+scheduler = JobScheduler(
+    run_merge,
+    on_update=update_job,
+    workers=settings.job_workers,
+    max_queue=settings.job_queue_size,
+    executor=settings.job_executor,
+    start_method=settings.job_start_method,
+    should_cancel=cancel_requested
+)
+QUEUE_DEPTH.callback = lambda: scheduler.stats()["queue_depth"]
+JOBS_RUNNING.callback = lambda: scheduler.stats()["running"]
 
-    return {"status": "queued", "job_id": job_id}
+
+@app.post("/api/merge/{session_id}")
+async def merge_data(session_id: str, refresh_mappings: bool = False, mode: str = "memory", output_format: Optional[str] = None, priority: int = 0, profile: bool = False,
+                     merge_strategy: str = "append", keys: Optional[List[str]] = Query(None), incremental: bool = True,
+                     compact: Optional[bool] = None):
+    """Queue the AI-powered merge on the job scheduler and return a job id immediately.
+
+    Pass refresh_mappings=true to ignore any cached mappings for this schema layout (and
+    mappings confirmed after a preview, see /api/preview/{session_id}).
+    mode=streaming merges chunk by chunk straight to the output files, for bundles that
+    do not fit in memory (schemas are profiled from a reservoir sample).
+    output_format is "csv" or "parquet" (defaults to the server setting).
+    Higher priority jobs start first; jobs of equal priority take turns across sessions.
+    profile=true runs the job under cProfile (see /api/job/{job_id}/profile).
+    merge_strategy=upsert|skip_existing merges by key instead of appending, on targets
+    with key fields: those marked "key": true in the mappings, or keys=table.field
+    (repeatable), which replaces the marked keys of that table. Upsert needs mode=memory.
+    By default only what changed since the session's last merge is recomputed (see
+    merge_graph); incremental=false rebuilds everything.
+    compact=true loads tables with compact dtypes to cut memory use (defaults to the
+    server setting; memory mode only). Results report each table's memory before and after.
+    """
+    session = require_session(session_id)
+    if mode not in ("memory", "streaming"):
+        raise HTTPException(status_code=400, detail="mode must be 'memory' or 'streaming'")
+    output_format = output_format or settings.output_format
+    compact = settings.compact_dtypes if compact is None else compact
+    if output_format not in ("csv", "parquet"):
+        raise HTTPException(status_code=400, detail="output_format must be 'csv' or 'parquet'")
+    if merge_strategy not in MERGE_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"merge_strategy must be one of {', '.join(MERGE_STRATEGIES)}")
+    if merge_strategy == "upsert" and mode == "streaming":
+        raise HTTPException(status_code=400, detail="merge_strategy=upsert needs mode=memory")
+    key_fields = {}
+    for key in keys or []:
+        table, _, field = key.rpartition(".")
+        if not table or not field:
+            raise HTTPException(status_code=400, detail=f"keys must look like table.field, got '{key}'")
+        key_fields.setdefault(table, []).append(field)
+
+    bundle1_paths = session.get("bundle1", [])
+    bundle2_paths = session.get("bundle2", [])
+
+    if not bundle1_paths or not bundle2_paths:
+        raise HTTPException(status_code=400, detail="Both bundles must be uploaded")
+
+    # Queue the job; workers get a snapshot of the session's files
+    job_id = str(uuid.uuid4())
+    jobs[job_id] = {"status": "queued", "session_id": session_id, "mode": mode, "merge_strategy": merge_strategy, "owner": JOB_OWNER, "result": None, "error": None}
+    snapshot = {
+        "bundle1": list(bundle1_paths),
+        "bundle2": list(bundle2_paths),
+        "schema1": list(session.get("schema1", [])),
+        "schema2": list(session.get("schema2", [])),
+        "hashes": dict(session.get("hashes", {})),
+        "confirmed_mappings": session.get("confirmed_mappings")
+    }
+    try:
+        position = scheduler.submit(job_id, session_id, (session_id, snapshot, mode, output_format, refresh_mappings, profile, merge_strategy, key_fields, incremental, compact), priority=priority)
+    except QueueFull as e:
+        del jobs[job_id]
+        raise HTTPException(status_code=429, detail=f"Merge queue is full ({e}); try again later")
+
+    return {"status": "queued", "job_id": job_id, "queue_position": position}
 
 
 @app.get("/api/download/{session_id}/{filename}")
-async def download_file(session_id: str, filename: str):
-    """Download merged results"""
-    file_path = OUTPUT_DIR / session_id / filename
-    
-    if not file_path.exists():
+async def download_file(session_id: str, filename: str, request: Request):
+    """Download merged results.
+
+    Merged tables live only inside merged_output.zip; they are streamed out of the
+    archive on request. Every response carries an ETag and supports If-None-Match and
+    Range/If-Range, so interrupted downloads can resume.
+    """
+    lifecycle.touch(session_id)
+    output_dir = OUTPUT_DIR / session_id
+    file_path = output_dir / filename
+    if file_path.resolve().parent != output_dir.resolve():
         raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(
-        file_path,
-        filename=filename,
-        media_type="application/octet-stream"
+
+    if file_path.is_file():
+        stat = file_path.stat()
+        etag = file_etag(stat)
+        headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+        if not_modified(request, etag, stat.st_mtime):
+            return Response(status_code=304, headers=headers)
+        # FileResponse answers Range and If-Range itself
+        return FileResponse(
+            file_path,
+            filename=filename,
+            media_type="application/octet-stream",
+            headers=headers
+        )
+
+    zip_path = output_dir / "merged_output.zip"
+    if not zip_path.exists():
+        raise HTTPException(status_code=404, detail="File not found")
+    with zipfile.ZipFile(zip_path) as zf:
+        try:
+            info = zf.getinfo(filename)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="File not found")
+
+    # Same content (CRC and size) keeps its ETag across re-merges
+    return ranged_response(
+        request,
+        info.file_size,
+        f'"{info.CRC:08x}-{info.file_size:x}"',
+        lambda start, end: iter_member_range(zip_path, filename, start, end),
+        filename,
+        last_modified=zip_path.stat().st_mtime
+    )
+
+
+@app.get("/api/archive/{session_id}")
+async def download_selection(session_id: str, request: Request, tables: Optional[List[str]] = Query(None), include_mappings: bool = True):
+    """Zip of only the selected merged tables (all of them if none are given).
+
+    The archive is assembled on the fly from the compressed entries already stored in
+    merged_output.zip, so nothing is recompressed or written and the download starts at
+    once; its size is known up front and Range requests work as for single files.
+    """
+    lifecycle.touch(session_id)
+    zip_path = OUTPUT_DIR / session_id / "merged_output.zip"
+    if not zip_path.exists():
+        raise HTTPException(status_code=404, detail="Merged output not found")
+    with zipfile.ZipFile(zip_path) as zf:
+        members = zf.namelist()
+    table_entries = {name.split("_", 1)[1].rsplit(".", 1)[0]: name for name in members if name.startswith("merged_")}
+
+    if tables:
+        names = []
+        for table in tables:
+            name = table if table in members else table_entries.get(table)
+            if name is None:
+                raise HTTPException(status_code=404, detail=f"Table '{table}' not found in the merged output")
+            names.append(name)
+    else:
+        names = list(table_entries.values())
+    if include_mappings and "mapping_documentation.json" in members:
+        names.append("mapping_documentation.json")
+
+    selection = await run_in_threadpool(ZipSelection, zip_path, list(dict.fromkeys(names)))
+    return ranged_response(
+        request,
+        selection.size,
+        selection.etag(),
+        selection.iter_range,
+        f"merged_{session_id}.zip",
+        media_type="application/zip",
+        last_modified=zip_path.stat().st_mtime
     )
 
 
 @app.get("/api/session/{session_id}/status")
 async def get_session_status(session_id: str):
     """Get current session status"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    session = sessions[session_id]
+    session = require_session(session_id)
     return {
         "session_id": session_id,
         "bundle1_files": len(session.get("bundle1", [])),
@@ -551,105 +1593,238 @@ async def get_session_status(session_id: str):
     }
 
 
+@app.get("/api/session/{session_id}/profile")
+async def get_session_profile(session_id: str):
+    """Column profiles for every uploaded Bundle 1 and Bundle 2 table"""
+    session = require_session(session_id)
+
+    def build_profiles():
+        hashes = session.get("hashes", {})
+        tables, _ = load_sources({
+            "bundle1": bundle_sources(session.get("bundle1", []), hashes),
+            "bundle2": bundle_sources(session.get("bundle2", []), hashes),
+        }, hashes)
+        return analyze_all_schemas(tables["bundle1"], tables["bundle2"])
+
+    b1_schema, b2_schema = await run_in_threadpool(build_profiles)
+    return {"session_id": session_id, "bundle1": b1_schema, "bundle2": b2_schema}
+
+
+@app.post("/api/preview/{session_id}")
+async def preview_merge(session_id: str, rows: Optional[int] = None, sample: str = "head", limit: int = 100,
+                        refresh_mappings: bool = False):
+    """Merge a sample of every table (rows each, see preview_rows) and return the merged rows.
+
+    Runs in the request rather than as a job: only the first rows of each file are read
+    (sample=random reservoir-samples each whole file instead), so once mappings are known
+    it takes a fraction of a second. The mappings used are kept with the session; POST
+    /api/preview/{session_id}/confirm to have the full merge use them.
+    """
+    session = require_session(session_id)
+    rows = rows or settings.preview_rows
+    if not 0 < rows <= settings.preview_max_rows:
+        raise HTTPException(status_code=400, detail=f"rows must be between 1 and {settings.preview_max_rows}")
+    if sample not in ("head", "random"):
+        raise HTTPException(status_code=400, detail="sample must be 'head' or 'random'")
+    if not session.get("bundle1") or not session.get("bundle2"):
+        raise HTTPException(status_code=400, detail="Both bundles must be uploaded")
+    result = await run_in_threadpool(preview_session, session_id, session, rows, sample, max(limit, 0), refresh_mappings)
+    return {"status": "success", **result, "confirm_url": f"/api/preview/{session_id}/confirm"}
+
+
+@app.post("/api/preview/{session_id}/confirm")
+async def confirm_preview_mappings(session_id: str, mappings: Optional[dict] = Body(None)):
+    """Confirm the last preview's mappings - or an edited version of them sent as the body.
+
+    Later merges use confirmed mappings for every Bundle 1 table whose columns are
+    unchanged since the preview, instead of reusing or generating mappings
+    (refresh_mappings=true ignores them).
+    """
+    session = require_session(session_id)
+    preview = session.get("preview")
+    if preview is None:
+        raise HTTPException(status_code=400, detail="Preview the merge before confirming its mappings")
+    if mappings is None:
+        mappings = preview["mappings"]
+    elif not isinstance(mappings.get("table_mappings"), list) or not all(
+            isinstance(tm, dict) and {"source_table", "target_table"} <= tm.keys() and isinstance(tm.get("field_mappings"), list)
+            and all(isinstance(fm, dict) and {"source_field", "target_field"} <= fm.keys() for fm in tm["field_mappings"])
+            for tm in mappings["table_mappings"]):
+        raise HTTPException(status_code=400, detail="mappings must have table_mappings with source_table, target_table "
+                                                    "and field_mappings of source_field/target_field")
+    errors = validate_transforms(mappings, preview["columns"])
+    if errors:
+        raise HTTPException(status_code=400, detail={"message": "Invalid transforms", "transform_errors": errors})
+
+    confirmed = {"mappings": mappings, "columns": preview["columns"], "confirmed_at": time.time()}
+    sessions.patch(session_id, {"confirmed_mappings": confirmed}, create=False)
+    return {"status": "success", "session_id": session_id, "confirmed_tables": sorted(preview["columns"])}
+
+
+@app.delete("/api/preview/{session_id}/confirm")
+async def clear_confirmed_mappings(session_id: str):
+    """Forget confirmed mappings; merges go back to reusing or generating them"""
+    require_session(session_id)
+    sessions.modify(session_id, lambda current: current and {k: v for k, v in current.items() if k != "confirmed_mappings"})
+    return {"status": "success", "session_id": session_id}
+
+
 @app.get("/api/job/{job_id}")
 async def get_job_status(job_id: str):
-    if job_id not in jobs:
+    job = jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    job = jobs[job_id]
     return {
         "job_id": job_id,
         "status": job.get("status"),
+        "stage": job.get("stage"),
+        "queue_position": scheduler.queue_position(job_id) if job.get("status") == "queued" else None,
+        "queued_at": job.get("queued_at"),
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "wait_seconds": job.get("wait_seconds"),
+        "stage_seconds": job.get("stage_seconds", {}),
         "result": job.get("result"),
         "error": job.get("error")
     }
 
 
+@app.get("/api/job/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    """Server-Sent Events stream of a job's progress.
+
+    Sends every stage event ("stage" messages, with elapsed seconds and row counts) as it
+    is recorded, then one "done" message with the final status and closes. Reconnecting
+    clients resume after the Last-Event-ID they received.
+    """
+    if jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    last_id = request.headers.get("last-event-id", "0")
+    last_seq = int(last_id) if last_id.isdigit() else 0
+
+    async def events():
+        nonlocal last_seq
+        idle = 0.0
+        while True:
+            job = jobs.get(job_id)
+            if job is None:
+                yield sse_event({"job_id": job_id, "status": "expired"}, event="done")
+                return
+            for event in job.get("events", []):
+                if event["seq"] > last_seq:
+                    last_seq = event["seq"]
+                    idle = 0.0
+                    yield sse_event(event, event="stage", event_id=last_seq)
+            if job.get("status") in ("success", "failed", "cancelled"):
+                yield sse_event({
+                    "job_id": job_id,
+                    "status": job.get("status"),
+                    "error": job.get("error"),
+                    "stage_seconds": job.get("stage_seconds", {})
+                }, event="done")
+                return
+            if await request.is_disconnected():
+                return
+            if idle >= settings.progress_keepalive_seconds:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            await asyncio.sleep(settings.progress_poll_seconds)
+            idle += settings.progress_poll_seconds
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.delete("/api/job/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued job, or stop a running one"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    previous = scheduler.cancel(job_id)
+    if previous is None:
+        if job.get("status") not in ("queued", "running"):
+            raise HTTPException(status_code=409, detail=f"Job already {job.get('status')}")
+        # Owned by another API worker; its scheduler picks up the flag
+        jobs.patch(job_id, {"cancel_requested": True}, create=False)
+        return {"job_id": job_id, "status": "cancelling"}
+    return {"job_id": job_id, "status": "cancelled" if previous == "queued" else "cancelling"}
+
+
+@app.get("/api/job/{job_id}/profile")
+async def get_job_profile(job_id: str, format: str = "text", limit: int = 40):
+    """cProfile stats of a job started with profile=true: a text summary (top functions
+    by cumulative time) or the raw .prof file (format=raw) for snakeviz/pstats"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    profile_path = job_profile_path(job["session_id"], job_id)
+    if not profile_path.exists():
+        raise HTTPException(status_code=404, detail="No profile for this job (start the merge with profile=true)")
+    if format == "raw":
+        return FileResponse(profile_path, filename=f"{job_id}.prof", media_type="application/octet-stream")
+    out = io.StringIO()
+    pstats.Stats(str(profile_path), stream=out).sort_stats("cumulative").print_stats(limit)
+    return PlainTextResponse(out.getvalue())
+
+
+@app.get("/api/jobs/stats")
+async def get_job_stats():
+    """Queue depth, running jobs, wait times and outcome counters"""
+    return scheduler.stats()
+
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Hit/miss counters and sizes for the parse and mapping caches"""
+    return {
+        "tables": table_cache.stats(),
+        "mappings": mapping_cache.stats()
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of this API process (scrape each worker when running several)"""
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/storage/stats")
+async def get_storage_stats():
+    """Session/job counts, upload and output bytes, quotas and eviction counters"""
+    return await run_in_threadpool(lifecycle.stats)
+
+
 @app.get("/api/mapping_pdf/{session_id}")
-async def get_mapping_pdf(session_id: str):
-    """Generate a PDF from mapping_documentation.json and return it for download."""
+async def get_mapping_pdf(session_id: str, request: Request):
+    """Mapping documentation as a PDF.
+
+    The PDF is rendered in a worker thread (usually already by the merge job) and cached
+    against the hash of mapping_documentation.json; its ETag lets clients revalidate
+    with If-None-Match and get a 304 instead of the file.
+    """
+    lifecycle.touch(session_id)
     output_dir = OUTPUT_DIR / session_id
-    mapping_doc_path = output_dir / "mapping_documentation.json"
-    if not mapping_doc_path.exists():
+    if not (output_dir / "mapping_documentation.json").exists():
         raise HTTPException(status_code=404, detail="Mapping documentation not found")
 
     if not REPORTLAB_AVAILABLE:
         return JSONResponse({"error": "reportlab is not installed on the server. Install it with 'pip install reportlab' to enable PDF generation."}, status_code=500)
 
-    # Load mapping JSON
-    with open(mapping_doc_path, 'r', encoding='utf-8') as f:
-        mapping = json.load(f)
-
-    # Create PDF in memory
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=letter)
-    width, height = letter
-    margin = 40
-    y = height - margin
-
-    # Title
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(margin, y, f"Mapping Documentation: {session_id}")
-    y -= 24
-
-    # Summary if present
-    summary = mapping.get('summary')
-    if summary:
-        c.setFont("Helvetica", 10)
-        text = c.beginText(margin, y)
-        text.textLines(f"Summary: {summary}")
-        c.drawText(text)
-        y -= 18 + (12 * (str(summary).count('\n') + 1))
-
-    # Table mappings
-    table_mappings = mapping.get('table_mappings', [])
-    c.setFont("Helvetica-Bold", 12)
-    for tm in table_mappings:
-        if y < margin + 80:
-            c.showPage()
-            y = height - margin
-            c.setFont("Helvetica-Bold", 12)
-        src = tm.get('source_table')
-        tgt = tm.get('target_table')
-        c.drawString(margin, y, f"{src} → {tgt}")
-        y -= 16
-        c.setFont("Helvetica", 9)
-        # headers
-        c.drawString(margin + 8, y, "Source Field")
-        c.drawString(margin + 200, y, "Target Field")
-        c.drawString(margin + 360, y, "Confidence")
-        y -= 12
-        for fm in tm.get('field_mappings', []):
-            if y < margin + 40:
-                c.showPage()
-                y = height - margin
-            sf = str(fm.get('source_field', ''))
-            tf = str(fm.get('target_field', ''))
-            conf = fm.get('confidence', '')
-            reasoning = fm.get('reasoning', '')
-            c.drawString(margin + 8, y, sf[:28])
-            c.drawString(margin + 200, y, tf[:28])
-            c.drawString(margin + 360, y, f"{conf}")
-            y -= 12
-            if reasoning:
-                # reasoning may be long; wrap it
-                rt = c.beginText(margin + 12, y)
-                rt.setFont("Helvetica-Oblique", 8)
-                for line in str(reasoning).splitlines():
-                    rt.textLine(line[:90])
-                    y -= 10
-                c.drawText(rt)
-                y -= 4
-        y -= 10
-
-    c.save()
-    buf.seek(0)
-
-    # Write to a temp file and return as FileResponse (FileResponse needs a path)
-    tmp_path = output_dir / "mapping_documentation.pdf"
-    with open(tmp_path, 'wb') as out_f:
-        out_f.write(buf.read())
-
-    return FileResponse(tmp_path, filename="mapping_documentation.pdf", media_type="application/pdf")
+    try:
+        pdf_path, etag = await run_in_threadpool(ensure_mapping_pdf, output_dir, session_id)
+    except FileNotFoundError:
+        # Evicted while we were looking
+        raise HTTPException(status_code=404, detail="Mapping documentation not found")
+
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(pdf_path, filename="mapping_documentation.pdf", media_type="application/pdf", headers=headers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+# mapping_cache.py - Persistent cache of Gemini mapping results keyed by schema fingerprint
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+def _text_hash(text: Optional[str]) -> Optional[str]:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest() if text else None
+
+
+def schema_fingerprint(b1_schema: dict, b2_schema: dict, schema_doc1: Optional[str], schema_doc2: Optional[str], model_name: str) -> str:
+    """Stable hash of everything that determines the mapping result.
+
+    Only table names, column names and dtypes are included - sample values and row
+    counts change every day for the same feed layout and must not bust the cache.
+    """
+    def shape(schema):
+        return {
+            table: {"columns": [str(c) for c in info.get("columns", [])], "dtypes": info.get("dtypes", {})}
+            for table, info in sorted(schema.items())
+        }
+
+    payload = {
+        "b1": shape(b1_schema),
+        "b2": shape(b2_schema),
+        "doc1": _text_hash(schema_doc1),
+        "doc2": _text_hash(schema_doc2),
+        "model": model_name,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class MappingCache:
+    """SQLite-backed store of mappings documents with TTL and LRU eviction."""
+
+    def __init__(self, db_path: Path, ttl_seconds: int, max_entries: int):
+        self.db_path = Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mappings ("
+                " fingerprint TEXT PRIMARY KEY,"
+                " mappings TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT mappings, created_at FROM mappings WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                conn.execute("UPDATE mappings SET last_used = ? WHERE fingerprint = ?", (now, fingerprint))
+                self.hits += 1
+                return json.loads(row[0])
+            if row:
+                conn.execute("DELETE FROM mappings WHERE fingerprint = ?", (fingerprint,))
+            self.misses += 1
+            return None
+
+    def put(self, fingerprint: str, mappings: dict):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO mappings (fingerprint, mappings, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (fingerprint, json.dumps(mappings), now, now),
+            )
+            conn.execute("DELETE FROM mappings WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM mappings WHERE fingerprint NOT IN"
+                " (SELECT fingerprint FROM mappings ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        with self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
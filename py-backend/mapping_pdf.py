@@ -0,0 +1,140 @@
+# mapping_pdf.py - Mapping documentation PDF, cached by the hash of mapping_documentation.json
+import hashlib
+import io
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Tuple
+
+try:
+    # reportlab is optional; if missing, the endpoint will return JSON error asking to install it
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    REPORTLAB_AVAILABLE = True
+except Exception:
+    REPORTLAB_AVAILABLE = False
+
+# Bump when the layout changes so cached PDFs are re-rendered
+PDF_LAYOUT_VERSION = "2"
+MAPPING_DOC_NAME = "mapping_documentation.json"
+
+
+def mapping_digest(mapping_doc_path: Path, session_id: str) -> str:
+    """Cache key of a session's PDF: the mapping JSON bytes, the title and the layout version"""
+    digest = hashlib.sha256(f"{PDF_LAYOUT_VERSION}\0{session_id}\0".encode())
+    digest.update(Path(mapping_doc_path).read_bytes())
+    return digest.hexdigest()
+
+
+def pdf_etag(digest: str) -> str:
+    return f'"{digest[:32]}"'
+
+
+def render_mapping_pdf(mapping: dict, session_id: str) -> bytes:
+    """Lay out the mapping document: title, summary, then one block per table mapping.
+
+    Rows are written through one text object per page instead of one drawString call per
+    cell, which keeps documents with thousands of fields fast to build.
+    """
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=letter)
+    _, height = letter
+    margin = 40
+    y = height - margin
+    text = None
+
+    def flush():
+        nonlocal text
+        if text is not None:
+            c.drawText(text)
+            text = None
+
+    def line(x, font, size, value):
+        nonlocal text
+        if text is None:
+            text = c.beginText()
+        text.setFont(font, size)
+        text.setTextOrigin(x, y)
+        text.textOut(value)
+
+    def new_page():
+        nonlocal y
+        flush()
+        c.showPage()
+        y = height - margin
+
+    # Title
+    line(margin, "Helvetica-Bold", 16, f"Mapping Documentation: {session_id}")
+    y -= 24
+
+    # Summary if present
+    summary = mapping.get('summary')
+    if summary:
+        for summary_line in f"Summary: {summary}".splitlines():
+            line(margin, "Helvetica", 10, summary_line)
+            y -= 12
+        y -= 6
+
+    # Table mappings
+    for tm in mapping.get('table_mappings', []):
+        if y < margin + 80:
+            new_page()
+        line(margin, "Helvetica-Bold", 12, f"{tm.get('source_table')} → {tm.get('target_table')}")
+        y -= 16
+        # headers
+        line(margin + 8, "Helvetica", 9, "Source Field")
+        line(margin + 200, "Helvetica", 9, "Target Field")
+        line(margin + 360, "Helvetica", 9, "Confidence")
+        y -= 12
+        for fm in tm.get('field_mappings', []):
+            if y < margin + 40:
+                new_page()
+            line(margin + 8, "Helvetica", 9, str(fm.get('source_field', ''))[:28])
+            line(margin + 200, "Helvetica", 9, str(fm.get('target_field', ''))[:28])
+            line(margin + 360, "Helvetica", 9, f"{fm.get('confidence', '')}")
+            y -= 12
+            if fm.get('transform'):
+                line(margin + 12, "Courier", 8, f"= {fm['transform']}"[:100])
+                y -= 10
+            reasoning = fm.get('reasoning', '')
+            if reasoning:
+                # reasoning may be long; each line is cut to fit the page width
+                for reasoning_line in str(reasoning).splitlines():
+                    if y < margin:
+                        new_page()
+                    line(margin + 12, "Helvetica-Oblique", 8, reasoning_line[:90])
+                    y -= 10
+                y -= 4
+        y -= 10
+
+    flush()
+    c.save()
+    return buf.getvalue()
+
+
+def ensure_mapping_pdf(output_dir: Path, session_id: str) -> Tuple[Path, str]:
+    """Return (pdf path, ETag) for a session, rendering only if the mapping JSON changed.
+
+    Rendered files are named after the digest they were built from and written atomically,
+    so concurrent renders (e.g. the merge job and a download) cannot serve a torn or stale
+    file. Raises FileNotFoundError if the session has no mapping documentation.
+    """
+    output_dir = Path(output_dir)
+    digest = mapping_digest(output_dir / MAPPING_DOC_NAME, session_id)
+    pdf_path = output_dir / f"mapping_documentation.{digest[:16]}.pdf"
+    if pdf_path.exists():
+        return pdf_path, pdf_etag(digest)
+
+    with open(output_dir / MAPPING_DOC_NAME, 'r', encoding='utf-8') as f:
+        mapping = json.load(f)
+    data = render_mapping_pdf(mapping, session_id)
+    fd, tmp = tempfile.mkstemp(dir=output_dir, suffix=".pdf.tmp")
+    with os.fdopen(fd, "wb") as out:
+        out.write(data)
+    os.replace(tmp, pdf_path)
+    # Renders of earlier mappings are no longer reachable
+    for stale in output_dir.glob("mapping_documentation*.pdf"):
+        if stale != pdf_path:
+            stale.unlink(missing_ok=True)
+    return pdf_path, pdf_etag(digest)
@@ -0,0 +1,211 @@
+# matcher.py - Deterministic local field matcher run before the Gemini mapping call
+import re
+from difflib import SequenceMatcher
+
+import numpy as np
+import pandas as pd
+
+from profiler import reservoir_sample
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_MAX_VALUES = 10_000
+# Columns with fewer distinct values (flags, codes) overlap by accident
+MIN_DISTINCT_FOR_OVERLAP = 20
+
+_rng = np.random.default_rng(20240917)
+_MINHASH_A = _rng.integers(1, np.iinfo(np.int64).max, MINHASH_PERMUTATIONS, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+_MINHASH_B = _rng.integers(0, np.iinfo(np.int64).max, MINHASH_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+
+
+def name_tokens(name) -> tuple:
+    """Split snake_case / camelCase / punctuated names into lowercase tokens."""
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(name))
+    return tuple(t for t in re.split(r"[^0-9a-zA-Z]+", text.lower()) if t)
+
+
+def name_similarity(a: tuple, b: tuple) -> float:
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    sa, sb = set(a), set(b)
+    jaccard = len(sa & sb) / len(sa | sb)
+    matcher = SequenceMatcher(None, "".join(a), "".join(b))
+    # quick_ratio is an upper bound on ratio; skip the expensive part for clear misses
+    ratio = matcher.ratio() if matcher.quick_ratio() >= 0.6 else 0.0
+    return max(jaccard, ratio)
+
+
+def dtype_family(dtype) -> str:
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    return "string"
+
+
+def dtype_compatibility(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    if "string" in (a, b) or {a, b} == {"bool", "numeric"}:
+        # Strings often carry numbers, dates or flags from CSV/Excel exports
+        return 0.7
+    return 0.0
+
+
+def _normalized_values(series: pd.Series) -> np.ndarray:
+    values = series.dropna()
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        # 5, 5.0 and "5.0" should hash alike
+        values = values.astype("float64").round(6)
+    values = values.astype(str).str.strip().str.lower()
+    return values.unique()[:MINHASH_MAX_VALUES]
+
+
+def minhash_signature(series: pd.Series):
+    """MinHash signature over a column's distinct values, or None if too few values."""
+    values = _normalized_values(series)
+    if len(values) < MIN_DISTINCT_FOR_OVERLAP:
+        return None
+    hashes = pd.util.hash_array(np.asarray(values, dtype=object))
+    # Universal hashing (a * h + b mod 2**64), one row per permutation
+    permuted = _MINHASH_A[:, None] * hashes[None, :] + _MINHASH_B[:, None]
+    return permuted.min(axis=1)
+
+
+def table_features(df: pd.DataFrame, sample_rows: int = 50_000):
+    """Per-column name tokens, dtype family and MinHash signature for one table."""
+    sample = df if len(df) <= sample_rows else reservoir_sample([df], sample_rows)
+    return [
+        {
+            "name": col,
+            "tokens": name_tokens(col),
+            "family": dtype_family(df[col].dtype),
+            "minhash": minhash_signature(sample[col]),
+        }
+        for col in df.columns
+    ]
+
+
+def score_table_pair(src_features, tgt_features):
+    """Score matrices (source columns x target columns) in [0, 1]: (combined, name, overlap).
+
+    Name similarity and value overlap are combined as independent evidence
+    (1 - (1 - name) * (1 - overlap)) and scaled by dtype compatibility.
+    """
+    names = np.array([[name_similarity(s["tokens"], t["tokens"]) for t in tgt_features] for s in src_features])
+    dtypes = np.array([[dtype_compatibility(s["family"], t["family"]) for t in tgt_features] for s in src_features])
+
+    overlap = np.zeros_like(names)
+    src_idx = [i for i, s in enumerate(src_features) if s["minhash"] is not None]
+    tgt_idx = [j for j, t in enumerate(tgt_features) if t["minhash"] is not None]
+    if src_idx and tgt_idx:
+        src_sigs = np.stack([src_features[i]["minhash"] for i in src_idx])
+        tgt_sigs = np.stack([tgt_features[j]["minhash"] for j in tgt_idx])
+        jaccard = (src_sigs[:, None, :] == tgt_sigs[None, :, :]).mean(axis=2)
+        overlap[np.ix_(src_idx, tgt_idx)] = jaccard
+
+    return dtypes * (1 - (1 - names) * (1 - overlap)), names, overlap
+
+
+def _greedy_assignment(scores: np.ndarray, threshold: float):
+    """One-to-one assignment of the highest-scoring pairs above threshold."""
+    pairs = []
+    used_src, used_tgt = set(), set()
+    flat = np.argsort(scores, axis=None)[::-1]
+    for i, j in zip(*np.unravel_index(flat, scores.shape)):
+        if scores[i, j] < threshold:
+            break
+        if i in used_src or j in used_tgt:
+            continue
+        used_src.add(i)
+        used_tgt.add(j)
+        pairs.append((int(i), int(j)))
+    return pairs
+
+
+def prematch(bundle1_tables: dict, bundle2_tables: dict, threshold: float = 0.9, min_coverage: float = 0.5):
+    """Match obvious Bundle 1 -> Bundle 2 fields locally, in the table_mappings format.
+
+    A table pair is only accepted when enough of the source table matched
+    (min_coverage) or the table names themselves match, so a lone "id" column does
+    not pull a table into every target that also has an "id".
+    """
+    src_features = {name: table_features(df) for name, df in bundle1_tables.items()}
+    tgt_features = {name: table_features(df) for name, df in bundle2_tables.items()}
+
+    table_mappings = []
+    for src_table, sf in src_features.items():
+        if not sf:
+            continue
+        for tgt_table, tf in tgt_features.items():
+            if not tf:
+                continue
+            scores, names, overlap = score_table_pair(sf, tf)
+            pairs = _greedy_assignment(scores, threshold)
+            if not pairs:
+                continue
+            coverage = len(pairs) / len(sf)
+            same_table_name = name_similarity(name_tokens(src_table), name_tokens(tgt_table)) >= threshold
+            if coverage < min_coverage and not same_table_name:
+                continue
+            table_mappings.append({
+                "source_table": src_table,
+                "target_table": tgt_table,
+                "field_mappings": [
+                    {
+                        "source_field": sf[i]["name"],
+                        "target_field": tf[j]["name"],
+                        "confidence": round(float(scores[i, j]), 3),
+                        "reasoning": f"local match: name {names[i, j]:.2f}, value overlap {overlap[i, j]:.2f}, dtype {sf[i]['family']}/{tf[j]['family']}",
+                        "method": "local"
+                    }
+                    for i, j in pairs
+                ]
+            })
+
+    return {
+        "table_mappings": table_mappings,
+        "summary": f"{sum(len(tm['field_mappings']) for tm in table_mappings)} fields matched locally by name, dtype and value overlap."
+    }
+
+
+def remaining_schema(b1_schema: dict, local_mappings: dict) -> dict:
+    """Bundle 1 schema restricted to the columns the local matcher did not map."""
+    matched = {}
+    for tm in local_mappings.get("table_mappings", []):
+        matched.setdefault(tm["source_table"], set()).update(fm["source_field"] for fm in tm["field_mappings"])
+
+    remaining = {}
+    for table, info in b1_schema.items():
+        done = matched.get(table, set())
+        columns = [c for c in info["columns"] if c not in done]
+        if not columns:
+            continue
+        keep = {str(c) for c in columns}
+        entry = dict(info)
+        entry["columns"] = columns
+        for key in ("dtypes", "profile"):
+            if key in info:
+                entry[key] = {c: v for c, v in info[key].items() if c in keep}
+        remaining[table] = entry
+    return remaining
+
+
+def combine_mappings(local_mappings: dict, llm_mappings: dict) -> dict:
+    """Merge local and model mappings; local field matches win on the same target field."""
+    combined = {}
+    for tm in local_mappings.get("table_mappings", []) + llm_mappings.get("table_mappings", []):
+        key = (tm["source_table"], tm["target_table"])
+        entry = combined.setdefault(key, {"source_table": key[0], "target_table": key[1], "field_mappings": []})
+        taken = {fm["target_field"] for fm in entry["field_mappings"]}
+        entry["field_mappings"].extend(fm for fm in tm.get("field_mappings", []) if fm["target_field"] not in taken)
+
+    summary = " ".join(s for s in (local_mappings.get("summary"), llm_mappings.get("summary")) if s)
+    result = {"table_mappings": list(combined.values()), "summary": summary}
+    unmapped = sorted(set(local_mappings.get("unmapped_tables", [])) | set(llm_mappings.get("unmapped_tables", [])), key=str)
+    if unmapped:
+        result["unmapped_tables"] = unmapped
+    return result
@@ -0,0 +1,635 @@
+# merge_engine.py - Applying table mappings: in-memory and streaming (out-of-core) merges
+import logging
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from ingest import TableSource, as_source, read_sheet
+from profiler import reservoir_sample
+from transforms import compile_transform
+
+try:
+    # pyarrow is optional; only needed for Parquet output
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+# append: add every Bundle 1 row; upsert: update target rows with the same key and insert
+# the rest; skip_existing: insert only rows whose key is not in the target yet
+MERGE_STRATEGIES = ("append", "upsert", "skip_existing")
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_target(mappings):
+    """Table mappings grouped by target table, preserving their order"""
+    by_target = {}
+    for mapping in mappings['table_mappings']:
+        by_target.setdefault(mapping['target_table'], []).append(mapping)
+    return by_target
+
+
+def nullable_dtype(dtype):
+    """Dtype that can hold missing values without changing kind (int64 -> Int64, bool -> boolean)"""
+    if pd.api.types.is_bool_dtype(dtype):
+        return pd.BooleanDtype()
+    if pd.api.types.is_integer_dtype(dtype) and not isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        return pd.api.types.pandas_dtype(str(dtype).replace("u", "U").replace("i", "I", 1))
+    return dtype
+
+
+def frame_bytes(df):
+    """Shallow in-memory size of a DataFrame (buffers only, no per-object walk)"""
+    return int(df.memory_usage(index=False, deep=False).sum())
+
+
+def build_source_block(source_df, field_mappings, verbose: bool = True, timings: Optional[dict] = None):
+    """Rename the mapped source columns into target columns, keeping their dtypes.
+
+    A field mapping with a "transform" expression (see transforms.py) gets the result of
+    the expression over the whole source frame instead. When timings is given, the rows
+    and seconds of every transform are added to it by target field (see transform_stats).
+    """
+    columns = {}
+    for field_map in field_mappings:
+        source_field = field_map['source_field']
+        target_field = field_map['target_field']
+        expression = field_map.get('transform')
+        if expression:
+            started = time.perf_counter()
+            columns[target_field] = compile_transform(expression, source_field)(source_df)
+            if timings is not None:
+                timing = timings.setdefault(target_field, {"transform": expression, "rows": 0, "seconds": 0.0})
+                timing["rows"] += len(source_df)
+                timing["seconds"] += time.perf_counter() - started
+        elif source_field in source_df.columns:
+            columns[target_field] = source_df[source_field].reset_index(drop=True)
+        else:
+            continue
+        if verbose:
+            logger.debug("%s -> %s (%s)", source_field, target_field, field_map.get('confidence', 'N/A'))
+    return pd.DataFrame(columns, index=pd.RangeIndex(len(source_df)))
+
+
+def transform_stats(source_table: str, timings: dict) -> List[dict]:
+    """Per-transform throughput from the timings collected by build_source_block"""
+    return [
+        {
+            "source_table": source_table,
+            "target_field": target_field,
+            "transform": timing["transform"],
+            "rows": timing["rows"],
+            "seconds": round(timing["seconds"], 4),
+            "rows_per_s": round(timing["rows"] / timing["seconds"]) if timing["seconds"] > 0 else None,
+        }
+        for target_field, timing in timings.items()
+    ]
+
+
+def align_block(block, target_columns):
+    """Restrict a block to the target columns, filling the ones it lacks with typed missing values.
+
+    Missing columns use the nullable form of the target dtype so the concatenation does not
+    degrade them to object/float.
+    """
+    index = block.index
+    return pd.DataFrame({
+        col: block[col] if col in block.columns else pd.Series(index=index, dtype=nullable_dtype(dtype))
+        for col, dtype in target_columns.items()
+    }, index=index)
+
+
+def unify_categoricals(frames: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """Give every column that is categorical in some of the frames one dtype in all of them.
+
+    pandas concatenates categoricals with different categories (or a categorical and a
+    string column) as object; a shared dtype with the union of the categories keeps the
+    result compact. Categoricals meeting non-text columns are turned back into values.
+    """
+    dtypes = {}
+    for df in frames:
+        for col, dtype in df.dtypes.items():
+            dtypes.setdefault(col, []).append(dtype)
+    shared = {}
+    for col, col_dtypes in dtypes.items():
+        if not any(isinstance(d, pd.CategoricalDtype) for d in col_dtypes) or all(d == col_dtypes[0] for d in col_dtypes):
+            continue
+        if all(isinstance(d, pd.CategoricalDtype) or pd.api.types.is_string_dtype(d) for d in col_dtypes):
+            values = [df[col].cat.categories if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].dropna().unique()
+                      for df in frames if col in df.columns]
+            shared[col] = pd.CategoricalDtype(pd.unique(np.concatenate([np.asarray(v, dtype=object) for v in values])))
+        else:
+            shared[col] = None
+    if not shared:
+        return frames
+    unified = []
+    for df in frames:
+        casts = {}
+        for col, dtype in shared.items():
+            if col not in df.columns:
+                continue
+            if dtype is not None:
+                casts[col] = dtype
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                casts[col] = df[col].cat.categories.dtype
+        unified.append(df.astype(casts) if casts else df)
+    return unified
+
+
+def key_fields_by_target(mappings, overrides: Optional[Dict[str, List[str]]] = None) -> Dict[str, List[str]]:
+    """Key fields per target table: field mappings marked "key": true, unless overridden"""
+    keys = {}
+    for mapping in mappings['table_mappings']:
+        for field_map in mapping['field_mappings']:
+            if field_map.get('key'):
+                fields = keys.setdefault(mapping['target_table'], [])
+                if field_map['target_field'] not in fields:
+                    fields.append(field_map['target_field'])
+    keys.update(overrides or {})
+    return keys
+
+
+def normalize_key(series: pd.Series) -> pd.Series:
+    """Key values as strings that compare equal across dtypes (1, 1.0 and "1" are one key)"""
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        values = series.dropna()
+        if len(values) == 0 or (values == np.floor(values)).all():
+            return series.astype("Int64").astype("string")
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime("%Y-%m-%dT%H:%M:%S.%f").astype("string")
+    return series.astype("string").str.strip()
+
+
+def key_frame(df: pd.DataFrame, key_fields: List[str], normalize: bool) -> pd.DataFrame:
+    keys = df[key_fields]
+    if normalize:
+        keys = pd.DataFrame({col: normalize_key(keys[col]) for col in key_fields}, index=df.index)
+    return keys
+
+
+def hash_keys(keys: pd.DataFrame):
+    """(uint64 hash per row, mask of rows with a missing key part)"""
+    if len(keys.columns) == 1 and keys.dtypes.iloc[0].kind in "iu":
+        # A plain integer key is its own (collision-free) hash; unlike real hashes it keeps
+        # the locality of sequential ids, which makes the sort in hash_codes much cheaper
+        return keys.iloc[:, 0].to_numpy().astype(np.int64, copy=False).view(np.uint64), np.zeros(len(keys), dtype=bool)
+    # categorize=False: keys are mostly distinct, so factorizing before hashing only costs
+    hashes = pd.util.hash_pandas_object(keys, index=False, categorize=False).to_numpy()
+    return hashes, keys.isna().any(axis=1).to_numpy()
+
+
+def hash_codes(hashes: np.ndarray):
+    """Dense group codes for hash values (like pd.factorize), and the number of groups.
+
+    Sorting beats a hash table here: random 64-bit hashes defeat the CPU cache, and the
+    unstable sort is enough because callers only need equal values to share a code.
+    """
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    order = np.argsort(hashes)
+    ordered = hashes[order]
+    starts = np.empty(len(hashes), dtype=bool)
+    starts[0] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=starts[1:])
+    codes = np.empty(len(hashes), dtype=np.int64)
+    codes[order] = np.cumsum(starts) - 1
+    return codes, int(starts.sum())
+
+
+def changed_values(source: pd.Series, target: pd.Series) -> np.ndarray:
+    """Rows where the source has a value that the target lacks or holds differently"""
+    try:
+        differs = source.ne(target)
+    except TypeError:
+        differs = source.astype("string").ne(target.astype("string"))
+    differs = differs.fillna(True).to_numpy(dtype=bool) if differs.dtype != bool else differs.to_numpy()
+    return source.notna().to_numpy() & (target.isna().to_numpy() | differs)
+
+
+def keyed_merge(target_df: Optional[pd.DataFrame], source_df: pd.DataFrame, key_fields: List[str], strategy: str):
+    """Merge source rows into the target by key; returns (merged frame, counts).
+
+    Keys (one or more columns) are reduced to 64-bit hashes and indexed once, and every
+    source row is resolved against the index with vectorized array operations. Matched
+    rows are updated (upsert; only non-missing source values overwrite) or skipped
+    (skip_existing); the rest are inserted. Duplicate keys within the source are
+    collapsed first (the last row wins for upsert, the first for skip_existing);
+    duplicate keys already in the target are counted and left alone, matches go to the
+    first of them. Rows with a missing key part cannot match and are inserted. Target
+    matches are confirmed on the key values, so a hash collision never updates the
+    wrong row.
+    """
+    if target_df is None:
+        target_df = source_df.iloc[0:0]
+    counts = {
+        "strategy": strategy, "key_fields": list(key_fields), "inserted": 0, "updated": 0, "unchanged": 0,
+        "skipped": 0, "conflicts": 0, "source_duplicates": 0, "target_duplicates": 0, "null_keys": 0,
+    }
+    missing = [k for k in key_fields if k not in target_df.columns or k not in source_df.columns]
+    if missing:
+        raise ValueError(f"key field(s) {', '.join(missing)} not in the merged table")
+
+    # Hash the native values when both sides agree on dtypes, else a normalized form
+    normalize = any(target_df[k].dtype != source_df[k].dtype for k in key_fields)
+    target_keys = key_frame(target_df, key_fields, normalize)
+    source_keys = key_frame(source_df, key_fields, normalize)
+    target_hash, target_null = hash_keys(target_keys)
+    source_hash, source_null = hash_keys(source_keys)
+
+    # Both sides are coded together: equal keys get equal codes, and first/last
+    # occurrences and target matches fall out of scatter writes indexed by code
+    codes, groups = hash_codes(np.concatenate([target_hash, source_hash]))
+    target_codes, source_codes = codes[:len(target_df)], codes[len(target_df):]
+    target_rows = np.flatnonzero(~target_null)
+    first_in_target = np.full(groups, -1, dtype=np.int64)
+    first_in_target[target_codes[target_rows[::-1]]] = target_rows[::-1]
+    counts["target_duplicates"] = int((first_in_target[target_codes[target_rows]] != target_rows).sum())
+
+    source_rows = np.flatnonzero(~source_null)
+    kept = np.full(groups, -1, dtype=np.int64)
+    if strategy == "upsert":
+        kept[source_codes[source_rows]] = source_rows
+    else:
+        kept[source_codes[source_rows[::-1]]] = source_rows[::-1]
+    lookup = source_rows[kept[source_codes[source_rows]] == source_rows]
+    source_dup = np.ones(len(source_df), dtype=bool)
+    source_dup[lookup] = False
+    source_dup &= ~source_null
+    counts["source_duplicates"] = int(source_dup.sum())
+    counts["null_keys"] = int(source_null.sum())
+    found = first_in_target[source_codes[lookup]]
+    matched = lookup[found >= 0]
+    target_pos = found[found >= 0]
+
+    same_key = np.ones(len(matched), dtype=bool)
+    for col in key_fields:
+        source_values = source_keys[col].iloc[matched].reset_index(drop=True)
+        target_values = target_keys[col].iloc[target_pos].reset_index(drop=True)
+        same_key &= source_values.eq(target_values).to_numpy(dtype=bool, na_value=False)
+    matched, target_pos = matched[same_key], target_pos[same_key]
+    insert = np.ones(len(source_df), dtype=bool)
+    insert[source_dup] = False
+    insert[matched] = False
+
+    changed = np.zeros(len(matched), dtype=bool)
+    updates = {}
+    for col in target_df.columns:
+        if col in key_fields or col not in source_df.columns:
+            continue
+        source_values = source_df[col].iloc[matched].reset_index(drop=True)
+        target_values = target_df[col].iloc[target_pos].reset_index(drop=True)
+        differs = changed_values(source_values, target_values)
+        changed |= differs
+        updates[col] = (source_values, target_values, differs)
+    counts["conflicts"] = int(changed.sum())
+    counts["unchanged"] = len(matched) - counts["conflicts"]
+    inserted = source_df.iloc[np.flatnonzero(insert)]
+    counts["inserted"] = len(inserted)
+
+    if strategy != "upsert" or not changed.any():
+        if strategy != "upsert":
+            counts["skipped"] = len(matched)
+        merged = pd.concat([target_df, inserted], ignore_index=True) if len(inserted) else target_df.reset_index(drop=True)
+        return merged, counts
+
+    # Updated rows are rebuilt and swapped in for the originals with one concat + take,
+    # which keeps the target's row order and lets concat settle the column dtypes
+    rows = np.flatnonzero(changed)
+    updated = {}
+    for col in target_df.columns:
+        if col in updates:
+            source_values, target_values, differs = updates[col]
+            updated[col] = target_values.iloc[rows].mask(differs[rows], source_values.iloc[rows]).reset_index(drop=True)
+        else:
+            updated[col] = target_df[col].iloc[target_pos[rows]].reset_index(drop=True)
+    updated = pd.DataFrame(updated, index=pd.RangeIndex(len(rows)))
+    counts["updated"] = len(updated)
+
+    combined = pd.concat([target_df, updated, inserted], ignore_index=True)
+    order = np.arange(len(combined))
+    order[target_pos[rows]] = len(target_df) + np.arange(len(updated))
+    order = np.delete(order, np.arange(len(target_df), len(target_df) + len(updated)))
+    return combined.take(order).reset_index(drop=True), counts
+
+
+class KeyIndex:
+    """Growing set of key hashes for streaming merges, kept as one sorted array.
+
+    Additions are merged in with a stable sort, which runs in linear time on the two
+    already-sorted runs.
+    """
+
+    def __init__(self):
+        self.hashes = np.zeros(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        if not len(self.hashes):
+            return np.zeros(len(hashes), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return self.hashes[pos] == hashes
+
+    def add(self, hashes: np.ndarray):
+        if len(hashes):
+            self.hashes = np.sort(np.concatenate([self.hashes, np.unique(hashes)]), kind="stable")
+
+
+def apply_mappings(bundle1_tables, bundle2_tables, mappings, stats: Optional[dict] = None,
+                   strategy: str = "append", key_fields: Optional[Dict[str, List[str]]] = None):
+    """Transform Bundle 1 data and merge into Bundle 2.
+
+    Mappings are grouped by target table; every source block is built once and each
+    target is assembled with a single concatenation. With strategy "upsert" or
+    "skip_existing", targets that have key fields (see key_fields_by_target) are merged
+    by key instead (see keyed_merge); the others are appended to. When stats is given it
+    is filled with per-target timings, an estimate of peak memory (inputs + result) and
+    the keyed merge counts, and the throughput of every field transform.
+    """
+    keys_by_target = key_fields_by_target(mappings, key_fields) if strategy != "append" else {}
+    
+    by_target = group_by_target(mappings)
+
+    merged_tables = {}
+    for table_name, df in bundle2_tables.items():
+        if table_name not in by_target:
+            merged_tables[table_name] = df.copy()
+
+    for target_table, table_mappings in by_target.items():
+        started = time.perf_counter()
+        target_df = bundle2_tables.get(target_table)
+        if target_df is None:
+            logger.info("Target table '%s' not found, creating new", target_table)
+        blocks = []
+        transforms = []
+        for mapping in table_mappings:
+            source_table = mapping['source_table']
+            if source_table not in bundle1_tables:
+                logger.warning("Source table '%s' not found, skipping", source_table)
+                continue
+            timings = {}
+            blocks.append(build_source_block(bundle1_tables[source_table], mapping['field_mappings'], timings=timings))
+            transforms.extend(transform_stats(source_table, timings))
+            logger.info("Mapped %s -> %s: %d rows", source_table, target_table, len(blocks[-1]))
+
+        # Existing targets keep their schema; new targets take the union of mapped fields
+        if target_df is not None and len(target_df.columns) > 0:
+            target_columns = dict(target_df.dtypes.items())
+        else:
+            target_columns = {}
+            for block in blocks:
+                for col, dtype in block.dtypes.items():
+                    target_columns.setdefault(col, dtype)
+        blocks = [align_block(block, target_columns) for block in blocks]
+
+        parts = unify_categoricals(([target_df] if target_df is not None else []) + blocks)
+        if target_df is not None:
+            target_df, blocks = parts[0], parts[1:]
+        else:
+            blocks = parts
+        keyed = None
+        if keys_by_target.get(target_table) and blocks:
+            source_df = pd.concat(blocks, ignore_index=True) if len(blocks) > 1 else blocks[0]
+            merged_tables[target_table], keyed = keyed_merge(target_df, source_df, keys_by_target[target_table], strategy)
+            logger.info("Keyed merge into %s: %d inserted, %d updated, %d skipped, %d duplicates, %d conflicts",
+                        target_table, keyed["inserted"], keyed["updated"], keyed["skipped"],
+                        keyed["source_duplicates"], keyed["conflicts"])
+        elif not parts:
+            merged_tables[target_table] = pd.DataFrame()
+        elif len(parts) == 1:
+            merged_tables[target_table] = parts[0].copy()
+        else:
+            merged_tables[target_table] = pd.concat(parts, ignore_index=True)
+
+        if stats is not None:
+            merged = merged_tables[target_table]
+            stats[target_table] = {
+                "seconds": round(time.perf_counter() - started, 4),
+                "source_blocks": len(blocks),
+                "rows_added": keyed["inserted"] if keyed else sum(len(b) for b in blocks),
+                "peak_bytes_estimate": sum(frame_bytes(p) for p in parts) + frame_bytes(merged)
+            }
+            if keyed is not None:
+                stats[target_table]["keyed"] = keyed
+            if transforms:
+                stats[target_table]["transforms"] = transforms
+    
+    return merged_tables
+
+
+def iter_table_chunks(source: Union[str, TableSource], chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Read a table (a path or TableSource) in chunks of at most chunk_rows. Excel cannot be
+    read incrementally, so sheets (capped at ~1M rows by the format) come as one chunk."""
+    source = as_source(source)
+    if source.is_csv:
+        with pd.read_csv(source.path, chunksize=chunk_rows) as reader:
+            yield from reader
+    else:
+        yield read_sheet(source)
+
+
+def sample_table(file_path: Union[str, TableSource], sample_rows: int, chunk_rows: int, seed: int = 0):
+    """Reservoir sample of a table plus its exact row count, in bounded memory"""
+    row_count = 0
+
+    def counted():
+        nonlocal row_count
+        for chunk in iter_table_chunks(file_path, chunk_rows):
+            row_count += len(chunk)
+            yield chunk
+
+    sample = reservoir_sample(counted(), sample_rows, seed)
+    return sample, row_count
+
+
+class TableSink:
+    """Appends DataFrame chunks as CSV or Parquet to a binary file handle (e.g. an archive entry)"""
+
+    def __init__(self, out, fmt: str = "csv"):
+        if fmt == "parquet" and not PYARROW_AVAILABLE:
+            raise RuntimeError("pyarrow is required for Parquet output")
+        self.out = out
+        self.fmt = fmt
+        self.rows = 0
+        self._started = False
+        self._parquet = None
+        self._schema = None
+
+    def write(self, df: pd.DataFrame):
+        if self.fmt == "parquet":
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            if self._parquet is None:
+                self._schema = table.schema
+                self._parquet = pq.ParquetWriter(self.out, self._schema, compression="zstd")
+            self._parquet.write_table(table)
+        else:
+            self.out.write(df.to_csv(index=False, header=not self._started).encode("utf-8"))
+        self._started = True
+        self.rows += len(df)
+
+    def close(self, columns: Optional[List[str]] = None):
+        """Finish the output; a sink that never received rows still gets a header/schema."""
+        if not self._started:
+            self.write(pd.DataFrame(columns=columns or []))
+        if self._parquet is not None:
+            self._parquet.close()
+        self.out.close()
+
+
+def write_frame(out, df: pd.DataFrame, fmt: str = "csv", chunk_rows: int = 100_000):
+    """Serialize a whole DataFrame to a binary handle in bounded slices, then close it"""
+    sink = TableSink(out, fmt)
+    for start in range(0, len(df), chunk_rows):
+        sink.write(df.iloc[start:start + chunk_rows])
+    sink.close(columns=list(df.columns))
+
+
+def target_schemas(bundle1_samples: Dict[str, pd.DataFrame], bundle2_samples: Dict[str, pd.DataFrame], mappings: dict):
+    """Column dtypes of every output table: Bundle 2 tables keep theirs, new targets take
+    the union of their mapped fields (typed from the Bundle 1 samples)"""
+    schemas = {name: dict(df.dtypes.items()) for name, df in bundle2_samples.items()}
+    for target_table, table_mappings in group_by_target(mappings).items():
+        if schemas.get(target_table):
+            continue
+        columns = schemas.setdefault(target_table, {})
+        for mapping in table_mappings:
+            sample = bundle1_samples.get(mapping['source_table'])
+            if sample is not None:
+                for col, dtype in build_source_block(sample, mapping['field_mappings'], verbose=False).dtypes.items():
+                    columns.setdefault(col, dtype)
+    return schemas
+
+
+def stream_merge(bundle1_paths: Dict[str, Union[str, TableSource]], bundle2_paths: Dict[str, Union[str, TableSource]], target_dtypes: Dict[str, dict],
+                 mappings: dict, archive, chunk_rows: int, fmt: str = "csv", progress: Optional[Callable[..., None]] = None,
+                 strategy: str = "append", key_fields: Optional[Dict[str, List[str]]] = None):
+    """Merge without holding whole tables in memory.
+
+    Every target table is written chunk by chunk into its archive entry: first its own
+    Bundle 2 rows, then the mapped Bundle 1 chunks aligned to its schema (target_dtypes,
+    see target_schemas). Row counts are accumulated as chunks pass through, and
+    progress(table=..., rows=...) is called after every chunk with the total rows
+    written so far. Returns (output_files, table_details) in the same shape as the
+    in-memory summary.
+
+    Only the "append" and "skip_existing" strategies can stream (an upsert would have to
+    rewrite target rows already written). For skip_existing, targets with key fields
+    keep a KeyIndex of the key hashes written so far and drop Bundle 1 rows whose key
+    is already there; values are not compared, so conflicts are not counted.
+    """
+    if strategy == "upsert":
+        raise ValueError("the upsert strategy needs the in-memory merge mode")
+    by_target = group_by_target(mappings)
+    keys_by_target = key_fields_by_target(mappings, key_fields) if strategy != "append" else {}
+    output_files = []
+    table_details = {}
+    extension = "parquet" if fmt == "parquet" else "csv"
+    rows_written = 0
+
+    def advance(table, rows):
+        nonlocal rows_written
+        rows_written += rows
+        if progress is not None:
+            progress(table=table, rows=rows_written)
+
+    for target_table in list(bundle2_paths) + [t for t in by_target if t not in bundle2_paths]:
+        started = time.perf_counter()
+        output_name = f"merged_{target_table}.{extension}"
+        target_path = bundle2_paths.get(target_table)
+        table_mappings = by_target.get(target_table, [])
+
+        if not table_mappings and target_path and as_source(target_path).is_csv and fmt == "csv":
+            # Untouched CSV target: copy the bytes, no parsing needed
+            archive.add_file(output_name, as_source(target_path).path)
+            output_files.append(output_name)
+            target_rows = sum(len(c) for c in iter_table_chunks(target_path, chunk_rows))
+            advance(target_table, target_rows)
+            table_details[target_table] = {
+                "total_rows": target_rows,
+                "rows_from_bundle1": 0,
+                "columns": len(target_dtypes.get(target_table, {}))
+            }
+            continue
+
+        target_columns = target_dtypes.get(target_table, {})
+        sink = TableSink(archive.open_entry(output_name, compress=fmt == "csv"), fmt)
+        peak_chunk_bytes = 0
+        target_rows = 0
+        key_fields_here = keys_by_target.get(target_table) if table_mappings else None
+        if key_fields_here:
+            missing = [k for k in key_fields_here if k not in target_columns]
+            if missing:
+                raise ValueError(f"key field(s) {', '.join(missing)} not in {target_table}")
+            # Chunks may infer different dtypes, so keys are always hashed normalized
+            target_index, source_index = KeyIndex(), KeyIndex()
+            keyed = {
+                "strategy": strategy, "key_fields": list(key_fields_here), "inserted": 0, "skipped": 0,
+                "source_duplicates": 0, "target_duplicates": 0, "null_keys": 0,
+            }
+        if target_path:
+            for chunk in iter_table_chunks(target_path, chunk_rows):
+                chunk = chunk.reindex(columns=list(target_columns))
+                if key_fields_here:
+                    hashes, null = hash_keys(key_frame(chunk, key_fields_here, normalize=True))
+                    hashes = hashes[~null]
+                    keyed["target_duplicates"] += int(
+                        (target_index.contains(hashes) | pd.Series(hashes).duplicated().to_numpy()).sum())
+                    target_index.add(hashes)
+                sink.write(chunk)
+                target_rows += len(chunk)
+                advance(target_table, len(chunk))
+                peak_chunk_bytes = max(peak_chunk_bytes, frame_bytes(chunk))
+
+        source_chunks = 0
+        transforms = []
+        for mapping in table_mappings:
+            source_path = bundle1_paths.get(mapping['source_table'])
+            if source_path is None:
+                logger.warning("Source table '%s' not found, skipping", mapping['source_table'])
+                continue
+            logger.info("Streaming %s -> %s", mapping['source_table'], target_table)
+            timings = {}
+            for chunk in iter_table_chunks(source_path, chunk_rows):
+                block = align_block(build_source_block(chunk, mapping['field_mappings'], verbose=False, timings=timings), target_columns)
+                if key_fields_here:
+                    hashes, null = hash_keys(key_frame(block, key_fields_here, normalize=True))
+                    existing = target_index.contains(hashes) & ~null
+                    duplicate = (source_index.contains(hashes) | pd.Series(hashes).duplicated().to_numpy()) & ~null & ~existing
+                    keep = ~existing & ~duplicate
+                    keyed["skipped"] += int(existing.sum())
+                    keyed["source_duplicates"] += int(duplicate.sum())
+                    keyed["null_keys"] += int(null.sum())
+                    keyed["inserted"] += int(keep.sum())
+                    source_index.add(hashes[keep & ~null])
+                    block = block[keep]
+                sink.write(block)
+                source_chunks += 1
+                advance(target_table, len(block))
+                peak_chunk_bytes = max(peak_chunk_bytes, frame_bytes(chunk) + frame_bytes(block))
+            transforms.extend(transform_stats(mapping['source_table'], timings))
+
+        sink.close(columns=list(target_columns))
+        output_files.append(output_name)
+        table_details[target_table] = {
+            "total_rows": sink.rows,
+            "rows_from_bundle1": sink.rows - target_rows,
+            "columns": len(target_columns),
+            "merge": {
+                "seconds": round(time.perf_counter() - started, 4),
+                "source_chunks": source_chunks,
+                "rows_added": sink.rows - target_rows,
+                "peak_bytes_estimate": peak_chunk_bytes
+            }
+        }
+        if key_fields_here:
+            table_details[target_table]["merge"]["keyed"] = keyed
+        if transforms:
+            table_details[target_table]["merge"]["transforms"] = transforms
+        logger.info("%s: %d rows written (%d from Bundle 1)", target_table, sink.rows, sink.rows - target_rows)
+
+    return output_files, table_details
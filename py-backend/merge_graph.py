@@ -0,0 +1,171 @@
+# merge_graph.py - Dependency graph of a merge (files -> tables -> mappings -> outputs) for incremental re-merges
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ingest import TableSource
+from parse_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "merge_manifest.json"
+# Bump when the meaning of a hash changes so older manifests are ignored
+MANIFEST_VERSION = 2
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def table_shape(info: dict) -> str:
+    """What mappings depend on in a table schema: column names and dtypes (as in schema_fingerprint)"""
+    return digest({"columns": [str(c) for c in info.get("columns", [])], "dtypes": info.get("dtypes", {})})
+
+
+def load_manifest(output_dir: Path) -> Optional[dict]:
+    path = Path(output_dir) / MANIFEST_NAME
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable merge manifest %s: %s", path, e)
+        return None
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+class MergeGraph:
+    """The inputs of every node of a merge, and which nodes the previous merge can supply.
+
+    files -> tables: a table is identified by the SHA-256 of its file (all sheets of a
+    workbook share it); its schema is reused while the file and the profiling settings
+    are unchanged.
+    tables -> mappings: the mappings of a Bundle 1 table are reused while its shape and
+    the mapping context (Bundle 2 shapes, schema docs, model) are unchanged.
+    mappings -> outputs: an output table hashes its Bundle 2 file, its source files,
+    their field mappings and the merge options; when that matches the previous merge
+    the archived entry is copied instead of rebuilt.
+    """
+
+    def __init__(self, previous: Optional[dict], bundles: Dict[str, Dict[str, TableSource]], hashes: Dict[str, str], profile_key: str):
+        self.previous = previous or {}
+        self.profile_key = profile_key
+        hashes = dict(hashes)
+        self.tables = {}
+        for bundle, sources in bundles.items():
+            self.tables[bundle] = {}
+            for name, source in sources.items():
+                if source.path not in hashes:
+                    hashes[source.path] = file_sha256(source.path)
+                self.tables[bundle][name] = {"path": source.path, "sheet": source.sheet, "hash": hashes[source.path]}
+        self.schemas = {bundle: {} for bundle in bundles}
+        self.mapping_context = None
+        self.mappings = None
+        self.outputs = {}
+
+    # files -> tables ----------------------------------------------------------------
+
+    def reusable_schema(self, bundle: str, table: str) -> Optional[dict]:
+        if self.previous.get("profile_key") != self.profile_key:
+            return None
+        previous = self.previous.get("tables", {}).get(bundle, {}).get(table)
+        if previous is None or previous["hash"] != self.tables[bundle][table]["hash"]:
+            return None
+        return previous["schema"]
+
+    def source(self, bundle: str, table: str) -> TableSource:
+        node = self.tables[bundle][table]
+        return TableSource(node["path"], node["sheet"])
+
+    def set_schema(self, bundle: str, table: str, info: dict):
+        self.schemas[bundle][table] = info
+
+    def drop(self, bundle: str, table: str):
+        """Forget a table that could not be loaded"""
+        self.tables[bundle].pop(table, None)
+        self.schemas[bundle].pop(table, None)
+
+    # tables -> mappings -------------------------------------------------------------
+
+    def reusable_mappings(self, context: str) -> Dict[str, list]:
+        """Previous table mappings of every Bundle 1 table that needs no new mapping, by source"""
+        self.mapping_context = context
+        if self.previous.get("mapping_context") != context:
+            return {}
+        previous_tables = self.previous.get("tables", {}).get("bundle1", {})
+        previous_mappings = self.previous.get("mappings", {})
+        unmapped = set(previous_mappings.get("unmapped_tables", []))
+        reused = {}
+        for table, info in self.schemas["bundle1"].items():
+            previous = previous_tables.get(table)
+            if table in unmapped or previous is None or table_shape(previous["schema"]) != table_shape(info):
+                continue
+            reused[table] = [tm for tm in previous_mappings.get("table_mappings", []) if tm["source_table"] == table]
+        return reused
+
+    def set_mappings(self, reused: Dict[str, list], fresh: Optional[dict]) -> dict:
+        """The mappings document of this merge: reused entries plus the newly built ones"""
+        base = fresh if fresh is not None else {k: v for k, v in self.previous.get("mappings", {}).items() if k != "unmapped_tables"}
+        fresh_entries = (fresh or {}).get("table_mappings", [])
+        table_mappings = []
+        for table in self.schemas["bundle1"]:
+            table_mappings.extend(reused.get(table, []))
+            table_mappings.extend(tm for tm in fresh_entries if tm["source_table"] == table)
+        # Entries naming an unknown source are kept; apply_mappings skips them with a warning
+        table_mappings.extend(tm for tm in fresh_entries if tm["source_table"] not in self.schemas["bundle1"])
+        self.mappings = {**base, "table_mappings": table_mappings}
+        return self.mappings
+
+    # mappings -> outputs ------------------------------------------------------------
+
+    def output_hash(self, target: str, table_mappings: List[dict], options: dict) -> str:
+        return digest({
+            "target": self.tables["bundle2"].get(target, {}).get("hash"),
+            "sources": [
+                [tm["source_table"], self.tables["bundle1"].get(tm["source_table"], {}).get("hash"), tm.get("field_mappings")]
+                for tm in table_mappings
+            ],
+            "options": options,
+        })
+
+    def reusable_output(self, target: str, output_hash: str) -> Optional[dict]:
+        previous = self.previous.get("outputs", {}).get(target)
+        if previous is None or previous["hash"] != output_hash:
+            return None
+        return previous
+
+    def set_output(self, target: str, output_hash: str, entry: str, details: dict):
+        self.outputs[target] = {"hash": output_hash, "entry": entry, "crc": None, "details": details}
+
+    def save(self, output_dir: Path, zip_path: Path):
+        """Write the manifest once the archive it describes is in place"""
+        with zipfile.ZipFile(zip_path) as zf:
+            crcs = {info.filename: info.CRC for info in zf.infolist()}
+        for output in self.outputs.values():
+            output["crc"] = crcs.get(output["entry"])
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "created_at": time.time(),
+            "profile_key": self.profile_key,
+            "tables": {
+                bundle: {
+                    name: {**node, "schema": self.schemas[bundle][name]}
+                    for name, node in tables.items() if name in self.schemas[bundle]
+                }
+                for bundle, tables in self.tables.items()
+            },
+            "mapping_context": self.mapping_context,
+            "mappings": self.mappings,
+            "outputs": self.outputs,
+        }
+        fd, tmp = tempfile.mkstemp(dir=output_dir, suffix=".json.tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, default=str)
+        os.replace(tmp, Path(output_dir) / MANIFEST_NAME)
@@ -0,0 +1,114 @@
+# parse_cache.py - Content-addressed columnar cache for parsed upload tables
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+try:
+    # pyarrow is optional; without it the cache is disabled and tables are parsed every time
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+
+def file_sha256(path, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file on disk in bounded chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TableCache:
+    """Arrow IPC files keyed by content hash, memory-mapped on read.
+
+    Entries are shared across sessions: the same bytes uploaded twice are parsed once.
+    The directory is kept under max_bytes by evicting the least recently used entries
+    (recency is tracked through the file mtime, which is bumped on every hit).
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.enabled = PYARROW_AVAILABLE and max_bytes > 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.arrow"
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with pa.memory_map(str(path), "r") as source:
+                table = pa_ipc.open_file(source).read_all()
+            os.utime(path)
+        except (FileNotFoundError, pa.ArrowInvalid, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return table.to_pandas()
+
+    def put(self, key: str, df: pd.DataFrame) -> bool:
+        """Store a DataFrame; returns False if it cannot be represented in Arrow."""
+        if not self.enabled:
+            return False
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # Mixed-type object columns (common in Excel exports) have no Arrow type
+            return False
+
+        path = self._path(key)
+        tmp_path = self.cache_dir / f".{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            with pa.OSFile(str(tmp_path), "wb") as sink:
+                with pa_ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        self.evict()
+        return True
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for p in self.cache_dir.glob("*.arrow"):
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+            total = sum(size for _, size, _ in entries)
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                p.unlink(missing_ok=True)
+                total -= size
+
+    def stats(self):
+        files = list(self.cache_dir.glob("*.arrow")) if self.enabled else []
+        return {
+            "enabled": self.enabled,
+            "entries": len(files),
+            "bytes": sum(p.stat().st_size for p in files if p.exists()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,139 @@
+# profiler.py - Vectorized column profiling for schema analysis
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+# HyperLogLog precision: 2**12 registers, ~1.6% standard error
+HLL_PRECISION = 12
+
+
+def reservoir_sample(chunks: Iterable[pd.DataFrame], k: int, seed: int = 0) -> pd.DataFrame:
+    """Uniform sample of k rows from a stream of DataFrame chunks in bounded memory.
+
+    Every row gets a random key and the k smallest keys seen so far are kept, which is
+    equivalent to classic reservoir sampling but vectorized per chunk.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    keys = np.empty(0)
+    for chunk in chunks:
+        if len(chunk) == 0:
+            if reservoir is None:
+                reservoir = chunk
+            continue
+        chunk_keys = rng.random(len(chunk))
+        if reservoir is None or len(reservoir) == 0:
+            combined, combined_keys = chunk, chunk_keys
+        else:
+            combined = pd.concat([reservoir, chunk], ignore_index=True)
+            combined_keys = np.concatenate([keys, chunk_keys])
+        if len(combined) > k:
+            keep = np.argpartition(combined_keys, k)[:k]
+            keep.sort()
+            combined = combined.iloc[keep].reset_index(drop=True)
+            combined_keys = combined_keys[keep]
+        reservoir, keys = combined, combined_keys
+    return reservoir if reservoir is not None else pd.DataFrame()
+
+
+def approx_distinct(series: pd.Series, precision: int = HLL_PRECISION) -> int:
+    """HyperLogLog estimate of the number of distinct non-null values."""
+    values = series.dropna()
+    if len(values) == 0:
+        return 0
+    m = 1 << precision
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+    idx = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    # Position of the leftmost 1-bit in the remaining (64 - p) bits
+    bit_length = np.zeros(len(rest), dtype=np.int64)
+    nonzero = rest > 0
+    bit_length[nonzero] = np.floor(np.log2(rest[nonzero].astype(np.float64))).astype(np.int64) + 1
+    rank = (64 - precision) - bit_length + 1
+
+    registers = np.zeros(m, dtype=np.int64)
+    np.maximum.at(registers, idx, rank)
+
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -registers))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        # Small-range correction (linear counting)
+        estimate = m * np.log(m / zeros)
+    return int(min(round(estimate), len(values)))
+
+
+def value_patterns(series: pd.Series, top_k: int = 3, max_len: int = 24):
+    """Most common shape signatures: letters -> A/a, digits -> 9, punctuation kept."""
+    values = series.dropna().astype(str).str.slice(0, max_len)
+    if len(values) == 0:
+        return []
+    shapes = (
+        values.str.replace(r"[A-Z]", "A", regex=True)
+        .str.replace(r"[a-z]", "a", regex=True)
+        .str.replace(r"[0-9]", "9", regex=True)
+    )
+    counts = shapes.value_counts(normalize=True).head(top_k)
+    return [[pattern, round(float(share), 3)] for pattern, share in counts.items()]
+
+
+def _json_scalar(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (int, float, bool, str)):
+        return value
+    return str(value)
+
+
+def profile_column(full: pd.Series, sample: pd.Series, top_k: int = 5) -> dict:
+    """Profile one column; cheap vectorized stats use the full column, the rest the sample."""
+    row_count = len(full)
+    null_count = int(full.isna().sum())
+    profile = {
+        "dtype": str(full.dtype),
+        "null_ratio": round(null_count / row_count, 4) if row_count else 0.0,
+        "approx_distinct": approx_distinct(full),
+    }
+
+    is_ordered = (
+        pd.api.types.is_numeric_dtype(full)
+        or pd.api.types.is_datetime64_any_dtype(full)
+    ) and not pd.api.types.is_bool_dtype(full)
+    try:
+        source = full if is_ordered else sample.dropna().astype(str)
+        profile["min"] = _json_scalar(source.min()) if len(source) else None
+        profile["max"] = _json_scalar(source.max()) if len(source) else None
+    except TypeError:
+        profile["min"] = profile["max"] = None
+
+    # Values seen once in the sample carry no signal (ids, measurements)
+    top = sample.value_counts(dropna=True).head(top_k)
+    profile["top_values"] = [[_json_scalar(v), int(c)] for v, c in top.items() if c > 1]
+    profile["patterns"] = value_patterns(sample)
+    return profile
+
+
+def profile_table(df: pd.DataFrame, sample_rows: int = 100_000, top_k: int = 5, seed: int = 0,
+                  full_scan_rows: int = 20_000_000, sample: Optional[pd.DataFrame] = None) -> dict:
+    """Compact per-column profile of a table.
+
+    Top values and patterns always come from a reservoir sample of sample_rows. Null
+    ratio, min/max and the distinct-count sketch scan the whole column up to
+    full_scan_rows; larger tables are profiled from the sample alone so the cost stays
+    bounded regardless of size.
+    """
+    if sample is None:
+        sample = df if len(df) <= sample_rows else reservoir_sample([df], sample_rows, seed)
+    full = df if len(df) <= full_scan_rows else sample
+    return {
+        "row_count": len(df),
+        "sampled_rows": len(sample),
+        "full_scan": full is df,
+        "columns": {
+            str(col): profile_column(full.iloc[:, i], sample.iloc[:, i], top_k)
+            for i, col in enumerate(df.columns)
+        },
+    }
@@ -0,0 +1,62 @@
+# progress.py - Stage timing for merge jobs and Server-Sent Events formatting
+import json
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# In the order a merge runs through them
+MERGE_STAGES = ("load", "profile", "mapping", "apply", "write", "zip", "pdf")
+
+
+class StageTracker:
+    """Times job stages and reports each as an event through report(event).
+
+    Every event carries the stage name, its state ("started", "progress", "finished" or
+    "failed"), the seconds since the job started ("elapsed") and any counters the stage
+    adds (rows, tables, bytes). Finished events also carry the stage's own "seconds".
+    """
+
+    def __init__(self, report: Callable[[dict], None]):
+        self.report = report
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    def _emit(self, stage: str, state: str, **fields):
+        event = {
+            "stage": stage,
+            "state": state,
+            "elapsed": round(time.perf_counter() - self.started, 3),
+            "ts": time.time(),
+        }
+        event.update(fields)
+        self.report(event)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage; the yielded dict's entries are added to its finished event."""
+        counters = {}
+        stage_started = time.perf_counter()
+        self._emit(name, "started")
+        try:
+            yield counters
+        except Exception as e:
+            self._emit(name, "failed", seconds=round(time.perf_counter() - stage_started, 3), error=str(e))
+            raise
+        seconds = round(time.perf_counter() - stage_started, 3)
+        self.timings[name] = seconds
+        self._emit(name, "finished", seconds=seconds, **counters)
+
+    def progress(self, name: str, **fields):
+        """Intermediate counters for a running stage (e.g. rows written so far)"""
+        self._emit(name, "progress", **fields)
+
+
+def sse_event(data: dict, event: Optional[str] = None, event_id: Optional[int] = None) -> str:
+    """One Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,144 @@
+# prompt_planner.py - Token-budgeted, sharded mapping prompts run concurrently
+import asyncio
+import json
+import re
+import time
+from typing import Awaitable, Callable, List, Optional
+
+# Rough average for English/JSON text; good enough to stay under context limits
+CHARS_PER_TOKEN = 4
+# Richest first: full column profiles, then names + dtypes, then names only
+SCHEMA_LEVELS = ("full", "compact", "names")
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1 if text else 0
+
+
+def render_table(info: dict, level: str) -> dict:
+    if level == "full":
+        return info
+    if level == "compact":
+        return {"columns": info["columns"], "dtypes": info.get("dtypes", {}), "row_count": info.get("row_count")}
+    return {"columns": info["columns"]}
+
+
+def render_schema(schema: dict, budget: int):
+    """Render a schema at the richest detail level that fits the token budget."""
+    for level in SCHEMA_LEVELS:
+        rendered = {table: render_table(info, level) for table, info in schema.items()}
+        if estimate_tokens(json.dumps(rendered, indent=2, default=str)) <= budget:
+            return rendered, level
+    return rendered, level
+
+
+def trim_doc(doc: Optional[str], budget: int, keywords) -> Optional[str]:
+    """Cut documentation down to the budget, keeping the lines that mention the keywords.
+
+    Sheet headers are always kept; remaining lines are ranked by how many keywords
+    they mention and emitted in their original order.
+    """
+    if not doc or estimate_tokens(doc) <= budget:
+        return doc
+    words = {k.lower() for k in keywords if len(k) > 2}
+    lines = doc.splitlines()
+
+    def relevance(line):
+        if line.startswith("--- SHEET"):
+            return float("inf")
+        tokens = set(re.split(r"[^0-9a-z_]+", line.lower()))
+        return len(tokens & words)
+
+    ranked = sorted(range(len(lines)), key=lambda i: (-relevance(lines[i]), i))
+    keep, used = set(), 0
+    for i in ranked:
+        cost = estimate_tokens(lines[i]) + 1
+        if used + cost > budget:
+            continue
+        keep.add(i)
+        used += cost
+    omitted = len(lines) - len(keep)
+    kept = [lines[i] for i in sorted(keep)]
+    return "\n".join(kept + [f"(... {omitted} lines omitted to fit the token budget)"])
+
+
+def _schema_keywords(schema: dict):
+    words = set()
+    for table, info in schema.items():
+        words.add(str(table))
+        words.update(str(c) for c in info.get("columns", []))
+    return {w.lower() for w in words}
+
+
+def plan_shards(b1_schema: dict, b2_schema: dict, schema_doc1: Optional[str], schema_doc2: Optional[str],
+                budget: int, prompt_builder: Callable[..., str]) -> List[dict]:
+    """Split the mapping task into prompts that each fit the token budget.
+
+    Every shard sees the full Bundle 2 (target) schema, rendered as richly as its share
+    of the budget allows, and a group of Bundle 1 tables packed until the budget is
+    used up. Documentation is trimmed per shard to the lines relevant to its tables.
+    prompt_builder(b1_schema, b2_schema, schema_doc1, schema_doc2) renders a prompt.
+    """
+    overhead = estimate_tokens(prompt_builder({}, {}, None, None))
+    target_schema, _ = render_schema(b2_schema, int(budget * 0.35))
+    target_tokens = estimate_tokens(json.dumps(target_schema, indent=2, default=str))
+    doc_budget = int(budget * 0.15)
+    doc_tokens = min(estimate_tokens(schema_doc1), doc_budget) + min(estimate_tokens(schema_doc2), doc_budget)
+    source_budget = max(budget - overhead - target_tokens - doc_tokens, 1)
+
+    groups, current, used = [], {}, 0
+    for table in sorted(b1_schema, key=str):
+        rendered, _ = render_schema({table: b1_schema[table]}, source_budget)
+        cost = estimate_tokens(json.dumps(rendered, indent=2, default=str))
+        if current and used + cost > source_budget:
+            groups.append(current)
+            current, used = {}, 0
+        current.update(rendered)
+        used += cost
+    if current:
+        groups.append(current)
+
+    target_words = _schema_keywords(b2_schema)
+    shards = []
+    for group in groups:
+        doc1 = trim_doc(schema_doc1, doc_budget, _schema_keywords(group))
+        doc2 = trim_doc(schema_doc2, doc_budget, target_words)
+        prompt = prompt_builder(group, target_schema, doc1, doc2)
+        shards.append({"tables": list(group), "prompt": prompt, "estimated_tokens": estimate_tokens(prompt)})
+    return shards
+
+
+class RateLimiter:
+    """Spaces out calls to at most requests_per_minute across concurrent tasks."""
+
+    def __init__(self, requests_per_minute: int):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run_concurrently(prompts: List[str], call: Callable[[str], Awaitable[dict]], concurrency: int, requests_per_minute: int) -> List:
+    """Await call(prompt) for every prompt, bounded and rate limited.
+
+    Results come back in prompt order; a failed call yields its exception instead of
+    cancelling the others.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    limiter = RateLimiter(requests_per_minute)
+
+    async def one(prompt):
+        async with semaphore:
+            await limiter.wait()
+            return await call(prompt)
+
+    return await asyncio.gather(*(one(p) for p in prompts), return_exceptions=True)
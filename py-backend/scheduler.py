@@ -0,0 +1,268 @@
+# scheduler.py - Bounded job queue with a worker pool, per-session fairness and cancellation
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The scheduler already holds max_queue waiting jobs."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a thread-mode job at its next progress report after cancel()."""
+
+
+def _process_entry(target, job_id, args, messages):
+    """Child-process side: run the job and send its outcome back to the scheduler."""
+    def report(event):
+        messages.put(("event", job_id, event))
+
+    try:
+        result = target(job_id, *args, report=report)
+        messages.put(("success", job_id, result))
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        messages.put(("failed", job_id, str(e)))
+
+
+class JobScheduler:
+    """Runs target(job_id, *args, report=callback) -> result on a pool of workers.
+
+    Waiting jobs are kept per session and dispatched round-robin across sessions (higher
+    priority first), so one session queueing many merges cannot starve the others. In
+    "process" mode every job runs in its own child process (the pandas work is GIL-bound)
+    and can be terminated; in "thread" mode cancellation takes effect at the job's next
+    report() call. on_update(job_id, fields) receives every state change. If given,
+    should_cancel(job_id) is polled about once a second so a cancellation recorded by
+    another API process reaches the process that owns the job.
+    """
+
+    def __init__(self, target: Callable, on_update: Callable[[str, dict], None], workers: int = 2,
+                 max_queue: int = 32, executor: str = "process", start_method: str = "spawn",
+                 should_cancel: Optional[Callable[[str], bool]] = None):
+        if executor not in ("process", "thread"):
+            raise ValueError("executor must be 'process' or 'thread'")
+        self.target = target
+        self.on_update = on_update
+        self.workers = max(workers, 1)
+        self.max_queue = max_queue
+        self.executor = executor
+        self.should_cancel = should_cancel
+        self._ctx = multiprocessing.get_context(start_method) if executor == "process" else None
+        self._messages = self._ctx.Queue() if self._ctx else queue.Queue()
+        self._waiting = OrderedDict()  # session_id -> deque of (priority, job_id, args, queued_at)
+        self._running = {}  # job_id -> {"worker": Process|Thread, "cancel": Event, "started_at": float}
+        self._lock = threading.Condition()
+        self._started = False
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._completed = {"success": 0, "failed": 0, "cancelled": 0}
+
+    # Public API -----------------------------------------------------------------------
+
+    def submit(self, job_id: str, session_id: str, args: tuple, priority: int = 0) -> int:
+        """Queue a job; returns its position in the queue. Raises QueueFull."""
+        with self._lock:
+            self._ensure_started()
+            if self._queued_count() >= self.max_queue:
+                raise QueueFull(f"{self.max_queue} jobs already queued")
+            self._waiting.setdefault(session_id, deque()).append((priority, job_id, args, time.time()))
+            position = self._queued_count()
+            self._lock.notify_all()
+        self.on_update(job_id, {"status": "queued", "queued_at": time.time()})
+        return position
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """Cancel a queued or running job. Returns its previous state, or None if unknown/finished."""
+        with self._lock:
+            for session_id, waiting in self._waiting.items():
+                for item in waiting:
+                    if item[1] == job_id:
+                        waiting.remove(item)
+                        if not waiting:
+                            del self._waiting[session_id]
+                        self._finish(job_id, "cancelled", error="Cancelled before start")
+                        return "queued"
+            running = self._running.get(job_id)
+            if running is None:
+                return None
+            running["cancel"].set()
+            if self.executor == "process":
+                running["worker"].terminate()
+            return "running"
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        with self._lock:
+            for position, (_, item) in enumerate(self._dispatch_order(), start=1):
+                if item[1] == job_id:
+                    return position
+        return None
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            waits = [now - item[3] for _, item in self._dispatch_order()]
+            return {
+                "executor": self.executor,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_depth": len(waits),
+                "running": len(self._running),
+                "sessions_waiting": len(self._waiting),
+                "oldest_wait_seconds": round(max(waits), 3) if waits else 0.0,
+                "avg_wait_seconds": round(self._wait_total / self._wait_count, 3) if self._wait_count else 0.0,
+                "completed": dict(self._completed),
+            }
+
+    def is_active(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._running or any(item[1] == job_id for _, item in self._dispatch_order())
+
+    # Internals ------------------------------------------------------------------------
+
+    def _ensure_started(self):
+        # Threads start lazily so importing the app in a worker process does not spawn them
+        if not self._started:
+            self._started = True
+            threading.Thread(target=self._dispatch_loop, name="job-dispatch", daemon=True).start()
+            threading.Thread(target=self._message_loop, name="job-messages", daemon=True).start()
+
+    def _queued_count(self):
+        return sum(len(w) for w in self._waiting.values())
+
+    def _dispatch_order(self):
+        """Waiting jobs in the order they would start: priority, then round-robin by session."""
+        lanes = [list(w) for w in self._waiting.values()]
+        order = []
+        while any(lanes):
+            heads = [(lane[0][0], i) for i, lane in enumerate(lanes) if lane]
+            best = max(p for p, _ in heads)
+            for p, i in heads:
+                if p == best:
+                    order.append((i, lanes[i].pop(0)))
+        return order
+
+    def _next_job(self):
+        best_session, best_priority = None, None
+        for session_id, waiting in self._waiting.items():
+            if best_priority is None or waiting[0][0] > best_priority:
+                best_session, best_priority = session_id, waiting[0][0]
+        waiting = self._waiting.pop(best_session)
+        item = waiting.popleft()
+        if waiting:
+            # Back of the line: the session gets its next turn after the others
+            self._waiting[best_session] = waiting
+        return item
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._waiting or len(self._running) >= self.workers:
+                    self._lock.wait(timeout=1.0)
+                    self._reap()
+                    self._poll_cancellations()
+                _, job_id, args, queued_at = self._next_job()
+                waited = time.time() - queued_at
+                self._wait_total += waited
+                self._wait_count += 1
+                cancel = threading.Event()
+                if self.executor == "process":
+                    worker = self._ctx.Process(target=_process_entry, args=(self.target, job_id, args, self._messages), daemon=True)
+                else:
+                    worker = threading.Thread(target=self._thread_entry, args=(job_id, args, cancel), daemon=True)
+                # Reported before the worker starts so a fast job's outcome cannot be overwritten
+                self.on_update(job_id, {"status": "running", "started_at": time.time(), "wait_seconds": round(waited, 3)})
+                try:
+                    worker.start()
+                except Exception as e:
+                    logger.exception("Could not start a worker for job %s", job_id)
+                    self._finish(job_id, "failed", error=f"Could not start worker: {e}")
+                    continue
+                self._running[job_id] = {"worker": worker, "cancel": cancel, "started_at": time.time()}
+
+    def _thread_entry(self, job_id, args, cancel):
+        def report(event):
+            if cancel.is_set():
+                raise JobCancelled()
+            self._messages.put(("event", job_id, event))
+
+        try:
+            result = self.target(job_id, *args, report=report)
+            self._messages.put(("success", job_id, result))
+        except JobCancelled:
+            self._messages.put(("cancelled", job_id, None))
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self._messages.put(("failed", job_id, str(e)))
+
+    def _message_loop(self):
+        while True:
+            try:
+                kind, job_id, payload = self._messages.get(timeout=1.0)
+            except queue.Empty:
+                with self._lock:
+                    self._reap()
+                continue
+            if kind == "event":
+                self.on_update(job_id, {"event": payload})
+                continue
+            with self._lock:
+                running = self._running.pop(job_id, None)
+                if running is None:
+                    continue
+                if running["cancel"].is_set():
+                    kind = "cancelled"
+                if kind == "success":
+                    self._finish(job_id, "success", result=payload)
+                elif kind == "cancelled":
+                    self._finish(job_id, "cancelled", error="Cancelled while running")
+                else:
+                    self._finish(job_id, "failed", error=payload)
+                self._lock.notify_all()
+
+    def _reap(self):
+        """Finish process jobs whose worker died without reporting (terminated or crashed).
+
+        A worker that exits cleanly has already sent its outcome, and threads always do.
+        """
+        if self.executor != "process":
+            return
+        for job_id, running in list(self._running.items()):
+            worker = running["worker"]
+            if worker.is_alive() or worker.exitcode == 0:
+                continue
+            del self._running[job_id]
+            if running["cancel"].is_set():
+                self._finish(job_id, "cancelled", error="Cancelled while running")
+            else:
+                self._finish(job_id, "failed", error=f"Worker exited unexpectedly (exit code {worker.exitcode})")
+            self._lock.notify_all()
+
+    def _poll_cancellations(self):
+        if self.should_cancel is None:
+            return
+        queued = [item[1] for _, item in self._dispatch_order()]
+        running = [job_id for job_id, r in self._running.items() if not r["cancel"].is_set()]
+        for job_id in queued + running:
+            try:
+                requested = self.should_cancel(job_id)
+            except Exception:
+                logger.exception("Cancellation check for job %s failed", job_id)
+                continue
+            if requested:
+                self.cancel(job_id)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self._completed[status] += 1
+        fields = {"status": status, "finished_at": time.time()}
+        if result is not None:
+            fields["result"] = result
+        if error is not None:
+            fields["error"] = error
+        self.on_update(job_id, fields)
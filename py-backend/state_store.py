@@ -0,0 +1,213 @@
+# state_store.py - Session/job state shared by every API worker and kept across restarts
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+try:
+    # redis is only needed for redis:// state backends
+    import redis
+    REDIS_AVAILABLE = True
+except Exception:
+    REDIS_AVAILABLE = False
+
+
+class StateCollection(MutableMapping):
+    """A dict-like view of one namespace (e.g. "sessions") of JSON documents.
+
+    Values are copies: mutating a returned dict does not write it back. Use patch() to
+    merge top-level fields or modify() for any other read-modify-write; both are atomic
+    across processes.
+    """
+
+    def __init__(self, backend, namespace: str):
+        self.backend = backend
+        self.namespace = namespace
+
+    def __getitem__(self, key):
+        value = self.backend.get(self.namespace, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.backend.put(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        if not self.backend.delete(self.namespace, key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.backend.get(self.namespace, key) is not None
+
+    def __iter__(self):
+        return iter(self.backend.keys(self.namespace))
+
+    def __len__(self):
+        return len(self.backend.keys(self.namespace))
+
+    def items(self):
+        return self.backend.items(self.namespace)
+
+    def values(self):
+        return [value for _, value in self.backend.items(self.namespace)]
+
+    def modify(self, key, fn: Callable[[Optional[dict]], Optional[dict]]) -> Optional[dict]:
+        """Atomically replace the value with fn(current or None); None deletes it."""
+        return self.backend.modify(self.namespace, key, fn)
+
+    def patch(self, key, fields: dict, create: bool = True) -> Optional[dict]:
+        """Atomically merge fields into the value (creating it unless create=False)"""
+        def apply(current):
+            if current is None and not create:
+                return None
+            return {**(current or {}), **fields}
+        return self.modify(key, apply)
+
+
+class SQLiteStateBackend:
+    """Default backend: one SQLite file in WAL mode, safe for several worker processes."""
+
+    name = "sqlite"
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get(self, namespace, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, default=str), time.time()),
+            )
+
+    def delete(self, namespace, key) -> bool:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)).rowcount > 0
+
+    def keys(self, namespace):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT key FROM state WHERE namespace = ?", (namespace,))]
+
+    def items(self, namespace):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def modify(self, namespace, key, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent read-modify-writes serialize
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+                value = fn(json.loads(row[0]) if row else None)
+                if value is None:
+                    conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                        (namespace, key, json.dumps(value, default=str), time.time()),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return value
+
+
+class RedisStateBackend:
+    """Keeps each namespace in one Redis hash; works with any Redis-protocol server."""
+
+    name = "redis"
+
+    def __init__(self, client, prefix: str = "datamerge:"):
+        self.client = client
+        self.prefix = prefix
+
+    def _hash(self, namespace):
+        return f"{self.prefix}{namespace}"
+
+    def get(self, namespace, key):
+        raw = self.client.hget(self._hash(namespace), key)
+        return json.loads(raw) if raw is not None else None
+
+    def put(self, namespace, key, value):
+        self.client.hset(self._hash(namespace), key, json.dumps(value, default=str))
+
+    def delete(self, namespace, key) -> bool:
+        return self.client.hdel(self._hash(namespace), key) > 0
+
+    def keys(self, namespace):
+        return [k.decode() if isinstance(k, bytes) else k for k in self.client.hkeys(self._hash(namespace))]
+
+    def items(self, namespace):
+        return [
+            (k.decode() if isinstance(k, bytes) else k, json.loads(v))
+            for k, v in self.client.hgetall(self._hash(namespace)).items()
+        ]
+
+    def modify(self, namespace, key, fn):
+        name = self._hash(namespace)
+        result = {}
+
+        def transaction(pipe):
+            # WATCH/MULTI: retried by redis-py if another client changed the hash meanwhile
+            raw = pipe.hget(name, key)
+            value = fn(json.loads(raw) if raw is not None else None)
+            pipe.multi()
+            if value is None:
+                pipe.hdel(name, key)
+            else:
+                pipe.hset(name, key, json.dumps(value, default=str))
+            result["value"] = value
+
+        self.client.transaction(transaction, name)
+        return result["value"]
+
+
+def create_state_backend(url: str, client=None):
+    """Backend for a state URL: sqlite:///path/to/state.sqlite3 or redis://host:port/db.
+
+    fakeredis:// runs the Redis backend against an in-process stand-in (needs fakeredis).
+    A ready-made Redis-compatible client can be passed instead for redis URLs.
+    """
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(Path(url[len("sqlite:///"):]))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise RuntimeError("redis is not installed; pip install redis to use a redis:// state backend")
+            client = redis.Redis.from_url(url)
+        return RedisStateBackend(client)
+    if url.startswith("fakeredis://"):
+        import fakeredis
+        return RedisStateBackend(client or fakeredis.FakeRedis())
+    raise ValueError(f"unsupported state backend URL '{url}'")
@@ -0,0 +1,259 @@
+# telemetry.py - Structured logging tagged with job/session ids and Prometheus metrics
+import contextvars
+import json
+import logging
+import math
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# Tags attached to every log record and job-side metric emitted in the current context
+_log_context = contextvars.ContextVar("log_context", default={})
+# Inside a merge job, metric observations are shipped to the API process instead of
+# being recorded locally (the job may be running in a child process)
+_metric_sink = contextvars.ContextVar("metric_sink", default=None)
+
+
+# Logging ----------------------------------------------------------------------------
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.context = _log_context.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        tags = " ".join(f"{k}={v}" for k, v in record.context.items())
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if tags:
+            line += f" [{tags}]"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+            **record.context,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "text"):
+    """Route the app's loggers to stderr as text or JSON lines"""
+    handler = logging.StreamHandler()
+    handler.addFilter(ContextFilter())
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+
+
+@contextmanager
+def log_context(**tags):
+    """Tag log records (and job metrics) emitted inside the block, e.g. job_id/session_id"""
+    token = _log_context.set({**_log_context.get(), **{k: v for k, v in tags.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+# Metrics ----------------------------------------------------------------------------
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _label_key(labelnames: Sequence[str], labels: dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, values, extra: Optional[dict] = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    """Value read from a callback at scrape time (or set explicitly)"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+        self._values: Dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(self.labelnames, labels)] = value
+
+    def render(self):
+        lines = self.header()
+        if self.callback is not None:
+            lines.append(f"{self.name} {_format_value(self.callback())}")
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    le = {"le": _format_value(bound)}
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def record(name: str, value: float = 1.0, **labels):
+    """Counter increment or histogram observation, by metric name.
+
+    Inside a merge job (see metric_sink) the observation is forwarded to the API process.
+    """
+    sink = _metric_sink.get()
+    if sink is not None:
+        sink({"name": name, "value": value, "labels": labels})
+        return
+    apply_observation({"name": name, "value": value, "labels": labels})
+
+
+def apply_observation(observation: dict):
+    """Record an observation (from record() or a job event) in this process's registry"""
+    metric = registry.get(observation["name"])
+    if isinstance(metric, Histogram):
+        metric.observe(observation["value"], **observation.get("labels", {}))
+    elif isinstance(metric, Counter):
+        metric.inc(observation["value"], **observation.get("labels", {}))
+    elif isinstance(metric, Gauge):
+        metric.set(observation["value"], **observation.get("labels", {}))
+
+
+@contextmanager
+def metric_sink(sink: Callable[[dict], None]):
+    """Send record() calls in this context to sink instead of the local registry"""
+    token = _metric_sink.set(sink)
+    try:
+        yield
+    finally:
+        _metric_sink.reset(token)
+
+
+# Metric catalog -----------------------------------------------------------------------
+
+STAGE_SECONDS = registry.register(Histogram(
+    "datamerge_stage_seconds", "Duration of merge job stages", ["stage", "mode"]))
+STAGE_ROWS = registry.register(Counter(
+    "datamerge_stage_rows_total", "Rows handled by merge job stages", ["stage", "mode"]))
+JOB_SECONDS = registry.register(Histogram(
+    "datamerge_job_seconds", "Merge job run time, start to finish", ["status"]))
+JOB_WAIT_SECONDS = registry.register(Histogram(
+    "datamerge_job_wait_seconds", "Time merge jobs spent queued"))
+JOBS = registry.register(Counter(
+    "datamerge_jobs_total", "Finished merge jobs", ["status"]))
+QUEUE_DEPTH = registry.register(Gauge(
+    "datamerge_job_queue_depth", "Merge jobs waiting for a worker"))
+JOBS_RUNNING = registry.register(Gauge(
+    "datamerge_jobs_running", "Merge jobs currently running"))
+LLM_SECONDS = registry.register(Histogram(
+    "datamerge_llm_request_seconds", "Model call latency per attempt", ["backend", "outcome"]))
+LLM_TOKENS = registry.register(Counter(
+    "datamerge_llm_tokens_total", "Estimated tokens sent to and received from the model", ["backend", "direction"]))
+UPLOAD_BYTES = registry.register(Counter(
+    "datamerge_upload_bytes_total", "Bytes received by the upload endpoints", ["kind"]))
+OUTPUT_BYTES = registry.register(Counter(
+    "datamerge_output_bytes_total", "Merged output bytes, before (table) and after (archive) compression", ["kind"]))
@@ -0,0 +1,329 @@
+# transforms.py - Safe, vectorized field transformation expressions for field mappings
+import ast
+import operator
+from functools import lru_cache
+from typing import Callable, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# Longest expression accepted; transforms are one-liners, not programs
+MAX_EXPRESSION_LENGTH = 2000
+MAX_POWER = 64
+
+_BINARY = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+}
+_COMPARE = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+_BOOLEAN_WORDS = {"true": True, "t": True, "yes": True, "y": True, "1": True,
+                  "false": False, "f": False, "no": False, "n": False, "0": False}
+
+
+class TransformError(ValueError):
+    """A transform expression that is invalid, uses something not allowed, or fails on the data."""
+
+
+# Functions --------------------------------------------------------------------------
+# Every function takes and returns whole columns (Series) or scalars; none runs Python
+# code per row.
+
+def _series(value, index) -> pd.Series:
+    return value if isinstance(value, pd.Series) else pd.Series(value, index=index)
+
+
+def _text(value, index) -> pd.Series:
+    series = _series(value, index)
+    return series if pd.api.types.is_string_dtype(series.dtype) and series.dtype != object else series.astype("string")
+
+
+def _to_int(x, index):
+    numbers = pd.to_numeric(_series(x, index), errors="coerce")
+    return np.trunc(numbers).astype("Int64")
+
+
+def _to_bool(x, index):
+    series = _series(x, index)
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series.astype("boolean")
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.ne(0).astype("boolean").mask(series.isna())
+    return _text(series, index).str.strip().str.lower().map(_BOOLEAN_WORDS).astype("boolean")
+
+
+def _date(x, index, format=None, dayfirst=False):
+    return pd.to_datetime(_series(x, index), errors="coerce", format=format, dayfirst=dayfirst)
+
+
+def _concat(*parts, index, sep=""):
+    if not parts:
+        raise TransformError("concat() needs at least one argument")
+    texts = [_text(p, index) for p in parts]
+    return texts[0].str.cat(texts[1:], sep=sep, na_rep="") if len(texts) > 1 else texts[0]
+
+
+def _lookup(x, table, index, default=None):
+    if not isinstance(table, dict):
+        raise TransformError("lookup() needs a {key: value} table as its second argument")
+    series = _series(x, index)
+    mapped = series.map(table)
+    if pd.api.types.is_numeric_dtype(series.dtype) and all(isinstance(k, str) for k in table):
+        # Codes read as numbers from CSV but written as strings in the table
+        mapped = mapped.fillna(series.astype("string").map(table))
+    return mapped if default is None else mapped.where(mapped.notna(), default)
+
+
+def _replace(x, old, new, index):
+    if not isinstance(old, str) or not old or not isinstance(new, str):
+        raise TransformError("replace() needs a non-empty text to find and a replacement text")
+    return _text(x, index).str.replace(old, new, regex=False)
+
+
+def _where(condition, a, b, index):
+    condition = _series(condition, index).fillna(False).astype(bool)
+    return _series(a, index).where(condition, b)
+
+
+def _coalesce(*values, index):
+    if not values:
+        raise TransformError("coalesce() needs at least one argument")
+    result = _series(values[0], index)
+    for value in values[1:]:
+        result = result.where(result.notna(), value)
+    return result
+
+
+FUNCTIONS: Dict[str, Callable] = {
+    "int": _to_int,
+    "float": lambda x, index: pd.to_numeric(_series(x, index), errors="coerce").astype("float64"),
+    "number": lambda x, index: pd.to_numeric(_series(x, index), errors="coerce"),
+    "str": lambda x, index: _text(x, index),
+    "bool": _to_bool,
+    "date": _date,
+    "upper": lambda x, index: _text(x, index).str.upper(),
+    "lower": lambda x, index: _text(x, index).str.lower(),
+    "strip": lambda x, index: _text(x, index).str.strip(),
+    "title": lambda x, index: _text(x, index).str.title(),
+    "len": lambda x, index: _text(x, index).str.len().astype("Int64"),
+    "replace": _replace,
+    "substr": lambda x, start, stop=None, index=None: _text(x, index).str.slice(start, stop),
+    "split": lambda x, sep, part, index: _text(x, index).str.split(sep, regex=False).str[part],
+    "concat": _concat,
+    "lookup": _lookup,
+    "round": lambda x, digits=0, index=None: _series(x, index).round(digits),
+    "abs": lambda x, index: _series(x, index).abs(),
+    "coalesce": _coalesce,
+    "where": _where,
+    "isnull": lambda x, index: _series(x, index).isna(),
+    "notnull": lambda x, index: _series(x, index).notna(),
+}
+# Arguments that must be literals (not columns), by function
+LITERAL_ARGUMENTS = {
+    "replace": (1, 2), "substr": (1, 2), "split": (1, 2), "round": (1,), "lookup": (1, 2),
+}
+
+
+# Compiler ---------------------------------------------------------------------------
+
+def _literal(node):
+    """Value of a constant expression node (numbers, strings, booleans, None, -n, {k: v})"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) and isinstance(node.operand, ast.Constant) \
+            and isinstance(node.operand.value, (int, float)):
+        return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+    if isinstance(node, ast.Dict) and None not in node.keys:
+        return {_literal(k): _literal(v) for k, v in zip(node.keys, node.values)}
+    raise TransformError(f"expected a literal value, got {ast.unparse(node)!r}")
+
+
+def _column(df: pd.DataFrame, name: str) -> pd.Series:
+    if name not in df.columns:
+        raise TransformError(f"unknown column '{name}'")
+    return df[name]
+
+
+def _binary(op, left, right):
+    scalars = not isinstance(left, pd.Series) and not isinstance(right, pd.Series)
+    if scalars and not (isinstance(left, str) and isinstance(right, str) and op is operator.add):
+        if not all(isinstance(v, (int, float, bool, np.number)) for v in (left, right)):
+            raise TransformError("only numbers can be combined with arithmetic")
+        # Fixed-width arithmetic: no unbounded Python integers
+        left, right = np.float64(left), np.float64(right)
+    if op is operator.mul and any(isinstance(v, str) or (isinstance(v, pd.Series) and pd.api.types.is_string_dtype(v.dtype))
+                                  for v in (left, right)):
+        raise TransformError("text cannot be multiplied; use concat()")
+    with np.errstate(all="ignore"):
+        return op(left, right)
+
+
+def _compile(node, source_field: Optional[str]) -> Callable[[pd.DataFrame], object]:
+    if isinstance(node, ast.Expression):
+        return _compile(node.body, source_field)
+
+    if isinstance(node, (ast.Constant, ast.Dict)) or (
+            isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) and isinstance(node.operand, ast.Constant)):
+        value = _literal(node)
+        return lambda df: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name == "value":
+            if source_field is None:
+                raise TransformError("'value' is not available: the mapping has no source field")
+            name = source_field
+        elif name in ("true", "false", "null"):
+            value = {"true": True, "false": False, "null": None}[name]
+            return lambda df: value
+
+        return lambda df: _column(df, name)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+        op = _BINARY[type(node.op)]
+        if op is operator.pow:
+            exponent = node.right
+            if not isinstance(exponent, (ast.Constant, ast.UnaryOp)) or abs(_literal(exponent)) > MAX_POWER:
+                raise TransformError(f"exponents must be literal numbers up to {MAX_POWER}")
+        left, right = _compile(node.left, source_field), _compile(node.right, source_field)
+        return lambda df: _binary(op, left(df), right(df))
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile(node.operand, source_field)
+        if isinstance(node.op, ast.USub):
+            return lambda df: -operand(df)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.Not):
+            return lambda df: ~_series(operand(df), df.index).fillna(False).astype(bool)
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile(v, source_field) for v in node.values]
+        combine = operator.and_ if isinstance(node.op, ast.And) else operator.or_
+
+        def boolean(df):
+            result = _series(values[0](df), df.index).fillna(False).astype(bool)
+            for value in values[1:]:
+                result = combine(result, _series(value(df), df.index).fillna(False).astype(bool))
+            return result
+        return boolean
+
+    if isinstance(node, ast.Compare) and all(type(op) in _COMPARE for op in node.ops):
+        operands = [_compile(v, source_field) for v in [node.left, *node.comparators]]
+        ops = [_COMPARE[type(op)] for op in node.ops]
+
+        def compare(df):
+            values = [f(df) for f in operands]
+            result = None
+            for op, left, right in zip(ops, values, values[1:]):
+                part = _series(op(left, right), df.index).fillna(False).astype(bool)
+                result = part if result is None else result & part
+            return result
+        return compare
+
+    if isinstance(node, ast.IfExp):
+        condition, a, b = (_compile(n, source_field) for n in (node.test, node.body, node.orelse))
+        return lambda df: _where(condition(df), a(df), b(df), df.index)
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        name = node.func.id
+        if name == "col":
+            if len(node.args) != 1 or node.keywords:
+                raise TransformError("col() takes one column name")
+            name = _literal(node.args[0])
+            if not isinstance(name, str):
+                raise TransformError("col() takes one column name")
+            return lambda df: _column(df, name)
+        if name not in FUNCTIONS:
+            raise TransformError(f"unknown function '{name}'")
+        if any(isinstance(a, ast.Starred) for a in node.args) or any(k.arg is None for k in node.keywords):
+            raise TransformError("*args and **kwargs are not allowed")
+        literal_positions = LITERAL_ARGUMENTS.get(name, ())
+        args = [
+            (lambda value: (lambda df: value))(_literal(a)) if i in literal_positions else _compile(a, source_field)
+            for i, a in enumerate(node.args)
+        ]
+        kwargs = {k.arg: _literal(k.value) for k in node.keywords}
+        function = FUNCTIONS[name]
+
+        def call(df):
+            try:
+                return function(*(a(df) for a in args), index=df.index, **kwargs)
+            except TypeError as e:
+                raise TransformError(f"{name}(): {e}") from e
+        return call
+
+    raise TransformError(f"'{ast.unparse(node)}' is not allowed in a transform")
+
+
+@lru_cache(maxsize=1024)
+def compile_transform(expression: str, source_field: Optional[str] = None) -> Callable[[pd.DataFrame], pd.Series]:
+    """Compile a transform expression into a function of the source DataFrame.
+
+    Expressions use Python syntax restricted to literals, column names (value is the
+    mapping's source field; col("name") reaches any column), arithmetic, comparisons,
+    and/or/not, "a if cond else b" and the functions in FUNCTIONS - no attributes,
+    subscripts, lambdas or comprehensions, so nothing runs per row. For example:
+    float(value) * 100, date(value, format="%d/%m/%Y"), concat(first, last, sep=" "),
+    lookup(value, {"M": "male", "F": "female"}). Raises TransformError.
+    """
+    if not isinstance(expression, str) or not expression.strip():
+        raise TransformError("a transform must be a non-empty string")
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise TransformError(f"transforms are limited to {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+        raise TransformError(f"invalid transform syntax: {e.msg}") from e
+    compiled = _compile(tree, source_field)
+
+    def transform(df: pd.DataFrame) -> pd.Series:
+        try:
+            result = compiled(df)
+        except TransformError:
+            raise
+        except (TypeError, ValueError, AttributeError) as e:
+            raise TransformError(f"{expression}: {e}") from e
+        return _series(result, df.index).reset_index(drop=True)
+    return transform
+
+
+def transform_columns(expression: str, source_field: Optional[str] = None) -> set:
+    """Names of the source columns an expression reads"""
+    columns = set()
+    for node in ast.walk(ast.parse(expression.strip(), mode="eval")):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "col" and node.args \
+                and isinstance(node.args[0], ast.Constant):
+            columns.add(node.args[0].value)
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in ("col", "true", "false", "null"):
+            columns.add(source_field if node.id == "value" else node.id)
+    return columns
+
+
+def validate_transforms(mappings: dict, columns: Optional[Dict[str, list]] = None) -> list:
+    """Compile every transform in a mappings document; invalid ones are removed and noted.
+
+    With columns (source table -> column names), transforms reading a column the table
+    lacks are invalid too. A failed field mapping falls back to copying its source
+    field, and gets the error in "transform_error". Returns the list of errors.
+    """
+    errors = []
+    for tm in mappings.get("table_mappings", []):
+        known = None if columns is None else {str(c) for c in columns.get(tm["source_table"], [])}
+        for fm in tm.get("field_mappings", []):
+            expression = fm.get("transform")
+            if expression is None:
+                continue
+            try:
+                compile_transform(expression, fm.get("source_field"))
+                missing = sorted(transform_columns(expression, fm.get("source_field")) - known) if known is not None else []
+                if missing:
+                    raise TransformError(f"unknown column(s) {', '.join(map(str, missing))}")
+            except TransformError as e:
+                fm.pop("transform")
+                fm["transform_error"] = f"{expression!r}: {e}"
+                errors.append({"source_table": tm["source_table"], "target_table": tm["target_table"],
+                               "target_field": fm["target_field"], "error": fm["transform_error"]})
+    return errors
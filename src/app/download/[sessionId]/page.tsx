@@ -12,6 +12,7 @@ export default function DownloadPage() {
   const [summary, setSummary] = useState<any | null>(null);
   const [mappings, setMappings] = useState<any | null>(null);
   const [openTables, setOpenTables] = useState<Record<string, boolean>>({});
+  const [selected, setSelected] = useState<Record<string, boolean>>({});
 
   const API_BASE = process.env.NEXT_PUBLIC_API_BASE || "http://localhost:8000";
 
@@ -85,11 +86,29 @@ export default function DownloadPage() {
           </div>
 
           <div className="mt-6">
-            <h3 className="text-lg font-semibold mb-3">Files</h3>
+            <div className="flex items-center justify-between mb-3">
+              <h3 className="text-lg font-semibold">Files</h3>
+              {/* Zip of just the checked tables, streamed from the stored output */}
+              {Object.values(selected).some(Boolean) && (
+                <a
+                  href={`${API_BASE}/api/archive/${encodeURIComponent(sessionId)}?${Object.keys(selected).filter((f) => selected[f]).map((f) => `tables=${encodeURIComponent(f)}`).join("&")}`}
+                  className="text-sm font-semibold text-[#137fec]"
+                >
+                  Download selected
+                </a>
+              )}
+            </div>
             <ul className="space-y-3">
               {files && files.map((f) => (
                 <li key={f} className="flex items-center justify-between p-3 rounded-lg border border-black/5">
                   <div className="flex items-center gap-3">
+                    {f.startsWith("merged_") && f !== "merged_output.zip" && (
+                      <input
+                        type="checkbox"
+                        checked={!!selected[f]}
+                        onChange={(e) => setSelected((s) => ({ ...s, [f]: e.target.checked }))}
+                      />
+                    )}
                     <FiFileText className="w-5 h-5 text-black/60" />
                     <div className="font-medium">{f}</div>
                   </div>
@@ -28,6 +28,7 @@ export default function Page() {
   const [uploadError, setUploadError] = useState<string | null>(null);
   const [sessionId, setSessionId] = useState<string | null>(null);
   const [merging, setMerging] = useState(false);
+  const [progress, setProgress] = useState<string | null>(null);
   const router = useRouter();
 
   const API_BASE = process.env.NEXT_PUBLIC_API_BASE || "http://localhost:8000";
@@ -151,7 +152,21 @@ export default function Page() {
       const jobJson = await res.json();
       const jobId = jobJson.job_id;
 
-      // Poll job status
+      const finish = (j: any) => {
+        if (j.status === "success") {
+          // save result and navigate
+          try {
+            localStorage.setItem(`merge_result_${sessionId}`, JSON.stringify(j.result));
+          } catch (e) {}
+          router.push(`/download/${sessionId}`);
+        } else {
+          setUploadError(j.error || `Merge job ${j.status}`);
+          setMerging(false);
+          setProgress(null);
+        }
+      };
+
+      // Poll job status (fallback when the event stream is unavailable)
       const poll = async (): Promise<void> => {
         try {
           const r = await fetch(`${API_BASE}/api/job/${encodeURIComponent(jobId)}`);
@@ -160,16 +175,8 @@ export default function Page() {
             throw new Error(t || "Job status fetch failed");
           }
           const j = await r.json();
-          if (j.status === "success") {
-            // save result and navigate
-            try {
-              localStorage.setItem(`merge_result_${sessionId}`, JSON.stringify(j.result));
-            } catch (e) {}
-            router.push(`/download/${sessionId}`);
-            return;
-          } else if (j.status === "failed") {
-            setUploadError(j.error || "Merge job failed");
-            setMerging(false);
+          if (j.status === "success" || j.status === "failed" || j.status === "cancelled") {
+            finish(j);
             return;
           } else {
             // still queued/running -> wait and poll again
@@ -181,7 +188,33 @@ export default function Page() {
         }
       };
 
-      poll();
+      // Follow stage events as they happen; the final result is fetched once at the end
+      if (typeof EventSource === "undefined") {
+        poll();
+        return;
+      }
+      const events = new EventSource(`${API_BASE}/api/job/${encodeURIComponent(jobId)}/events`);
+      events.addEventListener("stage", (e) => {
+        const ev = JSON.parse((e as MessageEvent).data);
+        const rows = typeof ev.rows === "number" ? ` · ${ev.rows.toLocaleString()} rows` : "";
+        setProgress(`${ev.stage} ${ev.state}${rows} (${Number(ev.elapsed).toFixed(1)}s)`);
+      });
+      events.addEventListener("done", async () => {
+        events.close();
+        try {
+          const r = await fetch(`${API_BASE}/api/job/${encodeURIComponent(jobId)}`);
+          finish(await r.json());
+        } catch (err: any) {
+          setUploadError(err.message || String(err));
+          setMerging(false);
+        }
+      });
+      events.onerror = () => {
+        // EventSource retries on its own while the server is reachable; give up on a hard failure
+        if (events.readyState === EventSource.CLOSED) {
+          poll();
+        }
+      };
 
     } catch (e: any) {
       setUploadError(e.message || String(e));
@@ -307,7 +340,7 @@ export default function Page() {
           <div className="hidden md:flex mt-10 justify-end border-t border-black/10 pt-6">
             <div className={merging ? "animate-pulse" : ""}>
               <ContinueButton disabled={!canContinue || merging} onClick={handleContinue}>
-                {merging ? "Merging..." : "Continue"}
+                {merging ? (progress ? `Merging: ${progress}` : "Merging...") : "Continue"}
               </ContinueButton>
             </div>
           </div>
@@ -322,7 +355,7 @@ export default function Page() {
           </div>
             <div className="ml-auto w-[50%]">
               <ContinueButton disabled={!canContinue || merging} onClick={handleContinue}>
-                {merging ? "Merging..." : "Continue"}
+                {merging ? (progress ? `Merging: ${progress}` : "Merging...") : "Continue"}
               </ContinueButton>
             </div>
         </div>